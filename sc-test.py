@@ -31,8 +31,8 @@ GenerateSyntheticCount.scATAC_GenerateSyntheticCount(count_mat_filename=count_ma
 GenerateSyntheticCount.scATAC_GenerateSyntheticCount(count_mat_filename=count_mat_nonpeak_filename, directory=outdirectory, outdirectory=outdirectory)
 
 # Specify the names of synthetic count matrices (generated by GenerateSyntheticCount.scATAC_GenerateSyntheticCount)
-synthetic_countmat_peak_file = count_mat_peak_filename + ".scDesign2Simulated.txt"
-synthetic_countmat_nonpeak_file = count_mat_nonpeak_filename + ".scDesign2Simulated.txt"
+synthetic_countmat_peak_file = count_mat_peak_filename + ".scDesign2Simulated.mtx"
+synthetic_countmat_nonpeak_file = count_mat_nonpeak_filename + ".scDesign2Simulated.mtx"
 # Specify the base name of bed files containing synthetic reads
 OUTPUT_cells_barcode_file = "synthetic_cell_barcode.txt"
 peak_read_bedfile_prename = "%s.syntheticBAM.peak" % filename
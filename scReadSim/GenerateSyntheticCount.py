@@ -23,7 +23,7 @@ if len(names_to_install) > 0:
     utils.install_packages(StrVector(names_to_install))
 
 
-def scATAC_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new=None, total_count_new=None, celllabel_file=None, n_cluster=None):
+def scATAC_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new=None, total_count_new=None, celllabel_file=None, n_cluster=None, count_mat_format="mtx"):
 	"""Simulate synthetic count matrix.
 
 	Parameters
@@ -40,6 +40,8 @@ def scATAC_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n
 		Number of (expected) sequencing depth. If not specified, scReadSim uses the real sequencing depth.
 	celllabel_file: `str` (default: None)
 		Specify the one-column text file containing the predefined cell labels. Make sure that the order of cell labels correspond to the cell barcode file. If no cell labels are specified, scReadSim performs a Louvain clustering before implementing scDesign2.
+	count_mat_format: `str` (default: 'mtx')
+		Specify the format of the synthetic count matrix. 'mtx' writes the sparse Matrix Market file `count_mat_filename`.scDesign2Simulated.mtx with sidecars `count_mat_filename`.scDesign2Simulated.features.txt and `count_mat_filename`.scDesign2Simulated.barcodes.txt; 'txt' exports the dense text matrix `count_mat_filename`.scDesign2Simulated.txt. The input count matrix is read in whichever format function bam2countmat() wrote it.
 	"""
 	r = robjects.r
 	rscript_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Rscript/SyntheticCountFunctions.R')
@@ -55,9 +57,9 @@ def scATAC_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n
 		celllabel_file = "default"
 	if n_cluster == None:
 		n_cluster = "default"
-	scATAC_runSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new, total_count_new, celllabel_file, n_cluster)
+	scATAC_runSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new, total_count_new, celllabel_file, n_cluster, count_mat_format)
 	print("[scReadSim] Created:")
-	print("[scReadSim] Synthetic count matrix: %s.scDesign2Simulated.txt" % count_mat_filename)
+	print("[scReadSim] Synthetic count matrix: %s.scDesign2Simulated.%s" % (count_mat_filename, count_mat_format))
 	print("[scReadSim] Cell label file: %s.scDesign2Simulated.CellTypeLabel.txt" % count_mat_filename)
 	# if cluster_prestep == True:
 	# 	scATAC_runSyntheticCount(count_mat_filename, directory, outdirectory, cluster_prestep = 1)
@@ -65,7 +67,7 @@ def scATAC_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n
 	# 	scATAC_runSyntheticCount(count_mat_filename, directory, outdirectory, cluster_prestep = 0)
 
 
-def scRNA_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new=None, total_count_new=None, celllabel_file=None, n_cluster=None):
+def scRNA_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new=None, total_count_new=None, celllabel_file=None, n_cluster=None, count_mat_format="mtx"):
 	"""Simulate synthetic count matrix.
 
 	Parameters
@@ -82,6 +84,8 @@ def scRNA_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_
 		Number of (expected) sequencing depth. If not specified, scReadSim uses the real sequencing depth.
 	celllabel_file: `str` (default: None)
 		Specify the one-column text file containing the predefined cell labels. Make sure that the order of cell labels correspond to the cell barcode file. If no cell labels are specified, scReadSim performs a Louvain clustering before implementing scDesign2.
+	count_mat_format: `str` (default: 'mtx')
+		Specify the format of the synthetic count matrix. 'mtx' writes the sparse Matrix Market file `count_mat_filename`.scDesign2Simulated.mtx with sidecars `count_mat_filename`.scDesign2Simulated.features.txt and `count_mat_filename`.scDesign2Simulated.barcodes.txt; 'txt' exports the dense text matrix `count_mat_filename`.scDesign2Simulated.txt. The input count matrix is read in whichever format function bam2countmat() wrote it.
 	"""
 	r = robjects.r
 	rscript_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Rscript/SyntheticCountFunctions.R')
@@ -97,9 +101,9 @@ def scRNA_GenerateSyntheticCount(count_mat_filename, directory, outdirectory, n_
 		celllabel_file = "default"
 	if n_cluster == None:
 		n_cluster = "default"
-	scRNA_runSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new, total_count_new, celllabel_file, n_cluster)
+	scRNA_runSyntheticCount(count_mat_filename, directory, outdirectory, n_cell_new, total_count_new, celllabel_file, n_cluster, count_mat_format)
 	print("[scReadSim] Created:")
-	print("[scReadSim] Synthetic count matrix: %s.scDesign2Simulated.txt" % count_mat_filename)
+	print("[scReadSim] Synthetic count matrix: %s.scDesign2Simulated.%s" % (count_mat_filename, count_mat_format))
 	print("[scReadSim] Cell label file: %s.scDesign2Simulated.CellTypeLabel.txt" % count_mat_filename)
 
 	# if cluster_prestep == True:
@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+import pysam
+
+
+# An interval set maps each chromosome name to a pair of int64 arrays (start, end) of half-open BED intervals.
+# Functions below compute chromosome by chromosome and return new interval sets.
+
+
+def from_arrays(chrom, start, end):
+    """Build an interval set from parallel chromosome, start and end arrays. Chromosomes keep their order of first appearance.
+
+    """
+    chrom = np.asarray(chrom).astype(str)
+    start = np.asarray(start, dtype=np.int64)
+    end = np.asarray(end, dtype=np.int64)
+    intervals = {}
+    if len(chrom) == 0:
+        return intervals
+    chrom_names, first_idx, chrom_idx = np.unique(chrom, return_index=True, return_inverse=True)
+    for k in np.argsort(first_idx):
+        keep = chrom_idx == k
+        intervals[str(chrom_names[k])] = (start[keep], end[keep])
+    return intervals
+
+
+def read_bed(bed_file):
+    """Read the first three columns of a BED file (or of a BED-like file such as MACS3 narrowPeak) as an interval set.
+
+    Parameters
+    ----------
+    bed_file: `str`
+        Path to the BED file.
+
+    Return
+    ------
+    intervals: `dict`
+        Interval set of the BED records, in file order.
+    """
+    try:
+        bed_df = pd.read_csv(bed_file, sep="\t", header=None, usecols=[0, 1, 2], comment="#", dtype={0: str})
+    except pd.errors.EmptyDataError:
+        return {}
+    return from_arrays(bed_df[0].to_numpy(), bed_df[1].to_numpy(), bed_df[2].to_numpy())
+
+
+def write_bed(intervals, bed_file):
+    """Write an interval set as a three-column BED file.
+
+    """
+    frames = [pd.DataFrame({"chrom": chrom, "start": start, "end": end}) for chrom, (start, end) in intervals.items()]
+    if len(frames) == 0:
+        open(bed_file, 'w').close()
+        return
+    pd.concat(frames).to_csv(bed_file, sep="\t", header=False, index=False)
+
+
+def n_intervals(intervals):
+    """Return the number of intervals of an interval set.
+
+    """
+    return sum(len(start) for start, end in intervals.values())
+
+
+def read_genome_size(genome_size_file, chromosomes=None):
+    """Read a genome sizes file (chromosome name and size, tab delimited).
+
+    Parameters
+    ----------
+    genome_size_file: `str`
+        Path to the genome sizes file.
+    chromosomes: `list` (default: None)
+        Only keep chromosomes with exactly these names. If None, keep all chromosomes.
+
+    Return
+    ------
+    genome_size: `dict`
+        Size of each chromosome, in file order.
+    """
+    genome_size_df = pd.read_csv(genome_size_file, sep="\t", header=None, usecols=[0, 1], dtype={0: str})
+    genome_size = dict(zip(genome_size_df[0], genome_size_df[1].astype(np.int64)))
+    if chromosomes is not None:
+        chromosomes = set(chromosomes)
+        genome_size = {chrom: size for chrom, size in genome_size.items() if chrom in chromosomes}
+    return genome_size
+
+
+def bam_chromosomes(INPUT_bamfile):
+    """Return the chromosomes with at least one mapped read, read from the BAM index in-process.
+
+    """
+    samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+    chromosomes = [stat.contig for stat in samfile.get_index_statistics() if stat.mapped > 0]
+    samfile.close()
+    return chromosomes
+
+
+def select_chromosomes(intervals, chromosomes):
+    """Keep the intervals on chromosomes whose names exactly match `chromosomes`.
+
+    """
+    chromosomes = set(chromosomes)
+    return {chrom: pair for chrom, pair in intervals.items() if chrom in chromosomes}
+
+
+def sort(intervals):
+    """Sort an interval set by chromosome name, then by start and end, as `bedtools sort` does.
+
+    """
+    sorted_intervals = {}
+    for chrom in sorted(intervals):
+        start, end = intervals[chrom]
+        order = np.lexsort((end, start))
+        sorted_intervals[chrom] = (start[order], end[order])
+    return sorted_intervals
+
+
+def merge(intervals):
+    """Sort an interval set and merge overlapping and book-ended intervals, as `bedtools sort | bedtools merge` does.
+
+    """
+    merged = {}
+    for chrom, (start, end) in sort(intervals).items():
+        if len(start) == 0:
+            continue
+        run_end = np.maximum.accumulate(end)
+        is_first = np.ones(len(start), dtype=bool)
+        is_first[1:] = start[1:] > run_end[:-1]
+        first = np.nonzero(is_first)[0]
+        last = np.append(first[1:] - 1, len(start) - 1)
+        merged[chrom] = (start[first], run_end[last])
+    return merged
+
+
+def union(*interval_sets):
+    """Merge the intervals of several interval sets.
+
+    """
+    combined = {}
+    for intervals in interval_sets:
+        for chrom, (start, end) in intervals.items():
+            if chrom in combined:
+                combined[chrom] = (np.concatenate((combined[chrom][0], start)), np.concatenate((combined[chrom][1], end)))
+            else:
+                combined[chrom] = (start, end)
+    return merge(combined)
+
+
+def complement(intervals, genome_size):
+    """Return the regions of the genome not covered by an interval set, as `bedtools complement` does. Chromosomes follow the order of `genome_size`; intervals on chromosomes absent from `genome_size` are ignored.
+
+    Parameters
+    ----------
+    intervals: `dict`
+        Interval set.
+    genome_size: `dict`
+        Size of each chromosome, e.g. from `read_genome_size`.
+    """
+    merged = merge(intervals)
+    empty = np.zeros(0, dtype=np.int64)
+    complemented = {}
+    for chrom, size in genome_size.items():
+        start, end = merged.get(chrom, (empty, empty))
+        gap_start = np.concatenate(([0], np.minimum(end, size)))
+        gap_end = np.concatenate((np.minimum(start, size), [size]))
+        keep = gap_end > gap_start
+        if keep.any():
+            complemented[chrom] = (gap_start[keep].astype(np.int64), gap_end[keep].astype(np.int64))
+    return complemented
+
+
+def intersect(intervals_a, intervals_b):
+    """Return the regions covered by both interval sets.
+
+    """
+    merged_a = merge(intervals_a)
+    merged_b = merge(intervals_b)
+    intersected = {}
+    for chrom, (start_a, end_a) in merged_a.items():
+        if chrom not in merged_b:
+            continue
+        start_b, end_b = merged_b[chrom]
+        first = np.searchsorted(end_b, start_a, side="right")
+        last = np.searchsorted(start_b, end_a, side="left")
+        n_hit = np.maximum(last - first, 0)
+        idx_a = np.repeat(np.arange(len(start_a)), n_hit)
+        idx_b = np.arange(n_hit.sum()) - np.repeat(np.cumsum(n_hit) - n_hit, n_hit) + np.repeat(first, n_hit)
+        start = np.maximum(start_a[idx_a], start_b[idx_b])
+        end = np.minimum(end_a[idx_a], end_b[idx_b])
+        keep = end > start
+        if keep.any():
+            intersected[chrom] = (start[keep], end[keep])
+    return intersected
+
+
+def subtract(intervals_a, intervals_b):
+    """Return the regions covered by `intervals_a` but not by `intervals_b`.
+
+    """
+    merged_a = merge(intervals_a)
+    span = {chrom: int(end.max()) for chrom, (start, end) in merged_a.items()}
+    return intersect(merged_a, complement(select_chromosomes(intervals_b, span), span))
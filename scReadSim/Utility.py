@@ -1,15 +1,28 @@
 import csv
+import array
+import gzip
+import hashlib
+import heapq
+import itertools
+import multiprocessing
 import numpy as np
 import pysam
 import pandas as pd
 from collections import defaultdict
+from collections import OrderedDict
+from collections import deque
 from time import process_time
 import sys
 import subprocess
 from tqdm import tqdm
 import os
+import shutil
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from joblib import Parallel, delayed
 from collections import Counter
+import scReadSim.IntervalSet as IntervalSet
 
 
 def CallPeak(macs3_directory, INPUT_bamfile, outdirectory, MACS3_peakname_pre, qval=0.05):
@@ -25,219 +38,2169 @@ def CallPeak(macs3_directory, INPUT_bamfile, outdirectory, MACS3_peakname_pre, q
         Output directory of peak calling.
     MACS3_peakname_pre: `str`
         Base name of peak calling results for MACS3.
+    qval: `float` (default: 0.05)
+        Minimum q-value cutoff for peak detection.
     """
     macs_cmd = "%s/macs3 callpeak -f BAMPE -t %s -g mm -n %s/%s -B -q %s --outdir %s" % (macs3_directory, INPUT_bamfile, outdirectory, MACS3_peakname_pre, qval, outdirectory)
     output, error = subprocess.Popen(macs_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
     print('[MACS3] Call peaks:\n', error.decode())
 
 
-def ExtractBAMCoverage(INPUT_bamfile, samtools_directory, outdirectory):
+def filter_narrowpeak(narrowpeak_file, qval):
+    """Select the MACS3 narrowPeak records passing a stricter q-value cutoff.
+
+    Parameters
+    ----------
+    narrowpeak_file: `str`
+        MACS3 narrowPeak file, called with a q-value cutoff no stricter than `qval`.
+    qval: `float`
+        Minimum q-value cutoff. Records are kept if their -log10 q-value (column 9) is at least -log10(`qval`).
+
+    Return
+    ------
+    intervals: `dict`
+        Interval set of the selected records.
+    """
+    try:
+        narrowpeak_df = pd.read_csv(narrowpeak_file, sep="\t", header=None, usecols=[0, 1, 2, 8], comment="#", dtype={0: str})
+    except pd.errors.EmptyDataError:
+        return {}
+    narrowpeak_df = narrowpeak_df[narrowpeak_df[8] >= -np.log10(qval)]
+    return IntervalSet.from_arrays(narrowpeak_df[0].to_numpy(), narrowpeak_df[1].to_numpy(), narrowpeak_df[2].to_numpy())
+
+
+def ExtractBAMCoverage(INPUT_bamfile, samtools_directory=None, outdirectory=None):
     """Examine the covered chromosome names for the input bam file.
 
     Parameters
     ----------
-    INPUT_bamfile: `str`
-        Directory of input BAM file.
-    samtools_directory: `str`
-        Directory of software samtools.
-    outdirectory: `str`
-        Output directory.
-    
+    INPUT_bamfile: `str`
+        Directory of input BAM file.
+    samtools_directory: `str` (default: None)
+        Directory of software samtools. Not used anymore: the BAM index is read in-process.
+    outdirectory: `str` (default: None)
+        Output directory. Not used anymore.
+    
+    Return
+    ------
+    chromosomes_coverd: `list`
+        List of chromosome names that the input bam files covers.
+    """
+    chromosomes_coverd = IntervalSet.bam_chromosomes(INPUT_bamfile)
+    return chromosomes_coverd
+
+
+def scATAC_CreateFeatureSets(INPUT_bamfile, samtools_directory, bedtools_directory, outdirectory, genome_size_file, macs3_directory, INPUT_peakfile=None, INPUT_nonpeakfile=None, OUTPUT_peakfile=None, macs3_single_pass=True, peak_qval=0.01, nonpeak_qval=0.1):
+    """Create the foreground and background feature set for the input scATAC-seq bam file.
+
+    Parameters
+    ----------
+    INPUT_bamfile: `str`
+        Directory of input BAM file.
+    samtools_directory: `str`
+        Directory of software samtools. Not used anymore: the BAM index is read in-process.
+    bedtools_directory: `str`
+        Directory of software bedtools. Not used anymore: interval operations are computed by module `IntervalSet`.
+    outdirectory: `str`
+        Output directory.
+    genome_size_file: `str`
+        Directory of Genome sizes file. The file should be a tab delimited text file with two columns: first column for the chromosome name, second column indicates the size.  
+    macs3_directory: `str`
+        Path to software MACS3.
+    INPUT_peakfile: `str` (default: None)
+        Directory of user-specified input peak file.
+    INPUT_nonpeakfile: `str` (default: None)
+        Directory of user-specified input non-peak file.
+    OUTPUT_peakfile: `str` (default: None)
+        Directory of user-specified output peak file. Synthetic scATAC-seq reads will be generated taking `OUTPUT_peakfile` as ground truth peaks. Note that `OUTPUT_peakfile` does not name the generated feature files by function `scATAC_CreateFeatureSets`.
+    macs3_single_pass: `bool` (default: True)
+        Only used when peaks and non-peaks are called by MACS3. If True, run MACS3 once with cutoff `nonpeak_qval` and select the peaks passing `peak_qval` from its narrowPeak q-value column. If False, run MACS3 twice, once per cutoff, with both runs executed concurrently.
+    peak_qval: `float` (default: 0.01)
+        MACS3 q-value cutoff defining peaks.
+    nonpeak_qval: `float` (default: 0.1)
+        MACS3 q-value cutoff defining non-peaks as the regions outside the called peaks.
+    """
+    # Input peaks and non-peaks
+    if INPUT_peakfile is None or INPUT_nonpeakfile is None:
+        # Define peaks and non-peaks using MACS3
+        peakfile = "scReadSim.MACS3.peak.bed"
+        nonpeakfile = "scReadSim.MACS3.nonpeak.bed"
+        print("[scReadSim] No Input Peaks and Non-Peaks.")
+        print("[scReadSim] Generate Peaks and Non-Peaks using MACS3 Instead.")
+        # The MACS3 runs are external processes: read the BAM index and genome sizes while they run
+        executor = ThreadPoolExecutor(max_workers=2)
+        if macs3_single_pass:
+            print("[scReadSim] Generating Peaks and Non-Peaks using one MACS3 run...")
+            macs3_runs = [executor.submit(CallPeak, macs3_directory, INPUT_bamfile, outdirectory, "scReadSim_MACS3_LessStringent", nonpeak_qval)]
+        else:
+            print("[scReadSim] Generating Peaks and Non-Peaks using two concurrent MACS3 runs...")
+            macs3_runs = [executor.submit(CallPeak, macs3_directory, INPUT_bamfile, outdirectory, "scReadSim_MACS3_Stringent", peak_qval), executor.submit(CallPeak, macs3_directory, INPUT_bamfile, outdirectory, "scReadSim_MACS3_LessStringent", nonpeak_qval)]
+        chromosomes_coverd = ExtractBAMCoverage(INPUT_bamfile)
+        genome_size = IntervalSet.read_genome_size(genome_size_file, chromosomes_coverd)
+        for macs3_run in macs3_runs:
+            macs3_run.result()
+        executor.shutdown()
+        # Call peaks
+        if macs3_single_pass:
+            peaks = IntervalSet.merge(filter_narrowpeak("%s/scReadSim_MACS3_LessStringent_peaks.narrowPeak" % outdirectory, peak_qval))
+        else:
+            peaks = IntervalSet.merge(IntervalSet.read_bed("%s/scReadSim_MACS3_Stringent_peaks.narrowPeak" % outdirectory))
+        IntervalSet.write_bed(peaks, "%s/%s" % (outdirectory, peakfile))
+        print("[scReadSim] Peaks Generated: %s/%s" % (outdirectory, peakfile))
+        # Calculate the inter peaks as non-peaks
+        lessstringent_peaks = IntervalSet.read_bed("%s/scReadSim_MACS3_LessStringent_peaks.narrowPeak" % outdirectory)
+        nonpeaks = IntervalSet.complement(lessstringent_peaks, genome_size)
+        IntervalSet.write_bed(nonpeaks, "%s/%s" % (outdirectory, nonpeakfile))
+        print("[scReadSim] Non-Peaks Generated: %s/%s" % (outdirectory, nonpeakfile))
+    else:
+        peakfile = "scReadSim.UserInput.peak.bed"
+        nonpeakfile = "scReadSim.UserInput.nonpeak.bed"
+        chromosomes_coverd = ExtractBAMCoverage(INPUT_bamfile)
+        genome_size = IntervalSet.read_genome_size(genome_size_file, chromosomes_coverd)
+        # Merge and sort peak file
+        print("[scReadSim] Merging Input Peak File: %s" % INPUT_peakfile)
+        peaks = IntervalSet.merge(IntervalSet.read_bed(INPUT_peakfile))
+        IntervalSet.write_bed(peaks, "%s/%s" % (outdirectory, peakfile))
+        print("[scReadSim] Merging Input Non-Peak File: %s" % INPUT_nonpeakfile)
+        print("[scReadSim] Peaks Generated: %s/%s" % (outdirectory, peakfile))
+        # Merge and sort non-peak file
+        nonpeaks = IntervalSet.merge(IntervalSet.read_bed(INPUT_nonpeakfile))
+        IntervalSet.write_bed(nonpeaks, "%s/%s" % (outdirectory, nonpeakfile))
+        print("[scReadSim] Non-Peaks Generated: %s/%s" % (outdirectory, nonpeakfile))
+    # Union peaks and non-peaks
+    print("[scReadSim] Generating Gray Areas...")
+    grayareas = IntervalSet.complement(IntervalSet.union(peaks, nonpeaks), genome_size)
+    IntervalSet.write_bed(grayareas, "%s/scReadSim.grayareas.bed" % outdirectory)
+    print("[scReadSim] Gray Areas Generated: %s/scReadSim.grayareas.bed" % outdirectory)
+    print('\n[scReadSim] Created:')
+    print('[scReadSim] Peak File: %s/%s' % (outdirectory, peakfile))
+    print('[scReadSim] Non-Peak File: %s/%s' % (outdirectory, nonpeakfile))
+    print('[scReadSim] Gray Area File: %s/scReadSim.grayareas.bed' % (outdirectory))
+    # Output Peak Mode
+    if OUTPUT_peakfile is not None:
+        output_peakfile = "scReadSim.output.peak.bed"
+        output_nonpeakfile = "scReadSim.output.nonpeak.bed"
+        print("\n[scReadSim] User-specified Output Peaks Detected: %s" % OUTPUT_peakfile)
+        # Merge and sort output peak file
+        print("[scReadSim] Merging Output Peak File: %s" % OUTPUT_peakfile)
+        output_peaks = IntervalSet.merge(IntervalSet.read_bed(OUTPUT_peakfile))
+        IntervalSet.write_bed(output_peaks, "%s/%s" % (outdirectory, output_peakfile))
+        print("Generating Output Non-Peaks...")
+        IntervalSet.write_bed(IntervalSet.complement(output_peaks, genome_size), "%s/%s" % (outdirectory, output_nonpeakfile))
+        print('\n[scReadSim] Created:')
+        print('[scReadSim] Output Peak File: %s/%s' % (outdirectory, output_peakfile))
+        print('[scReadSim] Output Non-Peak File: %s/%s' % (outdirectory, output_nonpeakfile))
+    print('[scReadSim] Done!')
+
+
+ANNOTATION_INDEX_VERSION = 1
+ANNOTATION_FEATURES = ("gene", "exon")
+
+
+class AnnotationIndex:
+    """Gene and exon regions of a GTF genome annotation file, sorted per chromosome by start and end. Columns 1, 4 and 5 of the GTF records are used as chromosome, start and end.
+
+    Parameters
+    ----------
+    chrom_names: `list`
+        Chromosome names, in order of first appearance in the GTF file.
+    features: `dict`
+        For each feature type in `ANNOTATION_FEATURES`, a tuple (chrom_offset, start, end) of arrays. Regions on the k-th chromosome are start[chrom_offset[k]:chrom_offset[k+1]].
+    """
+    def __init__(self, chrom_names, features):
+        self.chrom_names = [str(chrom) for chrom in chrom_names]
+        self.features = {feature: tuple(np.asarray(array, dtype=np.int64) for array in features[feature]) for feature in ANNOTATION_FEATURES}
+
+    @classmethod
+    def from_gtf(cls, genome_annotation, chunksize=1000000):
+        """Build the index by streaming the GTF file (plain or gzipped) in chunks of `chunksize` records.
+
+        """
+        chrom_id = {}
+        chunks = {feature: [] for feature in ANNOTATION_FEATURES}
+        gtf_reader = pd.read_csv(genome_annotation, sep="\t", header=None, usecols=[0, 2, 3, 4], comment="#", quoting=csv.QUOTE_NONE, dtype={0: str, 2: str, 3: np.int64, 4: np.int64}, chunksize=chunksize)
+        for gtf_df in gtf_reader:
+            gtf_df = gtf_df[gtf_df[2].isin(ANNOTATION_FEATURES)]
+            chrom_code, chrom_uniques = pd.factorize(gtf_df[0])
+            for chrom in chrom_uniques:
+                chrom_id.setdefault(chrom, len(chrom_id))
+            chrom_code = np.asarray([chrom_id[chrom] for chrom in chrom_uniques], dtype=np.int64)[chrom_code] if len(chrom_uniques) > 0 else np.zeros(0, dtype=np.int64)
+            for feature in ANNOTATION_FEATURES:
+                is_feature = (gtf_df[2] == feature).to_numpy()
+                chunks[feature].append((chrom_code[is_feature], gtf_df[3].to_numpy()[is_feature], gtf_df[4].to_numpy()[is_feature]))
+        features = {}
+        for feature in ANNOTATION_FEATURES:
+            chrom_code = np.concatenate([chunk[0] for chunk in chunks[feature]] + [np.zeros(0, dtype=np.int64)])
+            start = np.concatenate([chunk[1] for chunk in chunks[feature]] + [np.zeros(0, dtype=np.int64)])
+            end = np.concatenate([chunk[2] for chunk in chunks[feature]] + [np.zeros(0, dtype=np.int64)])
+            order = np.lexsort((end, start, chrom_code))
+            chrom_offset = np.searchsorted(chrom_code[order], np.arange(len(chrom_id) + 1))
+            features[feature] = (chrom_offset, start[order], end[order])
+        return cls(list(chrom_id), features)
+
+    @classmethod
+    def load(cls, index_file):
+        """Load an index saved by `save`.
+
+        """
+        with np.load(index_file) as index_npz:
+            features = {feature: (index_npz["%s_chrom_offset" % feature], index_npz["%s_start" % feature], index_npz["%s_end" % feature]) for feature in ANNOTATION_FEATURES}
+            return cls(index_npz["chrom_names"], features)
+
+    def save(self, index_file, source_key):
+        """Save the index with `source_key`, the (size, modification time, SHA-1) triple of its GTF file. The file is written under a temporary name and then renamed, so concurrent runs never read a partial index.
+
+        """
+        arrays = {"version": np.int64(ANNOTATION_INDEX_VERSION), "source_size": np.int64(source_key[0]), "source_mtime_ns": np.int64(source_key[1]), "source_sha1": np.array(source_key[2]), "chrom_names": np.array(self.chrom_names, dtype=str)}
+        for feature in ANNOTATION_FEATURES:
+            chrom_offset, start, end = self.features[feature]
+            arrays["%s_chrom_offset" % feature] = chrom_offset
+            arrays["%s_start" % feature] = start
+            arrays["%s_end" % feature] = end
+        tmp_file = "%s.%d.tmp" % (index_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, index_file)
+
+    def restrict(self, chromosomes):
+        """Return the index restricted to the chromosomes whose names exactly match `chromosomes`.
+
+        """
+        chromosomes = set(chromosomes)
+        keep = [k for k, chrom in enumerate(self.chrom_names) if chrom in chromosomes]
+        features = {}
+        for feature in ANNOTATION_FEATURES:
+            chrom_offset, start, end = self.features[feature]
+            region_idx = np.concatenate([np.arange(chrom_offset[k], chrom_offset[k + 1]) for k in keep] + [np.zeros(0, dtype=np.int64)])
+            chrom_len = np.asarray([chrom_offset[k + 1] - chrom_offset[k] for k in keep], dtype=np.int64)
+            features[feature] = (np.concatenate(([0], np.cumsum(chrom_len))), start[region_idx], end[region_idx])
+        return AnnotationIndex([self.chrom_names[k] for k in keep], features)
+
+    def intervals(self, feature="gene"):
+        """Return the regions of one feature type as an interval set.
+
+        """
+        chrom_offset, start, end = self.features[feature]
+        return {chrom: (start[chrom_offset[k]:chrom_offset[k + 1]], end[chrom_offset[k]:chrom_offset[k + 1]]) for k, chrom in enumerate(self.chrom_names) if chrom_offset[k + 1] > chrom_offset[k]}
+
+
+def annotation_index_file(genome_annotation):
+    """Return the path of the annotation index saved next to a GTF file.
+
+    """
+    return "%s.scReadSim.index.npz" % genome_annotation
+
+
+def load_annotation_index(genome_annotation, chromosomes=None, cache=True):
+    """Load the annotation index of a GTF file, building it if needed.
+
+    Parameters
+    ----------
+    genome_annotation: `str`
+        GTF genome annotation file.
+    chromosomes: `list` (default: None)
+        Restrict the index to chromosomes with exactly these names, e.g. those covered by the input BAM file. If None, keep all chromosomes.
+    cache: `bool` (default: True)
+        Reuse the index saved next to the GTF file and save a newly built one there. A saved index is used if the GTF file has the recorded size and modification time, or otherwise the recorded SHA-1 checksum.
+
+    Return
+    ------
+    annotation_index: `AnnotationIndex`
+        Gene and exon regions of the annotation.
+    """
+    index_file = annotation_index_file(genome_annotation)
+    gtf_stat = os.stat(genome_annotation)
+    annotation_index = None
+    is_stale = True
+    if cache and os.path.exists(index_file):
+        with np.load(index_file) as index_npz:
+            if int(index_npz["version"]) == ANNOTATION_INDEX_VERSION and int(index_npz["source_size"]) == gtf_stat.st_size:
+                is_stale = int(index_npz["source_mtime_ns"]) != gtf_stat.st_mtime_ns
+                gtf_sha1 = file_content_hash(genome_annotation) if is_stale else str(index_npz["source_sha1"])
+                if gtf_sha1 == str(index_npz["source_sha1"]):
+                    annotation_index = AnnotationIndex.load(index_file)
+                    print("[scReadSim] Loaded Annotation Index: %s" % index_file)
+    if annotation_index is None:
+        print("[scReadSim] Building Annotation Index for %s..." % genome_annotation)
+        annotation_index = AnnotationIndex.from_gtf(genome_annotation)
+        gtf_sha1 = file_content_hash(genome_annotation) if cache else None
+    # Save a newly built index, or record the new modification time of an unchanged GTF file
+    if cache and is_stale:
+        try:
+            annotation_index.save(index_file, (gtf_stat.st_size, gtf_stat.st_mtime_ns, gtf_sha1))
+            print("[scReadSim] Annotation Index Saved: %s" % index_file)
+        except OSError as e:
+            print("[scReadSim] Annotation Index Not Saved: %s" % e)
+    if chromosomes is not None:
+        annotation_index = annotation_index.restrict(chromosomes)
+    return annotation_index
+
+
+def scRNA_CreateFeatureSets(INPUT_bamfile, samtools_directory, bedtools_directory, outdirectory, genome_annotation, genome_size_file, annotation_cache=True):
+    """Create the foreground and background feature set for the input scRNA-seq bam file.
+
+    Parameters
+    ----------
+    INPUT_bamfile: `str`
+        Input BAM file.
+    samtools_directory: `str`
+        Path to software `samtools`. Not used anymore: the BAM index is read in-process.
+    bedtools_directory: `str`
+        Path to software `bedtools`. Not used anymore: interval operations are computed by module `IntervalSet`.
+    outdirectory: `str`
+        Specify the output directory of the features files.
+    genome_annotation: `str`
+        Genome annotation file for the reference genome that the input BAM aligned on or the synthetic BAM should align on.
+    genome_size_file: `str`
+        Genome sizes file. The file should be a tab delimited text file with two columns: first column for the chromosome name, second column indicates the size.
+    annotation_cache: `bool` (default: True)
+        Reuse the annotation index saved next to `genome_annotation` by previous runs, or save it there after parsing the GTF file.
+    """
+    chromosomes_coverd = ExtractBAMCoverage(INPUT_bamfile)
+    genome_size = IntervalSet.read_genome_size(genome_size_file, chromosomes_coverd)
+    annotation_index = load_annotation_index(genome_annotation, chromosomes_coverd, cache=annotation_cache)
+    print("[scReadSim] Generating Bed File for Genes...")
+    genes = IntervalSet.merge(annotation_index.intervals("gene"))
+    IntervalSet.write_bed(genes, "%s/scReadSim.Gene.bed" % outdirectory)
+    print("[scReadSim] Generating Bed File for InterGenes...")
+    IntervalSet.write_bed(IntervalSet.complement(genes, genome_size), "%s/scReadSim.InterGene.bed" % outdirectory)
+    print('\n[scReadSim] Created:')
+    print('[scReadSim] Gene Bed File: %s/scReadSim.Gene.bed' % (outdirectory))
+    print('[scReadSim] InterGene Bed File: %s/scReadSim.InterGene.bed' % (outdirectory))
+    print('[scReadSim] Done!')
+
+
+BASE_2BIT_TABLE = str.maketrans("ACGT", "0123")
+
+
+def encode_2bit(seq):
+    """Pack an ACGT string into an integer with 2 bits per base.
+
+    A leading sentinel digit keeps sequences of different lengths distinct. Return -1 if `seq` contains a base other than A, C, G or T.
+    """
+    try:
+        return int("1" + seq.translate(BASE_2BIT_TABLE), 4)
+    except ValueError:
+        return -1
+
+
+class BarcodeResolver:
+    """Resolve the cell barcode of each read to its column index in the count matrix.
+
+    Lookups are hashed, so each read costs O(1) regardless of the number of cells. Whitelists with more than `compact_threshold` barcodes (e.g. combinatorial-indexing data) are stored as sorted 2-bit packed integers, 8 bytes per barcode, and resolved barcodes are cached in a bounded hash table.
+
+    Parameters
+    ----------
+    cells_barcode: `list`
+        Cell barcodes, in the column order of the count matrix.
+    barcode_tag: `str` (default: None)
+        BAM tag storing the cell barcode, e.g. 'CB' or 'CB:Z'. If None, the cell barcode is taken from the read name before the first ':'.
+    compact_threshold: `int` (default: 1000000)
+        Whitelist size above which barcodes are stored in packed form.
+    """
+    cache_size = 1000000
+
+    def __init__(self, cells_barcode, barcode_tag=None, compact_threshold=1000000):
+        self.barcode_tag = None if barcode_tag is None else barcode_tag[:2]
+        self.cells_n = len(cells_barcode)
+        self.suffix = None
+        self.cellsdic = {}
+        self.packed_barcode = None
+        if self.cells_n > compact_threshold:
+            self.packed_barcode, self.packed_idx, self.suffix = self.pack_whitelist(cells_barcode)
+        if self.packed_barcode is None:
+            self.cellsdic = {str(cell).upper(): k for k, cell in enumerate(cells_barcode)}
+
+    @staticmethod
+    def pack_whitelist(cells_barcode):
+        """Pack a whitelist whose barcodes share a common non-ACGT suffix (such as '-1'). Return None if barcodes cannot be packed.
+
+        """
+        first = str(cells_barcode[0]).upper()
+        seq_len = len(first.rstrip("-0123456789"))
+        suffix = first[seq_len:]
+        packed = np.empty(len(cells_barcode), dtype=np.int64)
+        for k, cell in enumerate(cells_barcode):
+            cell = str(cell).upper()
+            if len(cell) != seq_len + len(suffix) or not cell.endswith(suffix) or seq_len > 30:
+                return None, None, None
+            packed[k] = encode_2bit(cell[:seq_len])
+            if packed[k] < 0:
+                return None, None, None
+        packed_idx = np.argsort(packed, kind="stable")
+        return packed[packed_idx], packed_idx, suffix
+
+    def lookup(self, cell):
+        """Return the column index of barcode `cell`, or -1 if it is not in the whitelist.
+
+        """
+        idx = self.cellsdic.get(cell)
+        if idx is not None:
+            return idx
+        if self.packed_barcode is None:
+            return -1
+        idx = -1
+        if cell.endswith(self.suffix):
+            key = encode_2bit(cell[:len(cell) - len(self.suffix)])
+            pos = np.searchsorted(self.packed_barcode, key)
+            if key >= 0 and pos < len(self.packed_barcode) and self.packed_barcode[pos] == key:
+                idx = int(self.packed_idx[pos])
+        if len(self.cellsdic) >= self.cache_size:
+            self.cellsdic.clear()
+        self.cellsdic[cell] = idx
+        return idx
+
+    def read_barcode(self, read):
+        """Return the cell barcode of `read`, or None if the read has no barcode tag.
+
+        """
+        if self.barcode_tag is None:
+            return read.query_name.split(":", 1)[0].upper()
+        if not read.has_tag(self.barcode_tag):
+            return None
+        return read.get_tag(self.barcode_tag).upper()
+
+    def cell_index(self, read):
+        """Return the column index of the cell `read` comes from, or -1 if the cell is not in the whitelist.
+
+        """
+        cell = self.read_barcode(read)
+        if cell is None:
+            return -1
+        return self.lookup(cell)
+
+
+def load_cell_barcodes(cells_barcode_file):
+    """Read the one-column cell barcode file.
+
+    """
+    cells = pd.read_csv(cells_barcode_file, sep="\t", header=None, dtype=str)
+    return cells.iloc[:,0].tolist()
+
+
+BARCODE_BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+BARCODE_MAX_SIZE = 32 # Barcodes are packed into 64-bit integers, 2 bits per base
+BARCODE_BATCH_SIZE = 65536 # Candidates drawn at a time under a minimum Hamming distance
+
+
+def encode_barcodes(barcodes):
+    """Pack equal-length ACGT barcodes into a `numpy.uint64` array with 2 bits per base, the first base in the highest bits. Return the codes and the barcode length.
+
+    """
+    barcodes = np.asarray(barcodes, dtype=bytes)
+    size = barcodes.dtype.itemsize
+    if size > BARCODE_MAX_SIZE:
+        sys.exit("[ERROR] Barcodes longer than %d bp are not supported." % BARCODE_MAX_SIZE)
+    base_codes = BASE_CODE[np.frombuffer(barcodes.tobytes(), dtype=np.uint8).reshape(len(barcodes), size)]
+    if np.any(base_codes < 0):
+        sys.exit("[ERROR] Barcodes should be of equal length and only contain A, C, G and T.")
+    codes = np.zeros(len(barcodes), dtype=np.uint64)
+    for column in range(size):
+        codes = (codes << np.uint64(2)) | base_codes[:,column].astype(np.uint64)
+    return codes, size
+
+
+def decode_barcodes(codes, size):
+    """Unpack barcodes packed by `encode_barcodes` into a list of strings.
+
+    """
+    codes = np.asarray(codes, dtype=np.uint64)
+    shifts = np.arange(2 * (size - 1), -1, -2, dtype=np.uint64)
+    base_codes = (codes[:,None] >> shifts) & np.uint64(3)
+    return np.frombuffer(BARCODE_BASES[base_codes].tobytes(), dtype='S%d' % size).astype(str).tolist()
+
+
+def load_barcode_whitelist(whitelist_file):
+    """Read a barcode whitelist, one barcode per line (e.g. the 10x Genomics '737K-arc-v1.txt'), gzip compressed if its name ends with '.gz'. Return the unique packed barcodes and their length (see `encode_barcodes`).
+
+    """
+    with open_input(whitelist_file) as infile:
+        barcodes = [line.strip().upper() for line in infile if line.strip()]
+    if len(barcodes) == 0:
+        sys.exit("[ERROR] Barcode whitelist %s is empty." % whitelist_file)
+    codes, size = encode_barcodes(barcodes)
+    return np.unique(codes), size
+
+
+def first_occurrences(*keys):
+    """Return the mask of the entries that are the first occurrence of their combination of values in the equal-length arrays `keys`.
+
+    """
+    # lexsort is stable, so the first entry of each run of equal values is the first occurrence
+    order = np.lexsort(keys[::-1])
+    repeated = np.ones(len(order), dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        repeated[1:] &= sorted_key[1:] == sorted_key[:-1]
+    repeated[:1] = False
+    first = np.empty(len(order), dtype=bool)
+    first[order] = ~repeated
+    return first
+
+
+def draw_barcode_codes(n, size, rng, groups=None):
+    """Draw `n` random packed barcodes of `size` bp in bulk, unique within each group of `groups` (e.g. the UMIs of one cell), or unique overall if `groups` is None. Duplicates are redrawn until none is left.
+
+    """
+    n_codes = 4 ** size
+    groups = np.zeros(n, dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+    if n > 0 and np.max(np.bincount(groups)) > n_codes:
+        sys.exit("[ERROR] Cannot draw %d distinct barcodes of %d bp." % (np.max(np.bincount(groups)), size))
+    codes = rng.integers(0, n_codes, size=n, dtype=np.uint64)
+    # Pack the group and the barcode into one sort key when they fit into 64 bits
+    packed = n == 0 or (int(np.max(groups)) + 1) * n_codes <= 1 << 64
+    keys = lambda: (groups.astype(np.uint64) * np.uint64(n_codes % (1 << 64)) + codes,) if packed else (groups, codes)
+    duplicate = ~first_occurrences(*keys())
+    while np.any(duplicate):
+        codes[duplicate] = rng.integers(0, n_codes, size=np.count_nonzero(duplicate), dtype=np.uint64)
+        duplicate = ~first_occurrences(*keys())
+    return codes
+
+
+def barcode_distance(code, codes, size):
+    """Return the Hamming distances between packed barcode `code` and each barcode of array `codes`.
+
+    """
+    diff = np.bitwise_xor(codes, np.uint64(code))
+    # One bit per mismatched base
+    diff = (diff | (diff >> np.uint64(1))) & np.uint64(int("01" * BARCODE_MAX_SIZE, 2))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def spaced_barcode_codes(n, size, candidates, min_distance):
+    """Greedily accept packed barcodes from the iterable of arrays `candidates`, in order, if they are at Hamming distance `min_distance` or more from all accepted ones, until `n` barcodes are accepted. Return the accepted barcodes, fewer than `n` if the candidates run out.
+
+    The barcode is split into 2 (`min_distance` - 1) segments. Two barcodes closer than `min_distance` share at least half of the segments, so each candidate is only compared with the accepted barcodes sharing one combination of half of its segments, looked up in one hash table per combination.
+    """
+    n_segments = min(size, 2 * (min_distance - 1))
+    bounds = np.linspace(0, size, n_segments + 1).astype(int)
+    segment_masks = [((1 << (2 * (hi - lo))) - 1) << (2 * (size - hi)) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    key_masks = [np.uint64(sum(masks)) for masks in itertools.combinations(segment_masks, n_segments - min_distance + 1)]
+    base_mask = int("01" * size, 2)
+    buckets = [{} for _ in key_masks]
+    accepted = []
+    for batch in candidates:
+        batch_keys = zip(*[(batch & mask).tolist() for mask in key_masks])
+        for code, keys in zip(batch.tolist(), batch_keys):
+            close = False
+            for bucket, key in zip(buckets, keys):
+                for neighbor in bucket.get(key, ()):
+                    diff = code ^ neighbor
+                    # One bit per mismatched base
+                    if bin((diff | (diff >> 1)) & base_mask).count("1") < min_distance:
+                        close = True
+                        break
+                if close:
+                    break
+            if close:
+                continue
+            accepted.append(code)
+            for bucket, key in zip(buckets, keys):
+                bucket.setdefault(key, []).append(code)
+            if len(accepted) == n:
+                break
+        if len(accepted) == n:
+            break
+    return np.array(accepted, dtype=np.uint64)
+
+
+def generate_barcodes(n, size=16, rng=None, whitelist=None, min_distance=1, groups=None):
+    """Generate distinct random barcodes, e.g. synthetic cell barcodes or UMIs.
+
+    Barcodes are drawn in bulk as integers and decoded to ACGT with NumPy, and duplicates are redrawn, so no two cells share a barcode.
+
+    Parameters
+    ----------
+    n: `int`
+        Number of barcodes.
+    size: `int` (default: 16)
+        Barcode length, up to 32 bp.
+    rng: `numpy.random.Generator` (default: None)
+        Random generator. If None, use a generator seeded with 2022.
+    whitelist: `str` or `tuple` (default: None)
+        Barcode whitelist file (see `load_barcode_whitelist`), or its loaded (codes, size), to sample barcodes from without replacement. Its barcodes should be `size` bp long.
+    min_distance: `int` (default: 1)
+        Minimum Hamming distance between any two barcodes. Barcodes are accepted greedily in random order above 1 (see `spaced_barcode_codes`).
+    groups: `numpy.ndarray` (default: None)
+        Group index of each barcode, e.g. the cell of each UMI. Barcodes are then only unique within their group. Only used for random barcodes with `min_distance` 1.
+
+    Return
+    ------
+    barcodes: `list`
+        List of `n` barcodes.
+    """
+    if rng is None:
+        rng = np.random.default_rng(2022)
+    if size > BARCODE_MAX_SIZE:
+        sys.exit("[ERROR] Barcodes longer than %d bp are not supported." % BARCODE_MAX_SIZE)
+    if min_distance > size:
+        sys.exit("[ERROR] Minimum Hamming distance %d exceeds the barcode length %d." % (min_distance, size))
+    if whitelist is not None:
+        whitelist_codes, whitelist_size = load_barcode_whitelist(whitelist) if isinstance(whitelist, str) else whitelist
+        if whitelist_size != size:
+            sys.exit("[ERROR] Whitelist barcodes are %d bp long, while %d bp barcodes are required." % (whitelist_size, size))
+        shuffled = rng.permutation(whitelist_codes)
+        if min_distance <= 1:
+            codes = shuffled[:n]
+        else:
+            codes = spaced_barcode_codes(n, size, (shuffled[lo:lo + BARCODE_BATCH_SIZE] for lo in range(0, len(shuffled), BARCODE_BATCH_SIZE)), min_distance)
+        if len(codes) < n:
+            sys.exit("[ERROR] The whitelist only provides %d of the %d requested barcodes." % (len(codes), n))
+    elif min_distance <= 1:
+        codes = draw_barcode_codes(n, size, rng, groups)
+    else:
+        # Give up after a generous number of candidates, when the barcode space is too small for `n` barcodes at `min_distance`
+        max_candidates = 20 * n + 1000000
+        # Repeated candidates are rejected as closer than `min_distance`
+        codes = spaced_barcode_codes(n, size, (rng.integers(0, 4 ** size, size=BARCODE_BATCH_SIZE, dtype=np.uint64) for _ in range(max_candidates // BARCODE_BATCH_SIZE + 1)), min_distance)
+        if len(codes) < n:
+            sys.exit("[ERROR] Could only draw %d of the %d requested %d bp barcodes at Hamming distance %d or more." % (len(codes), n, size, min_distance))
+    return decode_barcodes(codes, size)
+
+
+count_worker_state = {}
+
+
+def count_worker_init(INPUT_bamfile, open_peak, barcode_resolver, UMI_tag=None, bam_threads=1):
+    """Set up a count worker: open its persistent BAM handle, with `bam_threads` BGZF decompression threads, and keep the feature set and barcode resolver for its tasks.
+
+    Used as the `initializer` of the count worker pool, so the state reaches workers explicitly and they also run under the spawn start method.
+    """
+    count_worker_state.clear()
+    count_worker_state["samfile"] = pysam.AlignmentFile(INPUT_bamfile, "rb", threads=bam_threads)
+    count_worker_state["open_peak"] = open_peak
+    count_worker_state["barcode_resolver"] = barcode_resolver
+    count_worker_state["UMI_tag"] = UMI_tag
+
+
+def synthesis_worker_init(INPUT_bamfile, worker_data, bam_threads=1):
+    """Set up a read synthesis worker: open its persistent BAM handle, unless `INPUT_bamfile` is None, and keep the read-only data of its tasks (e.g. synthetic count matrix, features and cell barcodes) from dict `worker_data`.
+
+    Used as the `initializer` of `run_count_workers` by the synthetic read generators. Workers sampling from a `TemplateStore` in `worker_data` do not read the BAM file and get no handle.
+    """
+    count_worker_state.clear()
+    count_worker_state["samfile"] = None if INPUT_bamfile is None else pysam.AlignmentFile(INPUT_bamfile, "rb", threads=bam_threads)
+    count_worker_state.update(worker_data)
+
+
+def run_count_workers(shard_func, shards, initargs, n_cores=1, start_method=None, initializer=count_worker_init):
+    """Run `shard_func` on every shard in a pool of `n_cores` workers set up by `initializer` (`count_worker_init` by default). Results are returned in shard order.
+
+    """
+    if n_cores <= 1 or len(shards) <= 1:
+        initializer(*initargs)
+        results = [shard_func(shard) for shard in tqdm(shards)]
+        if count_worker_state.get("samfile") is not None:
+            count_worker_state["samfile"].close()
+        count_worker_state.clear()
+        return results
+    ctx = multiprocessing.get_context(start_method)
+    with ctx.Pool(processes=min(n_cores, len(shards)), initializer=initializer, initargs=initargs) as pool:
+        results = list(tqdm(pool.imap(shard_func, shards), total=len(shards)))
+    return results
+
+
+def feature_rng(random_seed, *key):
+    """Return the random generator of one feature, seeded by the root seed `random_seed` and the feature's integer key (e.g. its index). Streams of different features are independent, so results do not depend on the order or process features are handled in.
+
+    """
+    return np.random.default_rng([random_seed] + [int(k) for k in key])
+
+
+def merge_shard_files(shard_files, output_file):
+    """Concatenate shard files, in order, into `output_file` and remove them.
+
+    """
+    with open(output_file, 'wb') as outsfile:
+        for shard_file in shard_files:
+            with open(shard_file, 'rb') as infile:
+                shutil.copyfileobj(infile, outsfile, 1 << 24)
+            os.remove(shard_file)
+
+
+def run_synthesis_shards(shard_func, feature_ids, bed_files, INPUT_bamfile, worker_data, settings, n_cores=1, sort_memory="1G", compress_threads=1):
+    """Generate the synthetic reads of `feature_ids` with `shard_func` in `n_cores` processes set up by `synthesis_worker_init`, and sort the bed files by coordinate.
+
+    Workers open a persistent handle of `INPUT_bamfile`, which is None when `shard_func` does not read the BAM file (e.g. samples from a `TemplateStore` in `worker_data`). Features are split into contiguous shards (feature_ids, bed_files, file_mode, settings). With one process all shards append to one set of temporary bed files, which are then sorted into `bed_files` with `sort_bed`. With several processes each shard writes its own bed files, which are sorted in parallel, with `sort_memory` shared among the processes, and merged into `bed_files` in shard order, so the output does not depend on `n_cores`. Bed files are sorted in lockstep by the coordinates of the first one, e.g. read pairs by read 1. Bed files ending with '.gz' are BGZF compressed by `compress_threads` background threads each, the first one being indexed with tabix.
+
+    Return
+    ------
+    results: `list`
+        Return value of `shard_func` for every shard, in shard order.
+    """
+    feature_ids = np.asarray(feature_ids, dtype=np.int64)
+    n_shards = max(1, min(len(feature_ids), n_cores * 16))
+    if n_cores <= 1:
+        unsorted_bed_files = ["%s.unsorted" % bed_file for bed_file in bed_files]
+        for bed_file in unsorted_bed_files:
+            open(bed_file, 'w').close()
+        shards = [(shard_ids, unsorted_bed_files, 'a', settings) for shard_ids in np.array_split(feature_ids, n_shards)]
+    else:
+        shards = [(shard_ids, ["%s.shard%d" % (bed_file, shard_no) for bed_file in bed_files], 'w', settings) for shard_no, shard_ids in enumerate(np.array_split(feature_ids, n_shards))]
+    results = run_count_workers(shard_func, shards, (INPUT_bamfile, worker_data), n_cores=n_cores, initializer=synthesis_worker_init)
+    if n_cores <= 1:
+        sort_bed(unsorted_bed_files, bed_files, sort_memory, threads=compress_threads)
+        for bed_file in unsorted_bed_files:
+            os.remove(bed_file)
+    else:
+        shard_memory = max(parse_memory_size(sort_memory) // n_cores, 1 << 20)
+        with multiprocessing.get_context().Pool(processes=n_cores) as pool:
+            pool.starmap(sort_bed, [(shard[1], shard[1], shard_memory) for shard in shards])
+        merge_sorted_beds([shard[1] for shard in shards], bed_files, remove_inputs=True, threads=compress_threads)
+    return results
+
+
+def feature_shards(open_peak, n_shards):
+    """Split the features into about `n_shards` shards of features that are contiguous on one chromosome, each sorted by start position.
+
+    Return
+    ------
+    shards: `list`
+        (chromosome, feature indices) of every shard.
+    """
+    chrom_names, chrom_idx = np.unique(open_peak[:,0], return_inverse=True)
+    order = np.lexsort((open_peak[:,1].astype(np.int64), chrom_idx))
+    bounds = np.searchsorted(chrom_idx[order], np.arange(len(chrom_names) + 1))
+    shard_size = max(1, -(-len(open_peak) // max(n_shards, 1)))
+    shards = []
+    for k, chromosome in enumerate(chrom_names):
+        for lo in range(bounds[k], bounds[k + 1], shard_size):
+            shards.append((chromosome, order[lo:min(lo + shard_size, bounds[k + 1])]))
+    return shards
+
+
+def countmat_mainloop(rec_id):
+    """Construct the sparse count vector, as (cell index, count) arrays, for each scATAC-seq feature.
+
+    """
+    rec = count_worker_state["open_peak"][rec_id]
+    barcode_resolver = count_worker_state["barcode_resolver"]
+    reads = count_worker_state["samfile"].fetch(rec[0], int(rec[1]), int(rec[2]))  # question: what about feature intersection or half overlap?
+    cell_idx_ls = []
+    for read in reads:
+        cell_idx = barcode_resolver.cell_index(read)
+        if cell_idx >= 0:
+            cell_idx_ls.append(cell_idx)
+    counter = Counter(cell_idx_ls)
+    keys = np.fromiter(counter.keys(), dtype=np.int64, count=len(counter))
+    values = np.fromiter(counter.values(), dtype=np.int64, count=len(counter))
+    return keys, values
+
+
+def countmat_shard(shard):
+    """Construct the sparse count vectors of one feature shard with the worker's persistent BAM handle.
+
+    """
+    chromosome, feature_ids = shard
+    return feature_ids, [countmat_mainloop(rec_id) for rec_id in feature_ids]
+
+
+def gather_shard_rows(shard_results, n_feature):
+    """Put the per-feature rows returned by the shards back in feature order.
+
+    """
+    rows = [None] * n_feature
+    for feature_ids, shard_rows in shard_results:
+        for rec_id, row in zip(feature_ids, shard_rows):
+            rows[rec_id] = row
+    return rows
+
+
+def feature_layers(feature_start, feature_end):
+    """Split features into layers of non-overlapping features.
+
+    Features are visited by start position and each one is put into the first layer whose last feature ends before it starts, so that reads can be assigned within every layer with `searchsorted`. Merged bed files give a single layer.
+
+    Return
+    ------
+    layers: `list`
+        List of index arrays, each sorted by feature start.
+    """
+    order = np.argsort(feature_start, kind="stable")
+    layers = []
+    layer_ends = []
+    for idx in order:
+        for layer_id, layer_end in enumerate(layer_ends):
+            if layer_end <= feature_start[idx]:
+                layers[layer_id].append(idx)
+                layer_ends[layer_id] = feature_end[idx]
+                break
+        else:
+            layers.append([idx])
+            layer_ends.append(feature_end[idx])
+    return [np.asarray(layer, dtype=np.int64) for layer in layers]
+
+
+def assign_reads_to_features(read_start, read_end, feature_start, feature_end):
+    """Assign reads to the non-overlapping features they overlap.
+
+    Features must be sorted by start and must not overlap each other. A read covering [`read_start`, `read_end`) is assigned to every feature it overlaps, which matches the reads returned by `pysam.AlignmentFile.fetch` on each feature.
+
+    Return
+    ------
+    read_idx: `numpy.ndarray`
+        Index of the read for each (read, feature) pair.
+    feature_idx: `numpy.ndarray`
+        Index of the feature for each (read, feature) pair.
+    """
+    first = np.searchsorted(feature_end, read_start, side="right")
+    last = np.searchsorted(feature_start, read_end, side="left")
+    n_hit = np.maximum(last - first, 0)
+    read_idx = np.repeat(np.arange(len(read_start)), n_hit)
+    # Offset of each pair within its read, added to the read's first feature
+    offset = np.arange(len(read_idx)) - np.repeat(np.cumsum(n_hit) - n_hit, n_hit)
+    feature_idx = np.repeat(first, n_hit) + offset
+    return read_idx, feature_idx
+
+
+def bam_sweep_chromosome(samfile, chromosome, barcode_resolver, count_unit="read", start=None, end=None):
+    """Stream the reads of one chromosome (or of one region of it) once and reduce each read to the interval it is counted on.
+
+    Parameters
+    ----------
+    samfile: `pysam.AlignmentFile`
+        Open handle of the coordinate-sorted and indexed input BAM file.
+    chromosome: `str`
+        Chromosome to stream.
+    barcode_resolver: `BarcodeResolver`
+        Resolver mapping the cell barcode of each read to its column index in the count matrix. If None, every read is kept and assigned to column 0.
+    count_unit: `str` (default: 'read')
+        'read' counts a read on every feature its alignment overlaps. 'fragment' reduces each fragment to its midpoint: a read pair on one chromosome is counted once, by the mate with the positive template length, and any other read by the midpoint of its alignment. 'insertion' reduces each read to its Tn5 insertion site (5' end shifted by +4 on the forward strand and -5 on the reverse strand).
+    start, end: `int` (default: None)
+        Only stream the reads overlapping this region of the chromosome.
+
+    Return
+    ------
+    read_start, read_end, cell_idx: `numpy.ndarray`
+        Counting interval and count matrix column of every read from a listed cell.
+    """
+    read_start = array.array("q")
+    read_end = array.array("q")
+    cell_idx = array.array("q")
+    for read in samfile.fetch(chromosome, start, end):
+        cell = 0 if barcode_resolver is None else barcode_resolver.cell_index(read)
+        if cell < 0:
+            continue
+        start = read.reference_start
+        end = read.reference_end
+        if end is None or end <= start:
+            end = start + 1
+        if count_unit == "insertion":
+            start = end - 5 if read.is_reverse else start + 4
+            end = start + 1
+        elif count_unit == "fragment":
+            if read.is_paired and not read.mate_is_unmapped and read.template_length != 0 and read.next_reference_id == read.reference_id:
+                # Count each fragment once, on the mate with the positive template length
+                if read.template_length < 0:
+                    continue
+                start = start + read.template_length // 2
+            else:
+                start = (start + end) // 2
+            end = start + 1
+        read_start.append(start)
+        read_end.append(end)
+        cell_idx.append(cell)
+    return np.frombuffer(read_start, dtype=np.int64), np.frombuffer(read_end, dtype=np.int64), np.frombuffer(cell_idx, dtype=np.int64)
+
+
+def sweep_countmat_chromosome(samfile, chromosome, feature_idx, feature_start, feature_end, barcode_resolver, count_unit="read", region=None):
+    """Count reads per cell for all features of one chromosome (or of one region of it) in a single pass over the BAM file.
+
+    Return
+    ------
+    coo_feature, coo_cell, coo_count: `numpy.ndarray`
+        Nonzero entries of the chromosome's count matrix, with features indexed as in `feature_idx`.
+    """
+    region = (None, None) if region is None else region
+    read_start, read_end, cell_idx = bam_sweep_chromosome(samfile, chromosome, barcode_resolver, count_unit, region[0], region[1])
+    cells_n = 1 if barcode_resolver is None else barcode_resolver.cells_n
+    keys = [np.zeros(0, dtype=np.int64)]
+    for layer in feature_layers(feature_start, feature_end):
+        pair_read, pair_feature = assign_reads_to_features(read_start, read_end, feature_start[layer], feature_end[layer])
+        keys.append(feature_idx[layer][pair_feature] * cells_n + cell_idx[pair_read])
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return keys // cells_n, keys % cells_n, counts
+
+
+def sweep_countmat_shard(shard):
+    """Sweep one shard of features with the worker's persistent BAM handle.
+
+    A shard is a whole chromosome, or for 'read' and 'insertion' counting a run of features streamed from the region they span, since every read counted on them overlaps that region.
+    """
+    chromosome, feature_idx, count_unit, whole_chromosome = shard
+    open_peak = count_worker_state["open_peak"]
+    feature_start = open_peak[feature_idx,1].astype(np.int64)
+    feature_end = open_peak[feature_idx,2].astype(np.int64)
+    region = None if whole_chromosome else (int(feature_start.min()), int(feature_end.max()))
+    return sweep_countmat_chromosome(count_worker_state["samfile"], chromosome, feature_idx, feature_start, feature_end, count_worker_state["barcode_resolver"], count_unit, region)
+
+
+def scATAC_bam2countmat_sweep(barcode_resolver, open_peak, INPUT_bamfile, count_unit="read", n_cores=1, bam_threads=1):
+    """Construct the count matrix of a feature set by streaming each chromosome of the BAM file once.
+
+    Return
+    ------
+    coo_feature, coo_cell, coo_count: `numpy.ndarray`
+        Nonzero entries of the feature by cell count matrix sorted by feature, with features indexed in the order of `open_peak`.
+    """
+    if count_unit == "fragment":
+        # A fragment midpoint may lie outside the read's own alignment, so fragments are swept chromosome by chromosome
+        shards = [(chromosome, feature_idx, count_unit, True) for chromosome, feature_idx in feature_shards(open_peak, 1)]
+    else:
+        shards = [(chromosome, feature_idx, count_unit, False) for chromosome, feature_idx in feature_shards(open_peak, n_cores * 4)]
+    coo_list = run_count_workers(sweep_countmat_shard, shards, (INPUT_bamfile, open_peak, barcode_resolver, None, bam_threads), n_cores)
+    coo_feature, coo_cell, coo_count = [np.concatenate(x) for x in zip(*coo_list)]
+    order = np.argsort(coo_feature, kind="stable")
+    return coo_feature[order], coo_cell[order], coo_count[order]
+
+
+TEMPLATE_STORE_VERSION = 1
+TEMPLATE_COLUMNS = (("start", np.int32), ("end", np.int32), ("mate_start", np.int32), ("length", np.int32), ("read_order", np.int8), ("strand", np.int8))
+
+
+class TemplateStore:
+    """Read templates of a BAM file in columnar, memory-mapped '.npy' files, built with one pass over the BAM file by `build_template_store`.
+
+    Reads are kept in BAM order, chromosome by chromosome, as int32 columns 'start', 'end', 'mate_start' and 'length' (aligned length) and int8 columns 'read_order' (1 or 2) and 'strand' (1 or -1). Rows of the k-th chromosome are chrom_offset[k] to chrom_offset[k+1]. Only the store prefix is pickled, so worker processes map the same files instead of receiving copies.
+
+    Parameters
+    ----------
+    store_prefix: `str`
+        Path prefix of the store files.
+    """
+    def __init__(self, store_prefix):
+        self.store_prefix = store_prefix
+        with np.load("%s.index.npz" % store_prefix) as index_npz:
+            self.chrom_names = [str(chrom) for chrom in index_npz["chrom_names"]]
+            self.chrom_offset = index_npz["chrom_offset"]
+            self.max_span = index_npz["max_span"]
+        self.chrom_id = {chrom: k for k, chrom in enumerate(self.chrom_names)}
+        self.columns = {name: np.load("%s.%s.npy" % (store_prefix, name), mmap_mode='r') for name, dtype in TEMPLATE_COLUMNS}
+
+    def __getstate__(self):
+        return {"store_prefix": self.store_prefix}
+
+    def __setstate__(self, state):
+        self.__init__(state["store_prefix"])
+
+    def region_rows(self, chrom, start, end):
+        """Return the rows of the reads overlapping [`start`, `end`) of `chrom`, in BAM order. These are the reads `pysam.AlignmentFile.fetch` returns for the region.
+
+        """
+        if chrom not in self.chrom_id:
+            return np.zeros(0, dtype=np.int64)
+        k = self.chrom_id[chrom]
+        lo, hi = int(self.chrom_offset[k]), int(self.chrom_offset[k + 1])
+        read_start = self.columns["start"][lo:hi]
+        # Reads starting more than the chromosome's longest read span before the region cannot overlap it
+        first = lo + int(np.searchsorted(read_start, start - self.max_span[k], side="right"))
+        last = lo + int(np.searchsorted(read_start, end, side="left"))
+        return first + np.nonzero(self.columns["end"][first:last] > start)[0]
+
+    def templates(self, rows):
+        """Gather the templates of `rows` as an int64 array with one row [start, mate start, aligned length, read order, strand] per read.
+
+        """
+        template_rows = np.empty((len(rows), 5), dtype=np.int64)
+        for k, name in enumerate(("start", "mate_start", "length", "read_order", "strand")):
+            template_rows[:,k] = self.columns[name][rows]
+        return template_rows
+
+    def region_templates(self, chrom, start, end):
+        """Return the templates of the reads overlapping [`start`, `end`) of `chrom` (see `region_rows` and `templates`).
+
+        """
+        return self.templates(self.region_rows(chrom, start, end))
+
+
+class TemplateCache:
+    """Templates of the most recently used regions of a `TemplateStore`, so that regions sampled repeatedly, e.g. input peaks assigned to many output peaks by `FeatureMapping`, are only gathered from the store once.
+
+    Parameters
+    ----------
+    template_store: `TemplateStore`
+        Read template store.
+    max_templates: `int` (default: 2097152)
+        Total number of templates kept in memory, 40 bytes each. The least recently used regions are dropped beyond it.
+    """
+    def __init__(self, template_store, max_templates=2097152):
+        self.template_store = template_store
+        self.max_templates = max_templates
+        self.cache = OrderedDict()
+        self.n_templates = 0
+
+    def region_templates(self, chrom, start, end):
+        """Return the templates of the reads overlapping [`start`, `end`) of `chrom`, gathering them from the store unless the region is cached.
+
+        """
+        region = (chrom, start, end)
+        if region in self.cache:
+            self.cache.move_to_end(region)
+            return self.cache[region]
+        templates = self.template_store.region_templates(chrom, start, end)
+        self.cache[region] = templates
+        self.n_templates += len(templates)
+        while self.n_templates > self.max_templates and len(self.cache) > 1:
+            self.n_templates -= len(self.cache.popitem(last=False)[1])
+        return templates
+
+
+def template_store_shard(shard):
+    """Extract the read templates of one chromosome with the worker's persistent BAM handle and save them as temporary column files.
+
+    Return
+    ------
+    n_read: `int`
+        Number of reads of the chromosome.
+    max_span: `int`
+        Longest reference span of the chromosome's reads.
+    """
+    chromosome, part_prefix = shard
+    # Accumulate each column in its stored width, so the columns are saved without a wider copy
+    columns = {name: array.array(np.dtype(dtype).char) for name, dtype in TEMPLATE_COLUMNS}
+    for read in count_worker_state["samfile"].fetch(chromosome):
+        start = read.reference_start
+        end = read.reference_end
+        if end is None or end <= start:
+            end = start + 1
+        columns["start"].append(start)
+        columns["end"].append(end)
+        columns["mate_start"].append(read.next_reference_start)
+        columns["length"].append(read.query_alignment_length)
+        columns["read_order"].append(1 if read.is_read1 else 2)
+        columns["strand"].append(-1 if read.is_reverse else 1)
+    for name, dtype in TEMPLATE_COLUMNS:
+        np.save("%s.%s.npy" % (part_prefix, name), np.frombuffer(columns[name], dtype=dtype))
+    span = np.frombuffer(columns["end"], dtype=np.int32) - np.frombuffer(columns["start"], dtype=np.int32)
+    return len(columns["start"]), int(span.max()) if len(span) > 0 else 0
+
+
+def template_store_prefix(store_directory, INPUT_bamfile):
+    """Return the path prefix of the template store of `INPUT_bamfile` in `store_directory`.
+
+    """
+    return "%s/scReadSim.TemplateStore.%s" % (store_directory, bam_identity(INPUT_bamfile)[:16])
+
+
+def build_template_store(INPUT_bamfile, store_prefix, n_cores=1, bam_threads=1):
+    """Build the template store of a BAM file with one pass over each chromosome.
+
+    Chromosomes are extracted in parallel into temporary column files, which are then copied into one memory-mapped file per column. The index file is written last under a temporary name and renamed, so a store is only used once complete.
+
+    Parameters
+    ----------
+    INPUT_bamfile: `str`
+        Coordinate-sorted and indexed BAM file.
+    store_prefix: `str`
+        Path prefix of the store files, e.g. from `template_store_prefix`.
+    n_cores: `int` (default: 1)
+        Number of chromosomes extracted in parallel.
+    bam_threads: `int` (default: 1)
+        Number of BGZF decompression threads of each worker's BAM handle.
+    """
+    samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+    chrom_names = list(samfile.references)
+    samfile.close()
+    part_prefixes = ["%s.part%d" % (store_prefix, k) for k in range(len(chrom_names))]
+    results = run_count_workers(template_store_shard, list(zip(chrom_names, part_prefixes)), (INPUT_bamfile, None, None, None, bam_threads), n_cores)
+    n_read = np.asarray([0] + [result[0] for result in results], dtype=np.int64)
+    chrom_offset = np.cumsum(n_read)
+    for name, dtype in TEMPLATE_COLUMNS:
+        column = np.lib.format.open_memmap("%s.%s.tmp.npy" % (store_prefix, name), mode='w+', dtype=dtype, shape=(int(chrom_offset[-1]),))
+        for k, part_prefix in enumerate(part_prefixes):
+            column[chrom_offset[k]:chrom_offset[k + 1]] = np.load("%s.%s.npy" % (part_prefix, name))
+            os.remove("%s.%s.npy" % (part_prefix, name))
+        column.flush()
+        del column
+        os.replace("%s.%s.tmp.npy" % (store_prefix, name), "%s.%s.npy" % (store_prefix, name))
+    tmp_file = "%s.index.%d.tmp" % (store_prefix, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, version=np.int64(TEMPLATE_STORE_VERSION), chrom_names=np.array(chrom_names, dtype=str), chrom_offset=chrom_offset, max_span=np.asarray([result[1] for result in results], dtype=np.int64))
+    os.replace(tmp_file, "%s.index.npz" % store_prefix)
+
+
+def load_template_store(INPUT_bamfile, store_directory, n_cores=1):
+    """Load the template store of a BAM file from `store_directory`, building it with one pass over the BAM file if it does not exist yet.
+
+    The store is keyed by the path, size and modification time of the BAM file, so later runs on the same BAM file, e.g. with other `jitter_size` or `read_len`, reuse it.
+
+    Return
+    ------
+    template_store: `TemplateStore`
+        Read templates of the BAM file.
+    """
+    store_prefix = template_store_prefix(store_directory, INPUT_bamfile)
+    if os.path.exists("%s.index.npz" % store_prefix):
+        with np.load("%s.index.npz" % store_prefix) as index_npz:
+            if int(index_npz["version"]) == TEMPLATE_STORE_VERSION:
+                print("[scReadSim] Loaded Read Template Store: %s" % store_prefix)
+                return TemplateStore(store_prefix)
+    print("[scReadSim] Building Read Template Store for %s..." % INPUT_bamfile)
+    build_template_store(INPUT_bamfile, store_prefix, n_cores)
+    print("[scReadSim] Read Template Store Saved: %s" % store_prefix)
+    return TemplateStore(store_prefix)
+
+
+class CountMatrix:
+    """Feature by cell count matrix held in compressed sparse row (CSR) form.
+
+    Parameters
+    ----------
+    feature_names: `list`
+        Row names of the count matrix.
+    barcodes: `list`
+        Column names of the count matrix, i.e. cell barcodes or synthetic cell labels. Can be None.
+    indptr: `numpy.ndarray`
+        Row pointer of length `n_feature` + 1.
+    indices: `numpy.ndarray`
+        Column index of each nonzero entry.
+    data: `numpy.ndarray`
+        Count of each nonzero entry.
+    n_cell: `int`
+        Number of columns of the count matrix.
+    """
+    def __init__(self, feature_names, barcodes, indptr, indices, data, n_cell):
+        self.feature_names = list(feature_names)
+        self.barcodes = None if barcodes is None else list(barcodes)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.int64)
+        self.n_feature = len(self.feature_names)
+        self.n_cell = int(n_cell)
+
+    @classmethod
+    def from_coo(cls, feature_names, barcodes, coo_feature, coo_cell, coo_count, n_cell):
+        """Build the count matrix from its nonzero (feature, cell, count) entries.
+
+        """
+        coo_feature = np.asarray(coo_feature, dtype=np.int64)
+        coo_cell = np.asarray(coo_cell, dtype=np.int64)
+        coo_count = np.asarray(coo_count, dtype=np.int64)
+        keep = coo_count != 0
+        order = np.lexsort((coo_cell[keep], coo_feature[keep]))
+        coo_feature = coo_feature[keep][order]
+        indptr = np.searchsorted(coo_feature, np.arange(len(feature_names) + 1))
+        return cls(feature_names, barcodes, indptr, coo_cell[keep][order], coo_count[keep][order], n_cell)
+
+    @classmethod
+    def from_rows(cls, feature_names, barcodes, rows, n_cell):
+        """Build the count matrix from a list holding the (cell index, count) arrays of each feature.
+
+        """
+        row_len = np.asarray([len(row[0]) for row in rows], dtype=np.int64)
+        indptr = np.concatenate(([0], np.cumsum(row_len)))
+        if len(rows) == 0 or indptr[-1] == 0:
+            return cls(feature_names, barcodes, indptr, [], [], n_cell)
+        indices = np.concatenate([np.asarray(row[0], dtype=np.int64) for row in rows])
+        data = np.concatenate([np.asarray(row[1], dtype=np.int64) for row in rows])
+        return cls.from_coo(feature_names, barcodes, np.repeat(np.arange(len(rows)), row_len), indices, data, n_cell)
+
+    @property
+    def shape(self):
+        return (self.n_feature, self.n_cell)
+
+    def row(self, feature_id):
+        """Return the dense count vector of feature `feature_id` over all cells.
+
+        """
+        count_vec = np.zeros(self.n_cell, dtype=np.int64)
+        lo, hi = self.indptr[feature_id], self.indptr[feature_id + 1]
+        count_vec[self.indices[lo:hi]] = self.data[lo:hi]
+        return count_vec
+
+    def row_sums(self):
+        """Return the total count of each feature.
+
+        """
+        return np.add.reduceat(np.append(self.data, 0), self.indptr[:-1]) * (np.diff(self.indptr) > 0)
+
+    def to_coo(self):
+        """Return the nonzero entries as (feature, cell, count) arrays sorted by feature.
+
+        """
+        return np.repeat(np.arange(self.n_feature), np.diff(self.indptr)), self.indices, self.data
+
+
+def countmat_prefix(count_mat_file):
+    """Strip the Matrix Market extension of `count_mat_file` to get the prefix shared by its sidecar files.
+
+    """
+    for ext in (".mtx.gz", ".mtx"):
+        if count_mat_file.endswith(ext):
+            return count_mat_file[:-len(ext)]
+    return None
+
+
+def write_countmat_mtx(count_mat_prefix, countmat, chunk_size=1000000, threads=1):
+    """Write a count matrix as a gzipped Matrix Market coordinate file `<prefix>.mtx.gz`, compressed by `threads` background threads, with row names in `<prefix>.features.txt` and column names in `<prefix>.barcodes.txt`.
+
+    """
+    coo_feature, coo_cell, coo_count = countmat.to_coo()
+    with OutputFile("%s.mtx.gz" % count_mat_prefix, "gzip", threads, level=4) as outsfile:
+        outsfile.write("%%%%MatrixMarket matrix coordinate integer general\n%d %d %d\n" % (countmat.n_feature, countmat.n_cell, len(coo_count)))
+        for lo in range(0, len(coo_count), chunk_size):
+            chunk = pd.DataFrame({"row": coo_feature[lo:lo + chunk_size] + 1, "col": coo_cell[lo:lo + chunk_size] + 1, "count": coo_count[lo:lo + chunk_size]})
+            outsfile.write(chunk.to_csv(sep=" ", header=False, index=False))
+    with open("%s.features.txt" % count_mat_prefix, 'w') as outsfile:
+        outsfile.writelines(name + "\n" for name in countmat.feature_names)
+    if countmat.barcodes is not None:
+        with open("%s.barcodes.txt" % count_mat_prefix, 'w') as outsfile:
+            outsfile.writelines(str(cell) + "\n" for cell in countmat.barcodes)
+
+
+def write_countmat_txt(count_mat_file, countmat, codec=None, threads=1):
+    """Export a count matrix as tab-delimited dense text, one feature per line led by its name. The file is compressed with `codec` (see `OutputFile`), by default if its name ends with '.gz'.
+
+    """
+    zero_row = "\t".join(["0"] * countmat.n_cell)
+    with OutputFile(count_mat_file, codec, threads) as outsfile:
+        for feature_id in tqdm(range(countmat.n_feature)):
+            rec_name = countmat.feature_names[feature_id]
+            if countmat.indptr[feature_id] == countmat.indptr[feature_id + 1]:
+                outsfile.write(rec_name + "\t" + zero_row + "\n")
+            else:
+                outsfile.write(rec_name + "\t" + "\t".join(countmat.row(feature_id).astype(str)) + "\n")
+
+
+def write_countmat(countmat, count_mat_prefix, count_mat_format="mtx"):
+    """Write a count matrix in sparse Matrix Market ('mtx') or dense text ('txt') format.
+
+    Return
+    ------
+    count_mat_file: `str`
+        Path to the written count matrix.
+    """
+    if count_mat_format == "mtx":
+        write_countmat_mtx(count_mat_prefix, countmat)
+        return "%s.mtx.gz" % count_mat_prefix
+    elif count_mat_format == "txt":
+        write_countmat_txt("%s.txt" % count_mat_prefix, countmat)
+        return "%s.txt" % count_mat_prefix
+    else:
+        sys.exit("[ERROR] Unknown count_mat_format '%s': choose from 'mtx' and 'txt'." % count_mat_format)
+
+
+def read_countmat(count_mat_file):
+    """Read a count matrix written by scReadSim. Files ending in '.mtx' or '.mtx.gz' are read as Matrix Market coordinate files together with their '.features.txt' and '.barcodes.txt' sidecars; other files are read as dense tab-delimited text with feature names in the first column.
+
+    Return
+    ------
+    countmat: `CountMatrix`
+        The count matrix in CSR form.
+    """
+    prefix = countmat_prefix(count_mat_file)
+    if prefix is None:
+        count_mat_df = pd.read_csv(count_mat_file, header=None, delimiter="\t")
+        feature_names = count_mat_df.iloc[:,0].astype(str).tolist()
+        dense = count_mat_df.iloc[:,1:].to_numpy().round().astype(np.int64)
+        coo_feature, coo_cell = np.nonzero(dense)
+        return CountMatrix.from_coo(feature_names, None, coo_feature, coo_cell, dense[coo_feature, coo_cell], dense.shape[1])
+    opener = gzip.open if count_mat_file.endswith(".gz") else open
+    with opener(count_mat_file, 'rt') as mtx:
+        line = mtx.readline()
+        if not line.startswith("%%MatrixMarket matrix coordinate"):
+            sys.exit("[ERROR] %s is not a Matrix Market coordinate file." % count_mat_file)
+        while line.startswith("%"):
+            line = mtx.readline()
+        n_feature, n_cell, nnz = [int(x) for x in line.split()]
+        if nnz > 0:
+            entries = pd.read_csv(mtx, sep=r"\s+", header=None, nrows=nnz, dtype=np.float64).to_numpy()
+        else:
+            entries = np.zeros((0, 3))
+    with open("%s.features.txt" % prefix) as feature_file:
+        feature_names = feature_file.read().splitlines()
+    if len(feature_names) != n_feature:
+        sys.exit("[ERROR] %s.features.txt lists %d features while the count matrix has %d rows." % (prefix, len(feature_names), n_feature))
+    barcodes = None
+    if os.path.exists("%s.barcodes.txt" % prefix):
+        with open("%s.barcodes.txt" % prefix) as barcode_file:
+            barcodes = barcode_file.read().splitlines()
+    coo_count = entries[:,2] if entries.shape[1] > 2 else np.ones(len(entries))
+    return CountMatrix.from_coo(feature_names, barcodes, entries[:,0].astype(np.int64) - 1, entries[:,1].astype(np.int64) - 1, np.round(coo_count).astype(np.int64), n_cell)
+
+
+OUTPUT_CODECS = ("none", "gzip", "bgzf")
+COMPRESS_CHUNK_SIZE = 1 << 22 # Uncompressed bytes compressed by one task
+BGZF_BLOCK_SIZE = 65280 # Uncompressed bytes per BGZF block, as bgzip
+BGZF_HEADER = b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def output_codec(compress, filename=None):
+    """Return the codec of `OUTPUT_CODECS` selected by `compress`: a codec name, True for 'bgzf', or False or None for no compression, unless `filename` ends with '.gz', which selects 'bgzf'.
+
+    """
+    if compress is None or compress is False:
+        return "bgzf" if filename is not None and filename.endswith(".gz") else "none"
+    if compress is True:
+        return "bgzf"
+    if compress not in OUTPUT_CODECS:
+        sys.exit("[ERROR] Unknown compression codec '%s': choose from 'none', 'gzip' and 'bgzf'." % compress)
+    return compress
+
+
+def output_suffix(compress):
+    """Return the file name suffix of compression setting `compress` (see `output_codec`): '.gz' if compressed, '' otherwise.
+
+    """
+    return "" if output_codec(compress) == "none" else ".gz"
+
+
+def resolve_output_file(filename):
+    """Return `filename`, or its compressed version `filename`.gz if only that exists.
+
+    """
+    if not os.path.exists(filename) and os.path.exists(filename + ".gz"):
+        return filename + ".gz"
+    return filename
+
+
+def compress_gzip(data, level=6):
+    """Compress bytes as one gzip member. Concatenated members form a valid gzip file.
+
+    """
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def compress_bgzf(data, level=6):
+    """Compress bytes as BGZF blocks, the blocked gzip format of bgzip that samtools and tabix read.
+
+    """
+    blocks = []
+    for lo in range(0, len(data), BGZF_BLOCK_SIZE):
+        block = data[lo:lo + BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(block) + compressor.flush()
+        blocks.append(BGZF_HEADER + struct.pack("<H", len(deflated) + 25) + deflated + struct.pack("<II", zlib.crc32(block), len(block)))
+    return b''.join(blocks)
+
+
+class OutputFile:
+    """Binary output file with a selectable codec: none, gzip or BGZF.
+
+    Written data are buffered and compressed in chunks of `COMPRESS_CHUNK_SIZE` bytes by `threads` background threads (zlib releases the GIL), while the caller keeps producing data. Compressed chunks are written in order, so the output does not depend on `threads`. Text is encoded as UTF-8.
+
+    Parameters
+    ----------
+    filename: `str`
+        Output file.
+    codec: `str` (default: None)
+        Compression setting (see `output_codec`). If None, files ending with '.gz' are BGZF compressed.
+    threads: `int` (default: 1)
+        Number of background compression threads. With 0, chunks are compressed in the calling thread.
+    mode: `str` (default: 'wb')
+        File mode, 'w' to truncate the file or 'a' to append to it.
+    level: `int` (default: 6)
+        Compression level.
+    """
+    def __init__(self, filename, codec=None, threads=1, mode='wb', level=6):
+        self.filename = filename
+        self.codec = output_codec(codec, filename)
+        self.level = level
+        self.handle = open(filename, mode[0] + 'b', buffering=1 << 24)
+        self.compress = {"none": None, "gzip": compress_gzip, "bgzf": compress_bgzf}[self.codec]
+        self.executor = ThreadPoolExecutor(max_workers=threads) if self.compress is not None and threads > 0 else None
+        self.max_pending = 2 * max(threads, 1)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered_size = 0
+
+    def write(self, data):
+        """Write bytes or text.
+
+        """
+        if isinstance(data, str):
+            data = data.encode()
+        if self.compress is None:
+            self.handle.write(data)
+            return
+        self.buffer.append(data)
+        self.buffered_size += len(data)
+        if self.buffered_size >= COMPRESS_CHUNK_SIZE:
+            self.submit()
+
+    def writelines(self, lines):
+        """Write an iterable of bytes or text.
+
+        """
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, 65536))
+            if len(batch) == 0:
+                break
+            self.write(batch[0][:0].join(batch))
+
+    def submit(self):
+        """Compress the buffered data, in a background thread if any, and write out the compressed chunks that are done in order.
+
+        """
+        if self.buffered_size == 0:
+            return
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered_size = 0
+        if self.executor is None:
+            self.handle.write(self.compress(data, self.level))
+            return
+        self.pending.append(self.executor.submit(self.compress, data, self.level))
+        while len(self.pending) > self.max_pending or (len(self.pending) > 0 and self.pending[0].done()):
+            self.handle.write(self.pending.popleft().result())
+
+    def close(self):
+        """Compress and write out the remaining data and close the file.
+
+        """
+        if self.compress is not None:
+            self.submit()
+            while len(self.pending) > 0:
+                self.handle.write(self.pending.popleft().result())
+            if self.executor is not None:
+                self.executor.shutdown()
+            if self.codec == "bgzf":
+                self.handle.write(BGZF_EOF)
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_input(filename):
+    """Open an input file for reading bytes, gzip (or BGZF) compressed if its name ends with '.gz'.
+
+    """
+    if filename.endswith(".gz"):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb', buffering=1 << 20)
+
+
+class BufferedFileWriter:
+    """Write text to a group of files through persistent handles and in-memory buffers.
+
+    Texts for all files are passed together to `write`, so paired outputs such as read 1 and read 2 BED files stay in lockstep. All buffers are written out once `flush_size` characters have accumulated.
+
+    Parameters
+    ----------
+    filenames: `list`
+        Output files, truncated on opening.
+    flush_size: `int` (default: 16777216)
+        Number of buffered characters over all files that triggers a write.
+    mode: `str` (default: 'w')
+        File mode, 'w' to truncate the files or 'a' to append to them.
+    codec: `str` (default: None)
+        Compression of the files (see `OutputFile`). If None, files ending with '.gz' are BGZF compressed.
+    threads: `int` (default: 1)
+        Number of background compression threads of each file.
+    """
+    def __init__(self, filenames, flush_size=16777216, mode='w', codec=None, threads=1):
+        self.filenames = list(filenames)
+        self.flush_size = flush_size
+        self.handles = [OutputFile(filename, codec, threads, mode) for filename in self.filenames]
+        self.buffers = [[] for filename in self.filenames]
+        self.buffered_size = 0
+
+    def write(self, *texts):
+        """Append one text per file.
+
+        """
+        for buffer, text in zip(self.buffers, texts):
+            buffer.append(text)
+            self.buffered_size += len(text)
+        if self.buffered_size >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Write out all buffered texts.
+
+        """
+        for handle, buffer in zip(self.handles, self.buffers):
+            handle.write(''.join(buffer))
+            buffer.clear()
+        self.buffered_size = 0
+
+    def close(self):
+        """Flush the buffers and close the files.
+
+        """
+        self.flush()
+        for handle in self.handles:
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ReferenceGenome:
+    """Reference genome FASTA file read through its index ('.fai', built by pysam if missing), with the sequences of the most recently used chromosomes cached in memory.
+
+    Parameters
+    ----------
+    referenceGenome_file: `str`
+        Reference genome FASTA file.
+    max_cached: `int` (default: 2)
+        Number of chromosome sequences kept in memory.
+    """
+    def __init__(self, referenceGenome_file, max_cached=2):
+        self.fasta = pysam.FastaFile(referenceGenome_file)
+        self.chrom_size = dict(zip(self.fasta.references, self.fasta.lengths))
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+
+    def chromosome(self, chrom):
+        """Return the whole sequence of `chrom`, reading it from the FASTA file unless it is cached.
+
+        """
+        if chrom in self.cache:
+            self.cache.move_to_end(chrom)
+        else:
+            if len(self.cache) >= self.max_cached:
+                self.cache.popitem(last=False)
+            self.cache[chrom] = self.fasta.fetch(chrom)
+        return self.cache[chrom]
+
+    def close(self):
+        """Close the FASTA file and drop the cached sequences.
+
+        """
+        self.cache.clear()
+        self.fasta.close()
+
+
+def truth_bam_header(reference_genome):
+    """Return the header of a synthetic BAM file aligned to `reference_genome` (a `ReferenceGenome`), with one '@SQ' line per FASTA sequence.
+
+    """
+    return pysam.AlignmentHeader.from_dict({"HD": {"VN": "1.6", "SO": "unsorted"}, "SQ": [{"SN": chrom, "LN": int(size)} for chrom, size in reference_genome.chrom_size.items()], "PG": [{"ID": "scReadSim", "PN": "scReadSim"}]})
+
+
+TRUTH_MAPQ = 60
+TRUTH_BASE_QUALITY = 37 # 'F', the quality of FASTQ files written with `seqtk seq -F 'F'`
+
+
+def truth_aligned_segment(header, query_name, reference_id, reference_start, sequence, flag, tags):
+    """Build a read aligned at its true position: CIGAR '<length>M', mapping quality `TRUTH_MAPQ` and base quality `TRUTH_BASE_QUALITY`. `sequence` is in reference orientation. Mate fields are left to the caller.
+
+    """
+    segment = pysam.AlignedSegment(header)
+    segment.query_name = query_name
+    segment.flag = flag
+    segment.reference_id = reference_id
+    segment.reference_start = reference_start
+    segment.mapping_quality = TRUTH_MAPQ
+    segment.cigartuples = ((0, len(sequence)),)
+    segment.query_sequence = sequence
+    segment.query_qualities = array.array("B", [TRUTH_BASE_QUALITY]) * len(sequence)
+    segment.set_tags(tags)
+    return segment
+
+
+def read_bed_chunks(bed_file, chunk_size=500000):
+    """Stream the records (chromosome, start, end, name, length, strand) of a synthetic read bed file as DataFrames of `chunk_size` rows. If `bed_file` does not exist, its bgzip-compressed version `bed_file`.gz (see `merge_sorted_beds`) is read.
+
+    """
+    if not os.path.exists(bed_file) and os.path.exists(bed_file + ".gz"):
+        bed_file = bed_file + ".gz"
+    try:
+        bed_reader = pd.read_csv(bed_file, sep="\t", header=None, names=["chrom", "start", "end", "name", "length", "strand"], dtype={"chrom": str, "name": str, "strand": str}, quoting=csv.QUOTE_NONE, chunksize=chunk_size)
+        for bed_df in bed_reader:
+            yield bed_df
+    except pd.errors.EmptyDataError:
+        return
+
+
+REVERSE_COMPLEMENT = str.maketrans("ACGTNacgtn", "TGCANtgcan")
+
+
+def bed2fastq(bed_files, fastq_files, referenceGenome_file, barcode_fastq_file=None, barcode_length=26, chunk_size=500000, flush_size=16777216, compress_threads=1):
+    """Convert synthetic read bed files to FASTQ files in one pass, replacing `bedtools getfasta`, `sed` and `seqtk seq`.
+
+    Bed files are read in lockstep, so paired read 1 and read 2 bed files give paired FASTQ files. Reads on the '-' strand are reverse complemented and all bases get quality 'F'. A read pair is skipped if one of its reads lies outside the reference genome, which `bedtools getfasta` skips too.
+
+    Parameters
+    ----------
+    bed_files: `list`
+        Synthetic read bed files with the same number of records.
+    fastq_files: `list`
+        Output FASTQ file of each bed file. Files ending with '.gz' are BGZF compressed (see `OutputFile`).
+    referenceGenome_file: `str`
+        Reference genome FASTA file. The '.fai' index is built if missing.
+    barcode_fastq_file: `str` (default: None)
+        If given, also write a FASTQ file whose reads are the first `barcode_length` characters of the read names (cell barcode and UMI).
+    barcode_length: `int` (default: 26)
+        Length of the reads of `barcode_fastq_file`.
+    chunk_size: `int` (default: 500000)
+        Number of records loaded from each bed file at a time.
+    flush_size: `int` (default: 16777216)
+        Number of characters buffered in memory before the FASTQ files are written.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of each compressed FASTQ file.
+
+    Return
+    ------
+    n_skipped: `int`
+        Number of skipped reads (or read pairs).
+    """
+    reference_genome = ReferenceGenome(referenceGenome_file)
+    output_files = list(fastq_files) + ([] if barcode_fastq_file is None else [barcode_fastq_file])
+    quality = {}
+    n_skipped = 0
+    with BufferedFileWriter(output_files, flush_size=flush_size, threads=compress_threads) as fastq_writer:
+        for bed_dfs in zip(*[read_bed_chunks(bed_file, chunk_size) for bed_file in bed_files]):
+            names = bed_dfs[0]["name"].tolist()
+            records = [list(zip(bed_df["chrom"].tolist(), bed_df["start"].tolist(), bed_df["end"].tolist(), bed_df["strand"].tolist())) for bed_df in bed_dfs]
+            fastq_lines = [[] for output_file in output_files]
+            for read_no, name in enumerate(names):
+                seqs = []
+                for bed_records in records:
+                    chrom, start, end = bed_records[read_no][0:3]
+                    if chrom not in reference_genome.chrom_size or start < 0 or end > reference_genome.chrom_size[chrom] or end <= start:
+                        break
+                    seq = reference_genome.chromosome(chrom)[start:end]
+                    seqs.append(seq.translate(REVERSE_COMPLEMENT)[::-1] if bed_records[read_no][3] == '-' else seq)
+                else:
+                    if barcode_fastq_file is not None:
+                        seqs.append(name[:barcode_length])
+                    for lines, seq in zip(fastq_lines, seqs):
+                        if len(seq) not in quality:
+                            quality[len(seq)] = 'F' * len(seq)
+                        lines.append("@%s\n%s\n+\n%s\n" % (name, seq, quality[len(seq)]))
+                    continue
+                n_skipped += 1
+            fastq_writer.write(*[''.join(lines) for lines in fastq_lines])
+    reference_genome.close()
+    return n_skipped
+
+
+def parse_memory_size(memory):
+    """Convert a memory size given as a number of bytes or as a string such as '768M' or '3G' to bytes.
+
+    """
+    if isinstance(memory, (int, np.integer)):
+        return int(memory)
+    memory = str(memory).strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    if memory[-1] in units:
+        return int(float(memory[:-1]) * units[memory[-1]])
+    return int(memory)
+
+
+def fastq_records(fastq_file):
+    """Iterate over the records of a FASTQ file, gzip compressed if its name ends with '.gz', as bytes of four lines each.
+
+    """
+    with open_input(fastq_file) as infile:
+        for header in infile:
+            yield header + infile.readline() + infile.readline() + infile.readline()
+
+
+def open_fastq_output(fastq_file, threads=1):
+    """Open an output FASTQ file for writing bytes, BGZF compressed by `threads` background threads if its name ends with '.gz' (see `OutputFile`).
+
+    """
+    return OutputFile(fastq_file, None, threads)
+
+
+def merge_sorted_runs(run_files, output_file, threads=1):
+    """Merge FASTQ files sorted by `sort_fastq` into `output_file` and remove them.
+
+    """
+    with open_fastq_output(output_file, threads) as outsfile:
+        outsfile.writelines(heapq.merge(*[fastq_records(run_file) for run_file in run_files]))
+    for run_file in run_files:
+        os.remove(run_file)
+
+
+def sort_fastq(fastq_file, sorted_fastq_file, memory_budget="1G", temp_directory=None, n_cores=1, compress_threads=1):
+    """Sort the records of a FASTQ file by read name with a bounded-memory external merge sort, in the order of `sort -k1,1` under the C locale.
+
+    Records are loaded and sorted in runs of about `memory_budget` bytes, which are written to `temp_directory` and merged. With several runs and `n_cores` > 1, groups of runs are first merged in parallel processes.
+
+    Parameters
+    ----------
+    fastq_file: `str`
+        FASTQ file to sort, gzip compressed if its name ends with '.gz'.
+    sorted_fastq_file: `str`
+        Output FASTQ file, BGZF compressed if its name ends with '.gz'.
+    memory_budget: `str` or `int` (default: '1G')
+        Approximate memory used for sorting, e.g. '768M' or '3G', or a number of bytes.
+    temp_directory: `str` (default: None)
+        Directory of the sorted runs. If None, use the directory of `sorted_fastq_file`.
+    n_cores: `int` (default: 1)
+        Number of processes merging runs.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of a compressed output.
+    """
+    memory_budget = parse_memory_size(memory_budget)
+    temp_directory = os.path.dirname(os.path.abspath(sorted_fastq_file)) if temp_directory is None else temp_directory
+    run_prefix = "%s/%s.%d.sortrun" % (temp_directory, os.path.basename(sorted_fastq_file), os.getpid())
+    run_files = []
+    records = []
+    records_size = 0
+    for record in fastq_records(fastq_file):
+        records.append(record)
+        # Count the Python object overhead of each record besides its bytes
+        records_size += len(record) + 64
+        if records_size >= memory_budget:
+            records.sort()
+            run_files.append("%s%d" % (run_prefix, len(run_files)))
+            with open(run_files[-1], 'wb') as run_file:
+                run_file.writelines(records)
+            records = []
+            records_size = 0
+    records.sort()
+    if len(run_files) == 0:
+        with open_fastq_output(sorted_fastq_file, compress_threads) as outsfile:
+            outsfile.writelines(records)
+        return
+    if len(records) > 0:
+        run_files.append("%s%d" % (run_prefix, len(run_files)))
+        with open(run_files[-1], 'wb') as run_file:
+            run_file.writelines(records)
+    del records
+    if n_cores > 1 and len(run_files) > 2:
+        groups = [list(group) for group in np.array_split(run_files, min(n_cores, len(run_files) // 2))]
+        merged_files = ["%s.merge%d" % (run_prefix, k) for k in range(len(groups))]
+        with multiprocessing.get_context().Pool(processes=len(groups)) as pool:
+            pool.starmap(merge_sorted_runs, zip(groups, merged_files))
+        run_files = merged_files
+    merge_sorted_runs(run_files, sorted_fastq_file, compress_threads)
+
+
+def order_fastq(fastq_file, ordered_fastq_file, sort_reads=False, memory_budget="1G", temp_directory=None, n_cores=1, compress_threads=1):
+    """Move a FASTQ file to `ordered_fastq_file`, sorting its reads by name with `sort_fastq` if `sort_reads` is True. The FASTQ file is recompressed if only one of the two names ends with '.gz'.
+
+    Synthetic read 1 and read 2 FASTQ files are written in the same read order, so sorting is only needed when reads must be ordered by name.
+    """
+    if sort_reads:
+        sort_fastq(fastq_file, ordered_fastq_file, memory_budget, temp_directory, n_cores, compress_threads)
+        os.remove(fastq_file)
+    elif fastq_file.endswith(".gz") != ordered_fastq_file.endswith(".gz"):
+        copy_fastq(fastq_file, ordered_fastq_file, compress_threads)
+        os.remove(fastq_file)
+    else:
+        os.replace(fastq_file, ordered_fastq_file)
+
+
+def copy_fastq(fastq_file, output_fastq_file, compress_threads=1):
+    """Copy a FASTQ file, decompressing or compressing it as given by the names of the files (see `open_input` and `open_fastq_output`).
+
+    """
+    if fastq_file.endswith(".gz") == output_fastq_file.endswith(".gz"):
+        shutil.copyfile(fastq_file, output_fastq_file)
+        return
+    with open_input(fastq_file) as infile, open_fastq_output(output_fastq_file, compress_threads) as outsfile:
+        while True:
+            data = infile.read(COMPRESS_CHUNK_SIZE)
+            if len(data) == 0:
+                break
+            outsfile.write(data)
+
+
+def bed_record_key(record):
+    """Sort key (chromosome, start, end) of a tuple of bed lines (bytes) read in lockstep, taken from its first line. Chromosomes are ordered as bytes, as `sort -k1,1 -k2,2n -k3,3n` does under the C locale.
+
+    """
+    fields = record[0].split(b'\t', 3)
+    return fields[0], int(fields[1]), int(fields[2])
+
+
+def bed_records(bed_files):
+    """Iterate over bed files in lockstep, yielding tuples with one line (bytes) of each file. Files ending with '.gz' are read as gzip (or BGZF) compressed.
+
+    """
+    infiles = [open_input(bed_file) for bed_file in bed_files]
+    try:
+        yield from zip(*infiles)
+    finally:
+        for infile in infiles:
+            infile.close()
+
+
+def write_bed_records(records, bed_files, compress=False, write_size=65536, threads=1):
+    """Write tuples of bed lines to `bed_files`, the k-th line of each tuple to the k-th file, compressed as set by `compress` (see `output_codec`), e.g. BGZF compressed so that they can be indexed by tabix.
+
+    """
+    outsfiles = [OutputFile(bed_file, compress, threads) for bed_file in bed_files]
+    try:
+        while True:
+            batch = list(itertools.islice(records, write_size))
+            if len(batch) == 0:
+                break
+            for k, outsfile in enumerate(outsfiles):
+                outsfile.write(b''.join([record[k] for record in batch]))
+    finally:
+        for outsfile in outsfiles:
+            outsfile.close()
+
+
+def merge_sorted_beds(bed_file_groups, output_files, compress=False, remove_inputs=False, threads=1):
+    """Merge coordinate-sorted bed files with a streaming k-way merge.
+
+    Each group holds bed files read in lockstep (e.g. read 1 and read 2 bed files), ordered by the coordinates of its first file (see `bed_record_key`). The k-th files of all groups are merged into `output_files`[k] with one shared order, so read pairs stay in the same lines. Records with equal keys keep the order of the groups.
+
+    Parameters
+    ----------
+    bed_file_groups: `list`
+        Lists of bed files, one list per sorted input.
+    output_files: `list`
+        Output bed files, one per file of a group.
+    compress: `bool` or `str` (default: False)
+        Compression of the outputs (see `output_codec`), by default BGZF if their names end with '.gz'. BGZF compressed outputs are indexed with tabix ('.tbi'), only the first one, which is coordinate-sorted. The other outputs follow its order.
+    remove_inputs: `bool` (default: False)
+        Whether to remove the input bed files after merging.
+    threads: `int` (default: 1)
+        Number of background compression threads of each output.
+    """
+    codec = output_codec(compress, output_files[0])
+    write_bed_records(heapq.merge(*[bed_records(bed_files) for bed_files in bed_file_groups], key=bed_record_key), output_files, codec, threads=threads)
+    if codec == "bgzf":
+        pysam.tabix_index(output_files[0], preset="bed", force=True)
+    if remove_inputs:
+        for bed_files in bed_file_groups:
+            for bed_file in bed_files:
+                os.remove(bed_file)
+
+
+def sort_bed(bed_files, sorted_bed_files, memory_budget="1G", temp_directory=None, threads=1):
+    """Sort bed files in lockstep by the coordinates of the first file with a bounded-memory external merge sort. `sorted_bed_files` can be `bed_files`, to sort in place.
+
+    Records are loaded and sorted in runs of about `memory_budget` bytes, which are written to `temp_directory` and merged with `merge_sorted_beds`. The sort is stable, so records with equal coordinates keep their order and the output is deterministic.
+
+    Parameters
+    ----------
+    bed_files: `list`
+        Bed files with the same number of lines, e.g. read 1 and read 2 bed files of read pairs.
+    sorted_bed_files: `list`
+        Output bed file of each bed file.
+    memory_budget: `str` or `int` (default: '1G')
+        Approximate memory used for sorting, e.g. '768M' or '3G', or a number of bytes.
+    temp_directory: `str` (default: None)
+        Directory of the sorted runs. If None, use the directory of the first sorted bed file.
+    threads: `int` (default: 1)
+        Number of background compression threads of each sorted bed file. Sorted bed files ending with '.gz' are BGZF compressed, the first one being indexed with tabix.
+    """
+    memory_budget = parse_memory_size(memory_budget)
+    temp_directory = os.path.dirname(os.path.abspath(sorted_bed_files[0])) if temp_directory is None else temp_directory
+    run_prefix = "%s/%s.%d.sortrun" % (temp_directory, os.path.basename(sorted_bed_files[0]), os.getpid())
+    run_groups = []
+    records = []
+    records_size = 0
+    for record in bed_records(bed_files):
+        records.append(record)
+        # Count the Python object overhead of each record and its cached sort key besides its bytes
+        records_size += sum(len(line) for line in record) + 192
+        if records_size >= memory_budget:
+            records.sort(key=bed_record_key)
+            run_groups.append(["%s%d.%d" % (run_prefix, len(run_groups), k) for k in range(len(bed_files))])
+            write_bed_records(iter(records), run_groups[-1])
+            records = []
+            records_size = 0
+    records.sort(key=bed_record_key)
+    if len(run_groups) == 0:
+        write_bed_records(iter(records), sorted_bed_files, threads=threads)
+        if output_codec(None, sorted_bed_files[0]) == "bgzf":
+            pysam.tabix_index(sorted_bed_files[0], preset="bed", force=True)
+        return
+    if len(records) > 0:
+        run_groups.append(["%s%d.%d" % (run_prefix, len(run_groups), k) for k in range(len(bed_files))])
+        write_bed_records(iter(records), run_groups[-1])
+    del records
+    merge_sorted_beds(run_groups, sorted_bed_files, remove_inputs=True, threads=threads)
+
+
+SUBSTITUTION_COLUMNS = {"A": ["a_to_c_error_rate", "a_to_g_error_rate", "a_to_t_error_rate"], "C": ["c_to_a_error_rate", "c_to_g_error_rate", "c_to_t_error_rate"], "G": ["g_to_a_error_rate", "g_to_c_error_rate", "g_to_t_error_rate"], "T": ["t_to_a_error_rate", "t_to_c_error_rate", "t_to_g_error_rate"]}
+# Substituted bases of A, C, G and T, in the order of SUBSTITUTION_COLUMNS
+SUBSTITUTION_BASES = np.frombuffer(b"CGTAGTACTACG", dtype=np.uint8).reshape(4, 3)
+BASE_CODE = np.full(256, -1, dtype=np.int64)
+BASE_CODE[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+ERROR_BASE_QUALITY = ord('9') # Phred score 24
+
+
+def substitution_tables(real_error_rate_read):
+    """Build the substitution tables of one read number from an error rate table with one row per read position (columns 'error_rate' and '<x>_to_<y>_error_rate', as written by fgbio ErrorRateByReadPosition).
+
     Return
     ------
-    chromosomes_coverd: `list`
-        List of chromosome names that the input bam files covers.
+    error_rate: `numpy.ndarray`
+        Error rate of each read position.
+    cumulative_prop: `numpy.ndarray`
+        Array of shape (read positions, 4, 3): cumulative probabilities of the substituted bases (`SUBSTITUTION_BASES`) of A, C, G and T at each read position. Positions without observed substitutions of a base use equal probabilities.
     """
-    cmd = "%s/samtools idxstats %s > %s/bam.stats.txt" % (samtools_directory, INPUT_bamfile, outdirectory)
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-         print('[ERROR] Fail to rerturn the index BAM information:\n', error.decode())    
-    bamstats = pd.read_csv("%s/bam.stats.txt" % outdirectory, header=None, delimiter="\t").to_numpy()
-    chromosomes_coverd = bamstats[np.nonzero(bamstats[:,2])[0],0].tolist()
-    return chromosomes_coverd
+    error_rate = real_error_rate_read['error_rate'].to_numpy(dtype=np.float64)
+    prop = np.stack([real_error_rate_read[SUBSTITUTION_COLUMNS[base]].to_numpy(dtype=np.float64) for base in "ACGT"], axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        prop = prop / prop.sum(axis=2, keepdims=True)
+    prop[np.isnan(prop).any(axis=2)] = 1 / 3
+    return error_rate, np.cumsum(prop, axis=2)
 
 
-def scATAC_CreateFeatureSets(INPUT_bamfile, samtools_directory, bedtools_directory, outdirectory, genome_size_file, macs3_directory, INPUT_peakfile=None, INPUT_nonpeakfile=None, OUTPUT_peakfile=None):
-    """Create the foreground and background feature set for the input scATAC-seq bam file.
+def inject_substitution_errors(lines, error_rate, cumulative_prop, rng):
+    """Introduce substitution errors into a chunk of FASTQ records given as a list of lines (bytes with line breaks), in place.
+
+    Sequences are encoded as one uint8 array. Error positions are drawn as one Bernoulli matrix of reads by read positions, and substituted bases with one uniform draw per error against `cumulative_prop`. Erroneous bases get quality '9' and reads with a substituted base are uppercased. Positions beyond the error rate table or the read, and bases other than A, C, G and T (in either case), get no errors.
+    """
+    seqs = lines[1::4]
+    n_read = len(seqs)
+    if n_read == 0:
+        return lines
+    seq_len = np.fromiter((len(seq) - 1 for seq in seqs), dtype=np.int64, count=n_read)
+    seq_buf = np.frombuffer(b''.join(seqs), dtype=np.uint8).copy()
+    qual_buf = np.frombuffer(b''.join(lines[3::4]), dtype=np.uint8).copy()
+    read_offset = np.cumsum(seq_len + 1) - seq_len - 1
+    is_error = rng.random((n_read, len(error_rate))) < error_rate
+    read_idx, position = np.nonzero(is_error)
+    in_read = position < seq_len[read_idx]
+    read_idx, position = read_idx[in_read], position[in_read]
+    error_idx = read_offset[read_idx] + position
+    base_code = BASE_CODE[seq_buf[error_idx] & 0xDF]
+    is_base = base_code >= 0
+    read_idx, error_idx, position, base_code = read_idx[is_base], error_idx[is_base], position[is_base], base_code[is_base]
+    has_error = np.zeros(n_read, dtype=bool)
+    has_error[read_idx] = True
+    # Reads with an error are uppercased
+    is_lower = (seq_buf >= ord('a')) & (seq_buf <= ord('z')) & np.repeat(has_error, seq_len + 1)
+    seq_buf[is_lower] -= 32
+    u = rng.random(len(error_idx))
+    substitution = (u[:, None] >= cumulative_prop[position, base_code, :2]).sum(axis=1)
+    seq_buf[error_idx] = SUBSTITUTION_BASES[base_code, substitution]
+    qual_buf[error_idx] = ERROR_BASE_QUALITY
+    seq_bytes = seq_buf.tobytes()
+    qual_bytes = qual_buf.tobytes()
+    for k in range(n_read):
+        if has_error[k]:
+            lo = read_offset[k]
+            hi = lo + seq_len[k] + 1
+            lines[4 * k + 1] = seq_bytes[lo:hi]
+            lines[4 * k + 3] = qual_bytes[lo:hi]
+    return lines
+
+
+SUBSTITUTION_BLOCK_SIZE = 4096 # Reads sharing one random generator in add_substitution_errors
+
+
+def substitution_error_chunk(task):
+    """Introduce substitution errors into one chunk (number of its first block, FASTQ lines, error rate, cumulative substitution table, random seed, stream). Each block of `SUBSTITUTION_BLOCK_SIZE` reads has its own random generator keyed by the block number, so errors do not depend on the chunk size.
+
+    """
+    first_block, lines, error_rate, cumulative_prop, random_seed, stream = task
+    block_lines = 4 * SUBSTITUTION_BLOCK_SIZE
+    return b''.join(b''.join(inject_substitution_errors(lines[lo:lo + block_lines], error_rate, cumulative_prop, feature_rng(random_seed, stream, first_block + lo // block_lines))) for lo in range(0, len(lines), block_lines))
+
+
+def add_substitution_errors(fastq_file, output_fq_file, real_error_rate_read, chunk_size=65536, n_cores=1, random_seed=2022, stream=0, compress_threads=1):
+    """Stream a FASTQ file in chunks of `chunk_size` reads and introduce substitution errors according to real data error rates.
 
     Parameters
     ----------
-    INPUT_bamfile: `str`
-        Directory of input BAM file.
-    samtools_directory: `str`
-        Directory of software samtools.
-    bedtools_directory: `str`
-        Directory of software bedtools.
-    outdirectory: `str`
-        Output directory.
-    genome_size_file: `str`
-        Directory of Genome sizes file. The file should be a tab delimited text file with two columns: first column for the chromosome name, second column indicates the size.  
-    macs3_directory: `str`
-        Path to software MACS3.
-    INPUT_peakfile: `str` (default: None)
-        Directory of user-specified input peak file.
-    INPUT_nonpeakfile: `str` (default: None)
-        Directory of user-specified input non-peak file.
-    OUTPUT_peakfile: `str` (default: None)
-        Directory of user-specified output peak file. Synthetic scATAC-seq reads will be generated taking `OUTPUT_peakfile` as ground truth peaks. Note that `OUTPUT_peakfile` does not name the generated feature files by function `scATAC_CreateFeatureSets`.
+    fastq_file: `str`
+        Input FASTQ file, gzip compressed if its name ends with '.gz'.
+    output_fq_file: `str`
+        Output FASTQ file, BGZF compressed if its name ends with '.gz'.
+    real_error_rate_read: `pandas.DataFrame`
+        Error rates of the read number, one row per read position (see `substitution_tables`).
+    chunk_size: `int` (default: 65536)
+        Number of reads per chunk, rounded up to a multiple of `SUBSTITUTION_BLOCK_SIZE`. The output does not depend on the chunk size.
+    n_cores: `int` (default: 1)
+        Number of processes introducing errors. The output does not depend on the number of processes.
+    random_seed: `int` (default: 2022)
+        Root seed of the random generators. Each block of `SUBSTITUTION_BLOCK_SIZE` reads has its own generator seeded by `random_seed`, `stream` and the block number.
+    stream: `int` (default: 0)
+        Random stream key, e.g. the read number, so that read 1 and read 2 get independent errors.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of a compressed output.
     """
-    chromosomes_coverd = ExtractBAMCoverage(INPUT_bamfile, samtools_directory, outdirectory)
-    search_string_chr = '|'.join(chromosomes_coverd)
-    cmd = "cat %s | grep -Ew '%s' > %s/genome_size_selected.txt" % (genome_size_file, search_string_chr, outdirectory)
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to extract gene regions from genome annotation file:\n', error.decode())
-    # Input peaks and non-peaks
-    if INPUT_peakfile is None or INPUT_nonpeakfile is None:
-        # Define peaks and non-peaks using MACS3
-        peakfile = outdirectory + "/" + "scReadSim.MACS3.peak.bed"
-        nonpeakfile = outdirectory + "/" + "scReadSim.MACS3.nonpeak.bed"
-        # Call peaks
-        print("[scReadSim] No Input Peaks and Non-Peaks.")
-        print("[scReadSim] Generate Peaks and Non-Peaks using MACS3 Instead.")
-        print("[scReadSim] Generating Peaks using MACS3...")
-        CallPeak(macs3_directory, INPUT_bamfile, outdirectory, "scReadSim_MACS3_Stringent", qval=0.01)
-        cmd = "%s/bedtools sort -i %s/scReadSim_MACS3_Stringent_peaks.narrowPeak | %s/bedtools merge  > %s/scReadSim.MACS3.peak.bed" % (bedtools_directory, outdirectory, bedtools_directory, outdirectory)
-        output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create feature set:\n', error.decode())
-        print("[scReadSim] Peaks Generated: %s/scReadSim.MACS3.peak.bed" % outdirectory)
-        # Call non-peaks
-        print("[scReadSim] Generating Non-Peaks using MACS3...")
-        CallPeak(macs3_directory, INPUT_bamfile, outdirectory, "scReadSim_MACS3_LessStringent", qval=0.1)
-        cmd = "%s/bedtools sort -i %s/scReadSim_MACS3_LessStringent_peaks.narrowPeak | %s/bedtools merge  > %s/scReadSim_MACS3.nonpeak.tmp.bed" % (bedtools_directory, outdirectory, bedtools_directory, outdirectory)
-        output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create feature set:\n', error.decode())
-        # Calculate the inter peaks as non-peaks
-        complement_cmd = "%s/bedtools complement -i %s/scReadSim_MACS3.nonpeak.tmp.bed -g %s/genome_size_selected.txt > %s/scReadSim.MACS3.nonpeak.bed" % (bedtools_directory, outdirectory, outdirectory, outdirectory)
-        output, error = subprocess.Popen(complement_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create complementary feature set:\n', error.decode())
-        print("[scReadSim] Non-Peaks Generated: %s/scReadSim.MACS3.nonpeak.bed" % outdirectory)
-    else:
-        peakfile = "scReadSim.UserInput.peak.bed"
-        nonpeakfile = "scReadSim.UserInput.nonpeak.bed"
-        # Merge and sort peak file
-        print("[scReadSim] Merging Input Peak File: %s" % INPUT_peakfile)
-        cmd = "%s/bedtools sort -i %s | %s/bedtools merge  > %s/%s" % (bedtools_directory, INPUT_peakfile, bedtools_directory, outdirectory, peakfile)
-        output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to sort input peak set:\n', error.decode())
-        print("[scReadSim] Merging Input Non-Peak File: %s" % INPUT_nonpeakfile)
-        print("[scReadSim] Peaks Generated: %s/%s" % (outdirectory, peakfile))
-        # Merge and sort non-peak file
-        cmd = "%s/bedtools sort -i %s | %s/bedtools merge  > %s/%s" % (bedtools_directory, INPUT_nonpeakfile, bedtools_directory, outdirectory, nonpeakfile)
-        output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to merge input non-peak feature set:\n', error.decode())
-        print("[scReadSim] Non-Peaks Generated: %s/%s" % (outdirectory, nonpeakfile))
-    # Union peaks and non-peaks
-    print("[scReadSim] Generating Gray Areas...")
-    cmd = "cat %s/%s %s/%s | bedtools sort | bedtools merge > %s/Peak_NonPeaks_Union.bed" % (outdirectory, peakfile, outdirectory, nonpeakfile, outdirectory)
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    complement_cmd = "%s/bedtools complement -i %s/Peak_NonPeaks_Union.bed -g %s/genome_size_selected.txt > %s/scReadSim.grayareas.bed" % (bedtools_directory, outdirectory, outdirectory, outdirectory)
-    output, error = subprocess.Popen(complement_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-         print('[ERROR] Fail to create gray area feature set:\n', error.decode())
-    print("[scReadSim] Gray Areas Generated: %s/scReadSim.grayareas.bed" % outdirectory)
-    print('\n[scReadSim] Created:')
-    print('[scReadSim] Peak File: %s/%s' % (outdirectory, peakfile))
-    print('[scReadSim] Non-Peak File: %s/%s' % (outdirectory, nonpeakfile))
-    print('[scReadSim] Gray Area File: %s/scReadSim.grayareas.bed' % (outdirectory))
-    # Output Peak Mode
-    if OUTPUT_peakfile is not None:
-        output_peakfile = "scReadSim.output.peak.bed"
-        output_nonpeakfile = "scReadSim.output.nonpeak.bed"
-        print("\n[scReadSim] User-specified Output Peaks Detected: %s" % OUTPUT_peakfile)
-        # Merge and sort output peak file
-        print("[scReadSim] Merging Output Peak File: %s" % OUTPUT_peakfile)
-        cmd = "%s/bedtools sort -i %s | %s/bedtools merge  > %s/%s" % (bedtools_directory, OUTPUT_peakfile, bedtools_directory, outdirectory, output_peakfile)
-        output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to sort output peak set:\n', error.decode())
-        print("Generating Output Non-Peaks...")
-        complement_cmd = "%s/bedtools complement -i %s -g %s/genome_size_selected.txt > %s/%s" % (bedtools_directory, OUTPUT_peakfile, outdirectory, outdirectory, output_nonpeakfile)
-        output, error = subprocess.Popen(complement_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create output non-peak feature set:\n', error.decode())
-        print('\n[scReadSim] Created:')
-        print('[scReadSim] Output Peak File: %s/%s' % (outdirectory, output_peakfile))
-        print('[scReadSim] Output Non-Peak File: %s/%s' % (outdirectory, output_nonpeakfile))
-    print('[scReadSim] Done!')
+    error_rate, cumulative_prop = substitution_tables(real_error_rate_read)
+    chunk_blocks = max(1, -(-chunk_size // SUBSTITUTION_BLOCK_SIZE))
+    with open_input(fastq_file) as infile, open_fastq_output(output_fq_file, compress_threads) as outsfile:
+        chunks = iter(lambda: list(itertools.islice(infile, 4 * SUBSTITUTION_BLOCK_SIZE * chunk_blocks)), [])
+        tasks = ((chunk_no * chunk_blocks, lines, error_rate, cumulative_prop, random_seed, stream) for chunk_no, lines in enumerate(chunks))
+        if n_cores <= 1:
+            for task in tasks:
+                outsfile.write(substitution_error_chunk(task))
+            return
+        with multiprocessing.get_context().Pool(processes=n_cores) as pool:
+            # Submit a bounded batch of chunks at a time, so the file is never fully loaded
+            while True:
+                batch = list(itertools.islice(tasks, 2 * n_cores))
+                if len(batch) == 0:
+                    break
+                outsfile.writelines(pool.imap(substitution_error_chunk, batch))
 
 
-def scRNA_CreateFeatureSets(INPUT_bamfile, samtools_directory, bedtools_directory, outdirectory, genome_annotation, genome_size_file):
-    """Create the foreground and background feature set for the input scRNA-seq bam file.
+ERROR_RATE_BASES = "acgt"
+COMPLEMENT_CODE = np.array([3, 2, 1, 0], dtype=np.int64)
+
+
+def error_profile_counts(blocks, reads, seq_buf, ref_buf, max_cycle):
+    """Count the (read number, cycle, reference base, read base) combinations of a batch of aligned blocks.
+
+    `blocks` holds one (read index, query start, reference start, length) row per aligned (M, = or X) CIGAR block and `reads` one (sequence offset, query length, is reverse, read number index) row per read. Bases of reverse strand reads are complemented and their cycles counted from the read end, so substitutions are in sequencing orientation. Positions with a base other than A, C, G and T in the read or reference are skipped.
+    """
+    counts = np.zeros((2, max_cycle, 4, 4), dtype=np.int64)
+    if len(blocks) == 0:
+        return counts
+    blocks = np.asarray(blocks, dtype=np.int64)
+    reads = np.asarray(reads, dtype=np.int64)
+    block_len = blocks[:, 3]
+    block_idx = np.repeat(np.arange(len(blocks)), block_len)
+    within = np.arange(block_len.sum()) - np.repeat(np.cumsum(block_len) - block_len, block_len)
+    read_idx = blocks[block_idx, 0]
+    query_pos = blocks[block_idx, 1] + within
+    read_code = BASE_CODE[seq_buf[reads[read_idx, 0] + query_pos] & 0xDF]
+    ref_code = BASE_CODE[ref_buf[blocks[block_idx, 2] + within] & 0xDF]
+    keep = (read_code >= 0) & (ref_code >= 0)
+    read_idx, query_pos, read_code, ref_code = read_idx[keep], query_pos[keep], read_code[keep], ref_code[keep]
+    is_reverse = reads[read_idx, 2] == 1
+    cycle = np.where(is_reverse, reads[read_idx, 1] - 1 - query_pos, query_pos)
+    read_code = np.where(is_reverse, COMPLEMENT_CODE[read_code], read_code)
+    ref_code = np.where(is_reverse, COMPLEMENT_CODE[ref_code], ref_code)
+    flat = ((reads[read_idx, 3] * max_cycle + cycle) * 4 + ref_code) * 4 + read_code
+    counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+    return counts
+
+
+def error_profile_shard(shard):
+    """Profile the substitutions of the first reads of one chromosome with the worker's persistent BAM handle, looking reference bases up in the reference genome.
+
+    Reads that are unmapped, secondary, supplementary, duplicates, QC failed or have a mapping quality below the minimum are skipped.
+
+    Return
+    ------
+    counts: `numpy.ndarray`
+        Array of shape (2, cycles, 4, 4) counting, for read 1 (or unpaired reads) and read 2 and each cycle, the read bases (last axis) called on each reference base.
+    """
+    chromosome, = shard
+    n_reads = count_worker_state["n_reads"]
+    min_mapping_quality = count_worker_state["min_mapping_quality"]
+    max_cycle = count_worker_state["max_cycle"]
+    counts = np.zeros((2, max_cycle, 4, 4), dtype=np.int64)
+    reference_genome = ReferenceGenome(count_worker_state["referenceGenome_file"], max_cached=1)
+    if chromosome not in reference_genome.chrom_size:
+        reference_genome.close()
+        return counts
+    ref_buf = np.frombuffer(reference_genome.chromosome(chromosome).encode(), dtype=np.uint8)
+    reference_genome.close()
+    blocks, reads, seqs = [], [], []
+    seq_offset = 0
+    n_read = 0
+    for read in count_worker_state["samfile"].fetch(chromosome):
+        if read.flag & 0xF04 or read.mapping_quality < min_mapping_quality:
+            continue
+        seq = read.query_sequence
+        if seq is None or len(seq) > max_cycle:
+            continue
+        # Walk the CIGAR, keeping aligned blocks
+        query_pos = 0
+        ref_pos = read.reference_start
+        for op, length in read.cigartuples:
+            if op == 0 or op == 7 or op == 8:
+                blocks.append((len(reads), query_pos, ref_pos, length))
+                query_pos += length
+                ref_pos += length
+            elif op == 1 or op == 4:
+                query_pos += length
+            elif op == 2 or op == 3:
+                ref_pos += length
+        reads.append((seq_offset, len(seq), read.is_reverse, 1 if read.is_read2 else 0))
+        seqs.append(seq)
+        seq_offset += len(seq)
+        n_read += 1
+        if len(reads) == 100000:
+            counts += error_profile_counts(blocks, reads, np.frombuffer(''.join(seqs).encode(), dtype=np.uint8), ref_buf, max_cycle)
+            blocks, reads, seqs = [], [], []
+            seq_offset = 0
+        if n_reads is not None and n_read >= n_reads:
+            break
+    counts += error_profile_counts(blocks, reads, np.frombuffer(''.join(seqs).encode(), dtype=np.uint8), ref_buf, max_cycle)
+    return counts
+
+
+def error_rate_table(counts):
+    """Convert substitution counts from `error_profile_shard` into an error rate table with one row per read number and cycle, in the layout of fgbio ErrorRateByReadPosition with '--collapse false'.
+
+    Cycles up to the longest observed read are kept for each read number with observed bases. Cycles without observed bases get rate 0.
+    """
+    rows = []
+    for read_number_idx in range(2):
+        observed = np.nonzero(counts[read_number_idx].sum(axis=(1, 2)))[0]
+        if len(observed) == 0:
+            continue
+        counts_read = counts[read_number_idx, :observed[-1] + 1].astype(np.float64)
+        bases_total = counts_read.sum(axis=(1, 2))
+        errors = bases_total - np.trace(counts_read, axis1=1, axis2=2)
+        ref_total = counts_read.sum(axis=2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            table = pd.DataFrame({"read_number": read_number_idx + 1, "position": np.arange(1, len(bases_total) + 1), "bases_total": bases_total.astype(np.int64), "errors": errors.astype(np.int64), "error_rate": np.nan_to_num(errors / bases_total)})
+            for ref_code, ref_base in enumerate(ERROR_RATE_BASES):
+                for read_code, read_base in enumerate(ERROR_RATE_BASES):
+                    if read_code != ref_code:
+                        table["%s_to_%s_error_rate" % (ref_base, read_base)] = np.nan_to_num(counts_read[:, ref_code, read_code] / ref_total[:, ref_code])
+        rows.append(table)
+    return pd.concat(rows, ignore_index=True)
+
+
+def profile_error_rates(INPUT_bamfile, referenceGenome_file, output_file, n_reads=100000, min_mapping_quality=20, max_read_length=1000, n_cores=1):
+    """Estimate per read position substitution error rates from the alignments of a sample of reads, as an in-process replacement of fgbio ErrorRateByReadPosition.
+
+    The first `n_reads` reads of each chromosome are compared with the reference genome, chromosomes being profiled in parallel. Chromosomes missing from the reference genome are skipped with a warning; the function stops with an error if no base could be profiled. The table written to `output_file` has the columns of fgbio's output read by `SubstiError_Pair` and `SubstiError`: 'read_number', 'position', 'bases_total', 'errors', 'error_rate' and 'x_to_y_error_rate' for every pair of bases x and y, counted in sequencing orientation.
 
     Parameters
     ----------
     INPUT_bamfile: `str`
-        Input BAM file.
-    samtools_directory: `str`
-        Path to software `samtools`.
-    bedtools_directory: `str`
-        Path to software `bedtools`.
-    outdirectory: `str`
-        Specify the output directory of the features files.
-    genome_annotation: `str`
-        Genome annotation file for the reference genome that the input BAM aligned on or the synthetic BAM should align on.
-    genome_size_file: `str`
-        Genome sizes file. The file should be a tab delimited text file with two columns: first column for the chromosome name, second column indicates the size.
+        Coordinate-sorted and indexed BAM file.
+    referenceGenome_file: `str`
+        Reference genome FASTA file the reads are aligned to.
+    output_file: `str`
+        Output tab-delimited error rate table.
+    n_reads: `int` (default: 100000)
+        Number of reads sampled from the start of each chromosome. If None, use all reads.
+    min_mapping_quality: `int` (default: 20)
+        Minimum mapping quality of the sampled reads.
+    max_read_length: `int` (default: 1000)
+        Reads longer than `max_read_length` are skipped.
+    n_cores: `int` (default: 1)
+        Number of chromosomes profiled in parallel.
+
+    Return
+    ------
+    real_error_rate: `pandas.DataFrame`
+        The error rate table.
     """
-    genome_size_df = pd.read_csv(genome_size_file, header=None, delimiter="\t")
-    chromosomes_coverd = ExtractBAMCoverage(INPUT_bamfile, samtools_directory, outdirectory)
-    search_string_chr = '|'.join(chromosomes_coverd)
-    cmd = "cat %s | grep -Ew '%s' > %s/genome_size_selected.txt" % (genome_size_file, search_string_chr, outdirectory)
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to extract corresponding chromosomes from genome size file:\n', error.decode())
-    cmd = """awk -F"\t" '$3=="gene"' %s | cut -f1,4,5 > %s/gene_region.bed""" % (genome_annotation, outdirectory)
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to extract gene regions from genome annotation file:\n', error.decode())
-    cmd = "%s/bedtools sort -i %s/gene_region.bed | %s/bedtools merge | grep -Ew '%s' > %s/scReadSim.Gene.bed" % (bedtools_directory, outdirectory, bedtools_directory, search_string_chr, outdirectory)
-    print("[scReadSim] Generating Bed File for Genes...")
-    output, error = subprocess.Popen(cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to create feature set:\n', error.decode())
-    os.system("rm %s/gene_region.bed" % outdirectory)
-    print("[scReadSim] Generating Bed File for InterGenes...")
-    complement_cmd = "%s/bedtools complement -i %s/scReadSim.Gene.bed -g %s/genome_size_selected.txt > %s/scReadSim.InterGene.bed" % (bedtools_directory, outdirectory, outdirectory, outdirectory)
-    output, error = subprocess.Popen(complement_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to create complementary feature set:\n', error.decode())
-    print('\n[scReadSim] Created:')
-    print('[scReadSim] Gene Bed File: %s/scReadSim.Gene.bed' % (outdirectory))
-    print('[scReadSim] InterGene Bed File: %s/scReadSim.InterGene.bed' % (outdirectory))
-    print('[scReadSim] Done!')
+    bam_chrom_names = IntervalSet.bam_chromosomes(INPUT_bamfile)
+    reference_genome = ReferenceGenome(referenceGenome_file)
+    ref_chrom_names = list(reference_genome.chrom_size)
+    reference_genome.close()
+    chrom_names = [chromosome for chromosome in bam_chrom_names if chromosome in ref_chrom_names]
+    missing_chrom_names = [chromosome for chromosome in bam_chrom_names if chromosome not in ref_chrom_names]
+    if len(chrom_names) == 0:
+        sys.exit("[ERROR] None of the chromosomes with mapped reads in %s (e.g. '%s') are in the reference genome %s (e.g. '%s'). Please check that the BAM file and the reference genome use the same chromosome names, e.g. 'chr1' or '1'." % (INPUT_bamfile, "', '".join(bam_chrom_names[:3]), referenceGenome_file, "', '".join(ref_chrom_names[:3])))
+    if len(missing_chrom_names) > 0:
+        print("[scReadSim] Warning: %d chromosomes with mapped reads in %s are not in the reference genome and are not profiled (e.g. '%s')." % (len(missing_chrom_names), INPUT_bamfile, "', '".join(missing_chrom_names[:3])))
+    worker_data = {"referenceGenome_file": referenceGenome_file, "n_reads": n_reads, "min_mapping_quality": min_mapping_quality, "max_cycle": max_read_length}
+    results = run_count_workers(error_profile_shard, [(chromosome,) for chromosome in chrom_names], (INPUT_bamfile, worker_data), n_cores, initializer=synthesis_worker_init)
+    counts = np.sum(results, axis=0)
+    if counts.sum() == 0:
+        sys.exit("[ERROR] No aligned base of %s was profiled. Reads are only profiled if they are mapped, primary, not duplicates or QC failed, have a mapping quality of at least %d (min_mapping_quality) and are at most %d bp long (max_read_length)." % (INPUT_bamfile, min_mapping_quality, max_read_length))
+    real_error_rate = error_rate_table(counts)
+    real_error_rate.to_csv(output_file, sep="\t", index=False, float_format="%.6g")
+    return real_error_rate
 
 
-def countmat_mainloop(rec_id):
-    """Construct count vector for each scATAC-seq feature.
+def sort_index_bam(unsorted_bamfile, sorted_bamfile, n_threads=1, sort_memory="768M"):
+    """Coordinate-sort a BAM file with the samtools bundled in pysam, index the sorted file and remove the unsorted one.
 
     """
-    count_array = np.zeros(cells_n, dtype=int) # initialize
-    rec = open_peak[rec_id]
-    rec_name = '_'.join((rec[0], str(rec[1]), str(rec[2])))
-    samfile = pysam.AlignmentFile(INPUT_bamfile_glb, "rb")
-    reads = samfile.fetch(rec[0], int(rec[1]), int(rec[2]))  # question: what about feature intersection or half overlap?
-    cell_iter = []
-    cell_idx_ls = []
-    for read in reads:
-        cell_iter.append(read.qname.split(":")[0].upper())
-    for cell in cell_iter:
-        if cell in cells_barcode:
-            cell_idx_ls.append(cells_barcode.index(cell))
-    counter = Counter(cell_idx_ls)
-    keys = list(counter.keys())
-    values = list(counter.values())
-    count_array[keys] = values
-    count_array_withPeak = np.insert(count_array.astype(str), 0, rec_name)
-    return count_array_withPeak
+    pysam.sort("-@", str(n_threads), "-m", sort_memory, "-T", "%s.tmp" % sorted_bamfile, "-o", sorted_bamfile, unsorted_bamfile)
+    pysam.index(sorted_bamfile)
+    os.remove(unsorted_bamfile)
 
 
-def scATAC_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdirectory, count_mat_filename, n_cores=1):
+def scATAC_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdirectory, count_mat_filename, n_cores=1, count_mode="fetch", barcode_tag=None, count_mat_format="mtx", bam_threads=2):
     """Construct count matrix for scATAC-seq BAM file.
 
     Parameters
@@ -253,23 +2216,22 @@ def scATAC_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdi
     count_mat_filename: `str`
         Specify the base name of output count matrix.
     n_cores: `int` (default: 1)
-        Specify the number of cores for parallel computing when generating count matrix.
-    """
-    cells = pd.read_csv(cells_barcode_file, sep="\t", header=None)
-    cells = cells.values.tolist()
-    # Specify global vars
-    global open_peak, cells_n, cells_barcode, INPUT_bamfile_glb
-    INPUT_bamfile_glb = INPUT_bamfile
-    cells_barcode = [item[0] for item in cells]
+        Specify the number of cores for parallel computing when generating count matrix. Each core counts contiguous shards of features on one chromosome with its own persistent BAM handle.
+    count_mode: `str` (default: 'fetch')
+        Specify how reads are counted. 'fetch' queries the BAM file once per feature. 'read', 'fragment' and 'insertion' stream the coordinate-sorted BAM file once per chromosome and count each read on the features its alignment overlaps ('read', same counts as 'fetch'), each fragment once on the feature containing its midpoint ('fragment'; a read pair on one chromosome is one fragment, any other read its own fragment) or on the feature containing its Tn5 insertion site ('insertion').
+    barcode_tag: `str` (default: None)
+        Specify the BAM tag storing the cell barcode, e.g. 'CB'. If None, the cell barcode is taken from the read name before the first ':'.
+    count_mat_format: `str` (default: 'mtx')
+        Specify the format of the output count matrix. 'mtx' writes a gzipped Matrix Market file `count_mat_filename`.mtx.gz with feature and barcode sidecars `count_mat_filename`.features.txt and `count_mat_filename`.barcodes.txt; 'txt' exports the dense tab-delimited text matrix `count_mat_filename`.txt.
+    bam_threads: `int` (default: 2)
+        Specify the number of BGZF decompression threads of the BAM handle kept open by each counting process.
+    """
+    cells_barcode = load_cell_barcodes(cells_barcode_file)
+    barcode_resolver = BarcodeResolver(cells_barcode, barcode_tag=barcode_tag)
     with open(bed_file) as open_peak:
         reader = csv.reader(open_peak, delimiter="\t")
         open_peak = np.asarray(list(reader))
     k = 0
-    cellsdic = defaultdict(lambda: [None])
-    for cell in cells_barcode:
-        cellsdic[cell] = k
-        k += 1
-    k = 0
     peaksdic = defaultdict(lambda: [None])
     for rec in open_peak:
         rec_name = '_'.join(rec)
@@ -277,52 +2239,128 @@ def scATAC_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdi
         k += 1
     cells_n = len(cells_barcode)
     peaks_n = len(open_peak)
+    feature_names = ['_'.join(rec[0:3]) for rec in open_peak]
     print("[scReadSim] Generating read count matrix...\n")
-    mat_array = Parallel(n_jobs=n_cores, backend='multiprocessing')(delayed(countmat_mainloop)(rec_id) for rec_id in (range(len(open_peak))))
-    para_countmat = np.array(mat_array)
-    with open("%s/%s.txt" % (outdirectory, count_mat_filename), 'w') as outsfile:
-        for rec_id in tqdm(range(len(open_peak))):
-            print("\t".join([str(x) for x in para_countmat[rec_id,:]]),file = outsfile)
+    if count_mode == "fetch":
+        shard_results = run_count_workers(countmat_shard, feature_shards(open_peak, n_cores * 4), (INPUT_bamfile, open_peak, barcode_resolver, None, bam_threads), n_cores)
+        countmat = CountMatrix.from_rows(feature_names, cells_barcode, gather_shard_rows(shard_results, peaks_n), cells_n)
+    elif count_mode in ("read", "fragment", "insertion"):
+        coo_feature, coo_cell, coo_count = scATAC_bam2countmat_sweep(barcode_resolver, open_peak, INPUT_bamfile, count_unit=count_mode, n_cores=n_cores, bam_threads=bam_threads)
+        countmat = CountMatrix.from_coo(feature_names, cells_barcode, coo_feature, coo_cell, coo_count, cells_n)
+    else:
+        sys.exit("[ERROR] Unknown count_mode '%s': choose from 'fetch', 'read', 'fragment' and 'insertion'." % count_mode)
+    count_mat_file = write_countmat(countmat, "%s/%s" % (outdirectory, count_mat_filename), count_mat_format)
     print('[scReadSim] Created:')
-    print('[scReadSim] Read Count Matrix: %s/%s.txt' % (outdirectory, count_mat_filename))
+    print('[scReadSim] Read Count Matrix: %s' % count_mat_file)
     print('[scReadSim] Done!')
 
 
-def scRNA_UMIcountmat_mainloop(rec_id):
-    """Construct count vector for each scRNA-seq feature.
+def bam_sweep_umi(samfile, chromosome, barcode_resolver, UMI_tag, start=None, end=None):
+    """Stream the reads of one chromosome region once and collect the alignment interval, cell and 2-bit packed UMI of every read carrying a UMI.
+
+    UMIs containing bases other than A, C, G and T get distinct negative codes, so they are still counted but never error-corrected.
 
+    Return
+    ------
+    read_start, read_end, cell_idx, umi: `numpy.ndarray`
+        Alignment interval, count matrix column and UMI code of every read from a listed cell.
     """
-    UMI_currlist  = [["empty UMI"] for _ in range(cells_n)] 
-    rec = open_peak[rec_id]
-    rec_name = '_'.join((rec[0], str(rec[1]), str(rec[2])))
-    samfile = pysam.AlignmentFile(INPUT_bamfile_glb, "rb")
-    reads = samfile.fetch(rec[0], int(rec[1]), int(rec[2]))  
-    # UMI_iter = []
-    # cell_idx_ls = []
-    for read in reads:
-        cell = read.qname.split(":")[0].upper()
-        if cell in cells_barcode:
-            print(1)
-            try:
-                if read.has_tag(UMI_tag_glb):
-                    UMI = read.get_tag(UMI_tag_glb)
-                    UMI_currlist[cellsdic[cell]].append(UMI)
-            except KeyError:
-                pass
-    UMI_count_array = [len(set(UMIs_percell))-1 for UMIs_percell in UMI_currlist]
-    UMI_count_array.insert(0,rec_name)
-    return UMI_count_array
-
-
-# TEST
-# cells_barcode_file= INPUT_cells_barcode_file
-# bed_file=outdirectory + "/" + ref_peakfile
-# count_mat_filename=UMI_count_mat_filename
-# UMI_modeling=True
-# UMI_tag = "UB:Z"
-# UMI_countmat_array = scRNA_UMIcountmat_mainloop(rec_id)
-
-def scRNA_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdirectory, count_mat_filename, UMI_modeling=True, UMI_tag="UB:Z", n_cores=1):
+    read_start = array.array("q")
+    read_end = array.array("q")
+    cell_idx = array.array("q")
+    umi = array.array("q")
+    umi_other = {}
+    for read in samfile.fetch(chromosome, start, end):
+        cell = barcode_resolver.cell_index(read)
+        if cell < 0 or not read.has_tag(UMI_tag):
+            continue
+        UMI = read.get_tag(UMI_tag)
+        code = encode_2bit(UMI)
+        if code < 0:
+            code = umi_other.setdefault(UMI, -2 - len(umi_other))
+        read_start.append(read.reference_start)
+        read_end.append(read.reference_end if read.reference_end is not None and read.reference_end > read.reference_start else read.reference_start + 1)
+        cell_idx.append(cell)
+        umi.append(code)
+    return np.frombuffer(read_start, dtype=np.int64), np.frombuffer(read_end, dtype=np.int64), np.frombuffer(cell_idx, dtype=np.int64), np.frombuffer(umi, dtype=np.int64)
+
+
+def umi_hamming1_absorbed(group, umi, n_read):
+    """Flag the UMIs that are within Hamming distance 1 of a more supported UMI of the same (feature, cell) group.
+
+    `group`, `umi` and `n_read` hold the distinct (group, UMI) pairs sorted by group then UMI, with the number of reads of each. A UMI is absorbed by a neighbour with more reads, or with as many reads and a smaller packed code.
+    """
+    absorbed = np.zeros(len(umi), dtype=bool)
+    valid = umi >= 0
+    if not valid.any():
+        return absorbed
+    umi_len = np.zeros(len(umi), dtype=np.int64)
+    umi_len[valid] = np.floor(np.log2(umi[valid].astype(np.float64))).astype(np.int64) // 2
+    umi_code, umi_rank = np.unique(umi, return_inverse=True)
+    pair_key = group * len(umi_code) + umi_rank
+    for pos in range(int(umi_len.max())):
+        at_pos = valid & (umi_len > pos)
+        for base_diff in (1, 2, 3):
+            neighbour = umi[at_pos] ^ (base_diff << (2 * pos))
+            rank = np.minimum(np.searchsorted(umi_code, neighbour), len(umi_code) - 1)
+            known = umi_code[rank] == neighbour
+            query = np.nonzero(at_pos)[0][known]
+            hit = np.searchsorted(pair_key, group[query] * len(umi_code) + rank[known])
+            hit = np.minimum(hit, len(pair_key) - 1)
+            found = pair_key[hit] == group[query] * len(umi_code) + rank[known]
+            query, hit = query[found], hit[found]
+            stronger = (n_read[hit] > n_read[query]) | ((n_read[hit] == n_read[query]) & (umi[hit] < umi[query]))
+            absorbed[query[stronger]] = True
+    return absorbed
+
+
+def count_unique_umis(feature_idx, cell_idx, umi, cells_n, UMI_correction=False):
+    """Count the distinct UMIs of each (feature, cell) pair from (feature, cell, UMI) triples with one sort.
+
+    Return
+    ------
+    coo_feature, coo_cell, coo_count: `numpy.ndarray`
+        Nonzero entries of the UMI count matrix.
+    """
+    group = feature_idx * cells_n + cell_idx
+    order = np.lexsort((umi, group))
+    group, umi = group[order], umi[order]
+    is_first = np.ones(len(group), dtype=bool)
+    is_first[1:] = (group[1:] != group[:-1]) | (umi[1:] != umi[:-1])
+    first = np.nonzero(is_first)[0]
+    group, umi = group[first], umi[first]
+    if UMI_correction and len(first) > 0:
+        n_read = np.diff(np.append(first, len(order)))
+        keep = ~umi_hamming1_absorbed(group, umi, n_read)
+        group = group[keep]
+    group, counts = np.unique(group, return_counts=True)
+    return group // cells_n, group % cells_n, counts
+
+
+def scRNA_UMIcountmat_shard(shard):
+    """Construct the UMI counts of one feature shard from a single pass of the worker's persistent BAM handle over the region the shard spans.
+
+    Return
+    ------
+    coo_feature, coo_cell, coo_count: `numpy.ndarray`
+        Nonzero entries of the shard's UMI count matrix, with features indexed in the order of the feature set.
+    """
+    chromosome, feature_idx, UMI_correction = shard
+    open_peak = count_worker_state["open_peak"]
+    barcode_resolver = count_worker_state["barcode_resolver"]
+    feature_start = open_peak[feature_idx,1].astype(np.int64)
+    feature_end = open_peak[feature_idx,2].astype(np.int64)
+    read_start, read_end, cell_idx, umi = bam_sweep_umi(count_worker_state["samfile"], chromosome, barcode_resolver, count_worker_state["UMI_tag"], int(feature_start.min()), int(feature_end.max()))
+    triple_feature, triple_cell, triple_umi = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for layer in feature_layers(feature_start, feature_end):
+        pair_read, pair_feature = assign_reads_to_features(read_start, read_end, feature_start[layer], feature_end[layer])
+        triple_feature.append(feature_idx[layer][pair_feature])
+        triple_cell.append(cell_idx[pair_read])
+        triple_umi.append(umi[pair_read])
+    return count_unique_umis(np.concatenate(triple_feature), np.concatenate(triple_cell), np.concatenate(triple_umi), barcode_resolver.cells_n, UMI_correction)
+
+
+def scRNA_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdirectory, count_mat_filename, UMI_modeling=True, UMI_tag="UB:Z", n_cores=1, barcode_tag=None, count_mat_format="mtx", bam_threads=2, UMI_correction=False):
     """Construct read (or UMI) count matrix for scRNA-seq BAM file.
 
     Parameters
@@ -342,24 +2380,22 @@ def scRNA_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdir
     UMI_tag: `str` (default: 'UB:Z')
         If UMI_modeling is set to True, specify the UMI tag of input BAM file, default value 'UB:Z' is the UMI tag for 10x scRNA-seq.
     n_cores: `int` (default: 1)
-        Specify the number of cores for parallel computing when generating count matrix.
-    """
-    cells = pd.read_csv(cells_barcode_file, sep="\t", header=None)
-    cells = cells.values.tolist()
-    # Specify global vars
-    global open_peak, cells_n, cells_barcode, INPUT_bamfile_glb, UMI_tag_glb, cellsdic
-    UMI_tag_glb = UMI_tag
-    INPUT_bamfile_glb = INPUT_bamfile
-    cells_barcode = [item[0] for item in cells]
+        Specify the number of cores for parallel computing when generating count matrix. Each core counts contiguous shards of features on one chromosome with its own persistent BAM handle.
+    barcode_tag: `str` (default: None)
+        Specify the BAM tag storing the cell barcode, e.g. 'CB:Z' for 10x scRNA-seq. If None, the cell barcode is taken from the read name before the first ':'.
+    count_mat_format: `str` (default: 'mtx')
+        Specify the format of the output count matrix. 'mtx' writes a gzipped Matrix Market file `count_mat_filename`.mtx.gz with feature and barcode sidecars `count_mat_filename`.features.txt and `count_mat_filename`.barcodes.txt; 'txt' exports the dense tab-delimited text matrix `count_mat_filename`.txt.
+    bam_threads: `int` (default: 2)
+        Specify the number of BGZF decompression threads of the BAM handle kept open by each counting process.
+    UMI_correction: `bool` (default: False)
+        If UMI_modeling is set to True, specify whether to merge each UMI into a UMI of the same cell and gene within Hamming distance 1 that is supported by more reads before counting.
+    """
+    cells_barcode = load_cell_barcodes(cells_barcode_file)
+    barcode_resolver = BarcodeResolver(cells_barcode, barcode_tag=barcode_tag)
     with open(bed_file) as open_peak:
         reader = csv.reader(open_peak, delimiter="\t")
         open_peak = np.asarray(list(reader))
     k = 0
-    cellsdic = defaultdict(lambda: [None])
-    for cell in cells_barcode:
-        cellsdic[cell] = k
-        k += 1
-    k = 0
     peaksdic = defaultdict(lambda: [None])
     for rec in open_peak:
         rec_name = '_'.join(rec)
@@ -367,35 +2403,45 @@ def scRNA_bam2countmat_paral(cells_barcode_file, bed_file, INPUT_bamfile, outdir
         k += 1
     cells_n = len(cells_barcode)
     peaks_n = len(open_peak)
+    feature_names = ['_'.join(rec[0:3]) for rec in open_peak]
     if UMI_modeling == True:
         print("[scReadSim] UMI Mode Detected.")
         print("[scReadSim] Generating UMI Count Matrix...")
-        UMI_countmat_array = Parallel(n_jobs=n_cores, backend='multiprocessing')(delayed(scRNA_UMIcountmat_mainloop)(rec_id) for rec_id in (range(len(open_peak))))
+        shards = [(chromosome, feature_idx, UMI_correction) for chromosome, feature_idx in feature_shards(open_peak, n_cores * 4)]
+        coo_list = run_count_workers(scRNA_UMIcountmat_shard, shards, (INPUT_bamfile, open_peak, barcode_resolver, UMI_tag, bam_threads), n_cores)
+        coo_feature, coo_cell, coo_count = [np.concatenate(x) for x in zip(*coo_list)]
         print("[scReadSim] Generated UMI Count Matrix.")
-        UMI_countmat = np.array(UMI_countmat_array)
-        print("[scReadSim] Writing UMI Count Matrix TXT File...")
-        with open("%s/%s.txt" % (outdirectory, count_mat_filename), 'w') as outsfile:
-            for rec_id in tqdm(range(len(open_peak))):
-                print("\t".join([str(x) for x in UMI_countmat[rec_id,:]]),file = outsfile)
+        print("[scReadSim] Writing UMI Count Matrix...")
+        countmat = CountMatrix.from_coo(feature_names, cells_barcode, coo_feature, coo_cell, coo_count, cells_n)
+        count_mat_file = write_countmat(countmat, "%s/%s" % (outdirectory, count_mat_filename), count_mat_format)
         print("[scReadSim] Created:")
-        print("[scReadSim] UMI Count Matrix %s.txt" % count_mat_filename)
+        print("[scReadSim] UMI Count Matrix %s" % count_mat_file)
     else:
         print("[scReadSim] Detected that UMI Mode Is Off.")
         print("[scReadSim] Generating Read Count Matrix...")
-        read_countmat_array = Parallel(n_jobs=n_cores, backend='multiprocessing')(delayed(countmat_mainloop)(rec_id) for rec_id in (range(len(open_peak))))
-        read_countmat = np.array(read_countmat_array)
-        print("[scReadSim] Writing Read Count Matrix TXT File...")
-        with open("%s/%s.txt" % (outdirectory, count_mat_filename), 'w') as outsfile:
-            for rec_id in tqdm(range(len(open_peak))):
-                print("\t".join([str(x) for x in read_countmat[rec_id,:]]),file = outsfile)
+        shard_results = run_count_workers(countmat_shard, feature_shards(open_peak, n_cores * 4), (INPUT_bamfile, open_peak, barcode_resolver, None, bam_threads), n_cores)
+        read_countmat_array = gather_shard_rows(shard_results, peaks_n)
+        print("[scReadSim] Writing Read Count Matrix...")
+        countmat = CountMatrix.from_rows(feature_names, cells_barcode, read_countmat_array, cells_n)
+        count_mat_file = write_countmat(countmat, "%s/%s" % (outdirectory, count_mat_filename), count_mat_format)
         print("[scReadSim] Created:")
-        print("[scReadSim] Read count matrix %s.txt" % count_mat_filename)
+        print("[scReadSim] Read count matrix %s" % count_mat_file)
     print("[scReadSim] Done.\n")
 
 
-def scATAC_bam2countmat_OutputPeak(cells_barcode_file, assignment_file, INPUT_bamfile, outdirectory, count_mat_filename):
+def source_region_index(open_peak):
+    """Return the index of the input region of each row of a peak assignment file (columns 4 to 6, see `FeatureMapping`), input regions being numbered in the order of chromosome, start and end. Rows with equal indices share their input region.
+
+    """
+    sources = pd.DataFrame({"chrom": open_peak[:,3], "start": open_peak[:,4].astype(np.int64), "end": open_peak[:,5].astype(np.int64)})
+    return sources.groupby(["chrom", "start", "end"], sort=True).ngroup().to_numpy()
+
+
+def scATAC_bam2countmat_OutputPeak(cells_barcode_file, assignment_file, INPUT_bamfile, outdirectory, count_mat_filename, barcode_tag=None, count_mat_format="mtx"):
     """Construct count matrix for task with user input features set. 
 
+    Output features assigned to the same input feature share its counts, so every input feature is fetched once, in coordinate order.
+
     Parameters
     ----------
     cells_barcode_file: `str`
@@ -408,70 +2454,40 @@ def scATAC_bam2countmat_OutputPeak(cells_barcode_file, assignment_file, INPUT_ba
         Specify the output directory of the count matrix file.
     count_mat_filename: `str`
         Specify the base name of output count matrix.
+    barcode_tag: `str` (default: None)
+        Specify the BAM tag storing the cell barcode, e.g. 'CB'. If None, the cell barcode is taken from the read name before the first ':'.
+    count_mat_format: `str` (default: 'mtx')
+        Specify the format of the output count matrix, 'mtx' (sparse Matrix Market with sidecars) or 'txt' (dense text).
     """
-    cells = pd.read_csv(cells_barcode_file, sep="\t", header=None)
-    cells = cells.values.tolist()
-    cells_barcode = [item[0] for item in cells]
-    with open("%s/%s.txt" % (outdirectory, count_mat_filename), 'w') as outsfile:
-        samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
-        with open(assignment_file) as open_peak:
-            reader = csv.reader(open_peak, delimiter="\t")
-            open_peak = np.asarray(list(reader))
-        k = 0
-        cellsdic = defaultdict(lambda: [None])
-        for cell in cells_barcode:
-            cellsdic[cell] = k
-            k += 1
-        k = 0
-        peaksdic = defaultdict(lambda: [None])
-        for rec in open_peak:
-            rec_name = '_'.join(rec)
-            peaksdic[rec_name] = k
-            k += 1
-        cells_n = len(cells_barcode)
-        peaks_n = len(open_peak)
-        # marginal_count_vec = [0] * len(open_peak)
-        print("[scReadSim] Generating count matrix...")
-        # for rec in open_peak:
-        for rec_id in tqdm(range(len(open_peak))):
-            rec = open_peak[rec_id]
-            rec_name = '_'.join(rec)
-            currcounts = [0]*cells_n
-            reads = samfile.fetch(rec[3], int(rec[4]), int(rec[5]))
-            for read in reads:
-                cell = read.qname.split(":")[0].upper()
-                if cell in cells_barcode:
-                    try:
-                        currcounts[cellsdic[cell]] += 1
-                    except KeyError:
-                        pass
-            # marginal_count_vec[rec_id] = sum(currcounts)
-            # if sum(currcounts) > 0:
-            print(rec_name + "\t" + "\t".join([str(x) for x in currcounts]),file = outsfile)
-
-
-def find_nearest_peak(array, value, k, ref_read_density):
-    """Find the index of largest-read-density input peak from `array` with a length similar to `value`.
-
-    """
-    array = np.asarray(array)
-    # idx = (np.abs(array - value)).argmin()   
-    idx = (np.abs(array - value)).argpartition(k)
-    idx_ReadDensity = ref_read_density[idx[:k]].argmax()
-    final_idx = idx[idx_ReadDensity]
-    return final_idx
-
-
-def find_nearest_nonpeak(array, value, k, ref_read_density):
-    """Find the index of largest-read-density input non-peak from `array` with a length similar to `value`.
-
-    """
-    array = np.asarray(array)
-    # idx = (np.abs(array - value)).argmin()   
-    idx = (np.abs(array - value)).argpartition(k)
-    idx_ReadDensity = ref_read_density[idx[:k]].argmin()
-    final_idx = idx[idx_ReadDensity]
-    return final_idx
+    cells_barcode = load_cell_barcodes(cells_barcode_file)
+    barcode_resolver = BarcodeResolver(cells_barcode, barcode_tag=barcode_tag)
+    samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+    with open(assignment_file) as open_peak:
+        reader = csv.reader(open_peak, delimiter="\t")
+        open_peak = np.asarray(list(reader))
+    cells_n = len(cells_barcode)
+    feature_names = ['_'.join(rec) for rec in open_peak]
+    source_idx = source_region_index(open_peak)
+    # First row of each input region
+    source_first_row = np.full(source_idx.max() + 1 if len(source_idx) > 0 else 0, len(source_idx))
+    np.minimum.at(source_first_row, source_idx, np.arange(len(source_idx)))
+    source_rows = []
+    print("[scReadSim] Generating count matrix...")
+    for rec_id in tqdm(source_first_row.tolist()):
+        rec = open_peak[rec_id]
+        counter = Counter()
+        reads = samfile.fetch(rec[3], int(rec[4]), int(rec[5]))
+        for read in reads:
+            cell_idx = barcode_resolver.cell_index(read)
+            if cell_idx >= 0:
+                counter[cell_idx] += 1
+        source_rows.append((list(counter.keys()), list(counter.values())))
+    samfile.close()
+    count_rows = [source_rows[k] for k in source_idx.tolist()]
+    countmat = CountMatrix.from_rows(feature_names, cells_barcode, count_rows, cells_n)
+    count_mat_file = write_countmat(countmat, "%s/%s" % (outdirectory, count_mat_filename), count_mat_format)
+    print("[scReadSim] Created:")
+    print("[scReadSim] Read Count Matrix: %s" % count_mat_file)
 
 
 def fragment_length(open_peak):
@@ -479,84 +2495,169 @@ def fragment_length(open_peak):
 	return output
 
 
-def match_peak(MarginalCountList, output_peaks, input_peaks, outdirectory, assignment_file, n_top):
-    """Map from output peaks to input peaks according to the similarity of peak length. 
+def nearest_length_candidates(sorted_length, query_length, k):
+    """Find, for each query length, the positions in `sorted_length` of the `k` input features with the most similar length.
+
+    The `k` nearest lengths lie within `k` positions of the query's insertion point, so only that window is scanned. Ties in length difference are resolved by window position.
+
+    Return
+    ------
+    candidates: `numpy.ndarray`
+        Matrix of shape (number of queries, `k`) of positions in `sorted_length`.
+    """
+    n_ref = len(sorted_length)
+    window = np.searchsorted(sorted_length, query_length)[:,None] + np.arange(-k, k)
+    in_range = (window >= 0) & (window < n_ref)
+    window = np.clip(window, 0, n_ref - 1)
+    length_diff = np.abs(sorted_length[window] - query_length[:,None])
+    length_diff[~in_range] = np.iinfo(np.int64).max // (4 * k)
+    rank_key = length_diff * (2 * k) + np.arange(2 * k)
+    nearest = np.argpartition(rank_key, k - 1, axis=1)[:,:k]
+    return np.take_along_axis(window, nearest, axis=1)
+
+
+def match_features(MarginalCountList, output_features, input_features, outdirectory, assignment_file, n_top, densest=True, batch_size=65536):
+    """Map each output feature to an input feature: among the `n_top` input features with the most similar length, pick the one with the largest (`densest` = True) or smallest read density. Ties in density go to the input feature listed first.
 
+    Input features are sorted by length once and output features are mapped in vectorized batches, then the mapping file is written at once.
     """
-    with open("%s" % (output_peaks)) as true_peak_file:
+    with open("%s" % (output_features)) as true_peak_file:
         reader = csv.reader(true_peak_file, delimiter="\t")
-        true_peak_set = np.asarray(list(reader))
-    with open("%s" % (input_peaks)) as ref_peak_file:
+        true_peak_set = np.asarray([rec[0:3] for rec in reader]).reshape(-1, 3)
+    with open("%s" % (input_features)) as ref_peak_file:
         reader = csv.reader(ref_peak_file, delimiter="\t")
-        ref_peak_set = np.asarray(list(reader))
+        ref_peak_set = np.asarray([rec[0:3] for rec in reader]).reshape(-1, 3)
     ref_marginal_count = np.asarray(MarginalCountList)
     ref_peak_fraglen = fragment_length(ref_peak_set)
     ref_read_density = ref_marginal_count.astype(int) / ref_peak_fraglen
-    # ref_peak_fraglen.view('i8,i8,i8').sort(order=['f0'], axis=0)
-    n_top_select = min(len(ref_marginal_count)-1, n_top)
-    with open("%s/%s" % (outdirectory, assignment_file), 'w') as outsfile:
-        for true_peak_id in tqdm(range(len(true_peak_set))):
-            true_peak = true_peak_set[true_peak_id]
-            true_length = int(true_peak[2]) - int(true_peak[1])
-            idx = find_nearest_peak(ref_peak_fraglen, true_length, n_top_select, ref_read_density)
-            print("\t".join(true_peak[0:3]) + '\t' + "\t".join(ref_peak_set[idx][0:3]), file=outsfile)
+    k = max(1, min(len(ref_marginal_count)-1, n_top))
+    length_order = np.argsort(ref_peak_fraglen, kind="stable")
+    sorted_length = ref_peak_fraglen[length_order].astype(np.int64)
+    true_length = true_peak_set[:,2].astype(np.int64) - true_peak_set[:,1].astype(np.int64)
+    assigned = np.empty(len(true_peak_set), dtype=np.int64)
+    for lo in tqdm(range(0, len(true_peak_set), batch_size)):
+        candidates = nearest_length_candidates(sorted_length, true_length[lo:lo + batch_size], k)
+        candidates = np.sort(length_order[candidates], axis=1)
+        candidate_density = ref_read_density[candidates]
+        best = candidate_density.argmax(axis=1) if densest else candidate_density.argmin(axis=1)
+        assigned[lo:lo + batch_size] = candidates[np.arange(len(candidates)), best]
+    assignment = pd.DataFrame(np.hstack((true_peak_set, ref_peak_set[assigned])))
+    assignment.to_csv("%s/%s" % (outdirectory, assignment_file), sep="\t", header=False, index=False)
+
+
+def match_peak(MarginalCountList, output_peaks, input_peaks, outdirectory, assignment_file, n_top):
+    """Map from output peaks to input peaks according to the similarity of peak length. 
+
+    """
+    match_features(MarginalCountList, output_peaks, input_peaks, outdirectory, assignment_file, n_top, densest=True)
 
 
 def match_nonpeak(MarginalCountList ,output_nonpeaks, input_nonpeaks, outdirectory, assignment_file, n_top):
     """Map from output non-peaks to input non-peaks according to the similarity of peak length. 
 
     """
-    with open("%s" % (output_nonpeaks)) as true_peak_file:
-        reader = csv.reader(true_peak_file, delimiter="\t")
-        true_peak_set = np.asarray(list(reader))
-    with open("%s" % (input_nonpeaks)) as ref_peak_file:
-        reader = csv.reader(ref_peak_file, delimiter="\t")
-        ref_peak_set = np.asarray(list(reader))
-    ref_marginal_count = np.asarray(MarginalCountList)
-    ref_peak_fraglen = fragment_length(ref_peak_set)
-    ref_read_density = ref_marginal_count.astype(int) / ref_peak_fraglen
-    n_top_select = min(len(ref_marginal_count)-1, n_top)
-    # ref_peak_fraglen.view('i8,i8,i8').sort(order=['f0'], axis=0)
-    with open("%s/%s" % (outdirectory, assignment_file), 'w') as outsfile:
-        for true_peak_id in tqdm(range(len(true_peak_set))):
-            true_peak = true_peak_set[true_peak_id]
-            true_length = int(true_peak[2]) - int(true_peak[1])
-            idx = find_nearest_nonpeak(ref_peak_fraglen, true_length, n_top_select, ref_read_density)
-            print("\t".join(true_peak[0:3]) + '\t' + "\t".join(ref_peak_set[idx][0:3]), file=outsfile)
+    match_features(MarginalCountList, output_nonpeaks, input_nonpeaks, outdirectory, assignment_file, n_top, densest=False)
 
 
-def bam2MarginalCount(bed_file, sam_filename):
-    """Count read overlapped for each feature from input bed file. 
+def bam_identity(sam_filename):
+    """Return a key identifying the current content of a BAM file from its path, size and modification time.
 
     """
-    samfile = pysam.AlignmentFile(sam_filename, "rb")
-    with open("%s" % (bed_file)) as open_peak:
-        reader = csv.reader(open_peak, delimiter="\t")
-        open_peak = np.asarray(list(reader))
-    k = 0
-    peaksdic = defaultdict(lambda: [None])
-    for rec in open_peak:
-        rec_name = '_'.join(rec)
-        peaksdic[rec_name] = k
-        k += 1
-    peaks_n = len(open_peak)
-    MarginalCountList = np.empty((peaks_n), dtype="int")
+    bam_stat = os.stat(sam_filename)
+    identity = "%s\t%d\t%d" % (os.path.realpath(sam_filename), bam_stat.st_size, bam_stat.st_mtime_ns)
+    return hashlib.sha1(identity.encode()).hexdigest()
+
+
+def file_content_hash(filename):
+    """Return the SHA-1 digest of a file's content.
+
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def marginal_cache_file(cache_directory, bed_file, sam_filename):
+    """Return the path of the cached marginal counts of `bed_file` on `sam_filename`.
+
+    """
+    return "%s/scReadSim.MarginalCount.%s.%s.npy" % (cache_directory, bam_identity(sam_filename)[:16], file_content_hash(bed_file)[:16])
+
+
+def bam2MarginalCounts(bed_files, sam_filename, cache_directory=None, n_cores=1):
+    """Count reads overlapping each feature of several bed files with a single sweep of the BAM file.
+
+    Parameters
+    ----------
+    bed_files: `list`
+        Feature bed files.
+    sam_filename: `str`
+        Coordinate-sorted and indexed BAM file.
+    cache_directory: `str` (default: None)
+        Directory of the marginal count cache. Counts are cached per BAM file and bed file content, so repeated calls do not rescan the BAM file. If None, nothing is cached.
+    n_cores: `int` (default: 1)
+        Number of cores for the sweep.
+
+    Return
+    ------
+    MarginalCountLists: `list`
+        Marginal count vector of each bed file.
+    """
+    MarginalCountLists = [None] * len(bed_files)
+    cache_files = [None] * len(bed_files)
+    for k, bed_file in enumerate(bed_files):
+        if cache_directory is None:
+            continue
+        cache_files[k] = marginal_cache_file(cache_directory, bed_file, sam_filename)
+        if os.path.exists(cache_files[k]):
+            print("[scReadSim] Loading cached marginal counts of %s..." % bed_file)
+            MarginalCountLists[k] = np.load(cache_files[k])
+    todo = [k for k in range(len(bed_files)) if MarginalCountLists[k] is None]
+    if len(todo) == 0:
+        return MarginalCountLists
+    feature_sets = []
+    for k in todo:
+        with open("%s" % (bed_files[k])) as open_peak:
+            reader = csv.reader(open_peak, delimiter="\t")
+            feature_sets.append(np.asarray([rec[0:3] for rec in reader]).reshape(-1, 3))
+    open_peak = np.concatenate(feature_sets)
     print("[scReadSim] Converting marginal count vector...")
-    # for rec in open_peak:
-    for rec_id in tqdm(range(len(open_peak))):
-        rec = open_peak[rec_id]
-        rec_name = '_'.join(rec)
-        currcounts =  0
-        reads = samfile.fetch(rec[0], int(rec[1]), int(rec[2]))
-        for read in reads:
-            currcounts += 1
-        # if sum(currcounts) > 0:
-        MarginalCountList[rec_id] = int(currcounts)
-        # print(rec_name + "\t" + str(currcounts),file = outsfile)
-    return MarginalCountList
+    shards = [(chromosome, feature_idx, "read", False) for chromosome, feature_idx in feature_shards(open_peak, n_cores * 4)]
+    coo_list = run_count_workers(sweep_countmat_shard, shards, (sam_filename, open_peak, None, None, 1), n_cores)
+    coo_feature = np.concatenate([np.zeros(0, dtype=np.int64)] + [x[0] for x in coo_list])
+    coo_count = np.concatenate([np.zeros(0, dtype=np.int64)] + [x[2] for x in coo_list])
+    marginal_count = np.bincount(coo_feature, weights=coo_count, minlength=len(open_peak)).astype(int)
+    offset = 0
+    for k, feature_set in zip(todo, feature_sets):
+        MarginalCountLists[k] = marginal_count[offset:offset + len(feature_set)]
+        offset += len(feature_set)
+        if cache_files[k] is not None:
+            np.save(cache_files[k], MarginalCountLists[k])
+    return MarginalCountLists
+
+
+def bam2MarginalCount(bed_file, sam_filename, cache_directory=None, n_cores=1):
+    """Count read overlapped for each feature from input bed file. 
+
+    """
+    return bam2MarginalCounts([bed_file], sam_filename, cache_directory, n_cores)[0]
 
 
-def FeatureMapping(INPUT_bamfile, input_peaks, input_nonpeaks, output_peaks, output_nonpeaks, outdirectory, assignment_peak_file, assignment_nonpeak_file, n_top=50):
+def countmat2MarginalCount(count_mat_file, bed_file):
+    """Obtain the marginal count of each feature from an already constructed count matrix of `bed_file`.
+
+    """
+    countmat = read_countmat(count_mat_file)
+    with open(bed_file) as open_peak:
+        peaks_n = sum(1 for rec in csv.reader(open_peak, delimiter="\t"))
+    if countmat.n_feature != peaks_n:
+        sys.exit("[ERROR] Count matrix %s has %d features while %s has %d." % (count_mat_file, countmat.n_feature, bed_file, peaks_n))
+    return countmat.row_sums()
+
+
+def FeatureMapping(INPUT_bamfile, input_peaks, input_nonpeaks, output_peaks, output_nonpeaks, outdirectory, assignment_peak_file, assignment_nonpeak_file, n_top=50, n_cores=1, input_peak_countmat_file=None, input_nonpeak_countmat_file=None, marginal_cache=True):
     """Obtain mappings between input and output peaks, input and output non-peaks. The mappings are output as `assignment_peak_file` and `assignment_nonpeak_file` within `outdirectory`.  
 
     Parameters
@@ -579,11 +2680,27 @@ def FeatureMapping(INPUT_bamfile, input_peaks, input_nonpeaks, output_peaks, out
         Specify the name of nonpeak mapping file.
     n_top: 'int'(default: 50)
         Specify the number of input peaks (or non-peaks) with the most similar length as the candidate mapped input peaks (or non-peaks) for each the output peak (or non-peak). From the candidate input peaks (or non-peaks), scReadSim further selects the one with largest read density for peak mapping (smallest read density for non-peak mapping).
+    n_cores: `int` (default: 1)
+        Specify the number of cores for counting reads of the input peaks and non-peaks.
+    input_peak_countmat_file: `str` (default: None)
+        Count matrix already constructed for `input_peaks`, e.g. by function `Utility.scATAC_bam2countmat_paral`. If specified, the read counts of input peaks are taken from its row sums instead of the BAM file. Note that the count matrix only counts reads from listed cells.
+    input_nonpeak_countmat_file: `str` (default: None)
+        Count matrix already constructed for `input_nonpeaks`, used like `input_peak_countmat_file`.
+    marginal_cache: `bool` (default: True)
+        Specify whether to cache the read counts of input peaks and non-peaks in `outdirectory`, keyed by the BAM file and the bed file content, so that repeated mappings (e.g. with a different `n_top` or output peak set) do not rescan the BAM file.
     """
-    peak_MarginalCountList = bam2MarginalCount(input_peaks, INPUT_bamfile)
+    bed_files = [bed_file for bed_file, countmat_file in ((input_peaks, input_peak_countmat_file), (input_nonpeaks, input_nonpeak_countmat_file)) if countmat_file is None]
+    MarginalCountLists = bam2MarginalCounts(bed_files, INPUT_bamfile, outdirectory if marginal_cache else None, n_cores)
+    if input_peak_countmat_file is None:
+        peak_MarginalCountList = MarginalCountLists.pop(0)
+    else:
+        peak_MarginalCountList = countmat2MarginalCount(input_peak_countmat_file, input_peaks)
+    if input_nonpeak_countmat_file is None:
+        nonpeak_MarginalCountList = MarginalCountLists.pop(0)
+    else:
+        nonpeak_MarginalCountList = countmat2MarginalCount(input_nonpeak_countmat_file, input_nonpeaks)
     print("[scReadSim] Mapping Input Peaks and Output Peaks...")
     match_peak(peak_MarginalCountList, output_peaks, input_peaks, outdirectory, assignment_peak_file, n_top)
-    nonpeak_MarginalCountList = bam2MarginalCount(input_nonpeaks, INPUT_bamfile)
     print("[scReadSim] Mapping Input Non-Peaks and Output Non-Peaks...")
     match_nonpeak(nonpeak_MarginalCountList, output_nonpeaks, input_nonpeaks, outdirectory, assignment_nonpeak_file, n_top)
     print('[scReadSim] Created:')
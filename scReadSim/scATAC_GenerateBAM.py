@@ -4,10 +4,10 @@ import csv
 import collections
 import os
 pd.options.mode.chained_assignment = None  # default='warn'
-import random
 import subprocess
 from tqdm import tqdm
 import pysam
+import scReadSim.Utility as Utility
 
 def flatten(x):
     """Flatten a nested list.
@@ -19,36 +19,261 @@ def flatten(x):
         return [x]
 
 
-def cellbarcode_generator(length, size=10):
-	"""Generate random cellbarcode.
+def cellbarcode_generator(length, size=10, rng=None, whitelist=None, min_distance=1, groups=None):
+	"""Generate distinct random cell barcodes or UMIs (see `Utility.generate_barcodes`).
+
+	Parameters
+	----------
+	length: `int`
+		Number of cells.
+	size: `int` (default: '10')
+		Size of cell barcode. Default value is 10 bp.
+	rng: `numpy.random.Generator` (default: None)
+		Random generator to draw the barcodes from. If None, use a generator seeded with 2022.
+	whitelist: `str` (default: None)
+		Barcode whitelist file to sample the barcodes from.
+	min_distance: `int` (default: 1)
+		Minimum Hamming distance between any two barcodes.
+	groups: `numpy.ndarray` (default: None)
+		Group index of each barcode, e.g. the cell of each UMI, if barcodes only need to be distinct within their group.
+
+	Return
+	------
+	cb_list: `list`
+		List of randomly generated cell barcodes.
+	"""
+	return Utility.generate_barcodes(length, size, rng, whitelist, min_distance, groups)
+
+
+def find_leftnearest_nonpeaks(non_peak_list, gray_area_set):
+    """Assign every gray area to the non-peak on its chromosome whose end is nearest to the gray area's start, preferring the left neighbour on ties.
+
+    Non-peak ends are sorted once per chromosome, and all gray areas of a chromosome are looked up with one `searchsorted`.
 
     Parameters
     ----------
-    length: `int`
-        Number of cells.
-    size: `int` (default: '10')
-        Size of cell barcode. Default value is 10 bp.
+    non_peak_list: `numpy.ndarray`
+        Non-peak records (chromosome, start, end).
+    gray_area_set: `numpy.ndarray`
+        Gray area records (chromosome, start, end).
 
     Return
     ------
-    cb_list: `list`
-        List of randomly generated cell barcodes.
+    nonpeak_idx: `numpy.ndarray`
+        Row of `non_peak_list` assigned to each gray area, or -1 for gray areas on chromosomes without non-peaks.
     """
-	chars = 'ACGT'
-	cb_list = [''.join(random.choice(chars) for _ in range(size)) for cell in range(length)]
-	return cb_list
+    nonpeak_idx = np.full(len(gray_area_set), -1, dtype=np.int64)
+    if len(non_peak_list) == 0 or len(gray_area_set) == 0:
+        return nonpeak_idx
+    nonpeak_end = non_peak_list[:,2].astype(np.int64)
+    gray_start = gray_area_set[:,1].astype(np.int64)
+    for chrom in np.unique(gray_area_set[:,0]):
+        chrom_nonpeak = np.nonzero(non_peak_list[:,0] == chrom)[0]
+        if len(chrom_nonpeak) == 0:
+            continue
+        chrom_nonpeak = chrom_nonpeak[np.argsort(nonpeak_end[chrom_nonpeak], kind="stable")]
+        sorted_end = nonpeak_end[chrom_nonpeak]
+        chrom_gray = np.nonzero(gray_area_set[:,0] == chrom)[0]
+        right = np.searchsorted(sorted_end, gray_start[chrom_gray], side="right")
+        # Left neighbour: the first non-peak (in file order) with the largest end not after the gray area's start
+        left = np.searchsorted(sorted_end, sorted_end[np.maximum(right - 1, 0)], side="left")
+        left_dist = np.where(right > 0, gray_start[chrom_gray] - sorted_end[left], np.inf)
+        right_dist = np.where(right < len(sorted_end), sorted_end[np.minimum(right, len(sorted_end) - 1)] - gray_start[chrom_gray], np.inf)
+        nonpeak_idx[chrom_gray] = chrom_nonpeak[np.where(left_dist <= right_dist, left, np.minimum(right, len(sorted_end) - 1))]
+    return nonpeak_idx
+
 
+def scale_gray_area_counts(count_mat, non_peak_list, gray_area_set, nonpeak_idx, rng):
+    """Compute the synthetic count matrix of gray areas from the synthetic counts of their assigned non-peaks.
 
-def find_leftnearest_nonpeak(non_peak_list, gray_peak):
-	"""Find the gray peak's left nearest non-peak from a non-peak list.
+    Each nonzero count of the assigned non-peak is kept with probability min(gray area length / non-peak length, 1). One binomial mask is drawn for all nonzero counts at once.
+
+    Parameters
+    ----------
+    count_mat: `Utility.CountMatrix`
+        Synthetic count matrix of the non-peaks.
+    non_peak_list: `numpy.ndarray`
+        Non-peak records (chromosome, start, end).
+    gray_area_set: `numpy.ndarray`
+        Gray area records (chromosome, start, end).
+    nonpeak_idx: `numpy.ndarray`
+        Assigned non-peak of each gray area, see `find_leftnearest_nonpeaks`.
+    rng: `numpy.random.Generator`
+        Random generator of the mask.
 
+    Return
+    ------
+    grey_countmat: `Utility.CountMatrix`
+        Synthetic count matrix of the gray areas, with rows named '<chromosome>_<start>_<end>'.
     """
-	dist1 = np.abs(non_peak_list[:,2].astype(int) - int(gray_peak[1]))
-	id = dist1.argmin()
-	return id
+    has_nonpeak = nonpeak_idx >= 0
+    grey_length = gray_area_set[:,2].astype(np.int64) - gray_area_set[:,1].astype(np.int64)
+    nonpeak_length = np.ones(len(gray_area_set), dtype=np.int64)
+    nonpeak_length[has_nonpeak] = non_peak_list[nonpeak_idx[has_nonpeak],2].astype(np.int64) - non_peak_list[nonpeak_idx[has_nonpeak],1].astype(np.int64)
+    keep_prob = np.minimum(grey_length / np.maximum(nonpeak_length, 1), 1)
+    row_start = np.where(has_nonpeak, count_mat.indptr[np.maximum(nonpeak_idx, 0)], 0)
+    row_len = np.where(has_nonpeak, np.diff(count_mat.indptr)[np.maximum(nonpeak_idx, 0)], 0)
+    coo_gray = np.repeat(np.arange(len(gray_area_set)), row_len)
+    entry = np.repeat(row_start, row_len) + np.arange(len(coo_gray)) - np.repeat(np.cumsum(row_len) - row_len, row_len)
+    mask = rng.binomial(1, keep_prob[coo_gray])
+    return Utility.CountMatrix.from_coo(['_'.join(grey_area) for grey_area in gray_area_set], None, coo_gray, count_mat.indices[entry], count_mat.data[entry] * mask, count_mat.n_cell)
+
+
+def synthesize_read_pairs(template_sampled, count_frag_vec, read_synthetic_start, jitter_value_vec, read_len):
+    """Compute synthetic read pairs from sampled read templates.
 
+    Parameters
+    ----------
+    template_sampled: `numpy.ndarray`
+        Sampled read templates, one row per synthetic read pair (see `Utility.TemplateStore.templates`).
+    count_frag_vec: `numpy.ndarray`
+        Number of synthetic read pairs of each cell. Sums to the number of rows of `template_sampled`.
+    read_synthetic_start: `numpy.ndarray`
+        Start position of each synthetic read, before jitter.
+    jitter_value_vec: `numpy.ndarray`
+        Random shift of each synthetic read pair.
+    read_len: `int`
+        Length of synthetic reads. Reads whose mate starts at the same position keep their real aligned length.
 
-def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=50, random_noise_mode=False, GrayAreaModeling=False):
+    Return
+    ------
+    read_pairs: `dict`
+        Arrays 'cell_idx', 'frag_no', 'read_length', 'r1_start', 'r1_end', 'r1_strand', 'r2_start', 'r2_end' and 'r2_strand' with one entry per synthetic read pair. Pairs with a negative read 1 or read 2 start are removed.
+    """
+    template_sampled = np.asarray(template_sampled, dtype=np.int64).reshape(-1, 5)
+    count_frag_vec = np.asarray(count_frag_vec, dtype=np.int64)
+    cell_idx = np.repeat(np.arange(len(count_frag_vec)), count_frag_vec)
+    frag_no = np.arange(len(cell_idx)) - np.repeat(np.cumsum(count_frag_vec) - count_frag_vec, count_frag_vec)
+    read_length = np.where(template_sampled[:, 0] == template_sampled[:, 1], np.abs(template_sampled[:, 2]), read_len)
+    read_start = read_synthetic_start + jitter_value_vec
+    mate_start = template_sampled[:, 1] + read_synthetic_start - template_sampled[:, 0] + jitter_value_vec
+    strand = template_sampled[:, 4]
+    is_read1 = template_sampled[:, 3] == 1
+    r1_start = np.where(is_read1, read_start, mate_start)
+    r2_start = np.where(is_read1, mate_start, read_start)
+    r1_strand = np.where(is_read1, strand, -strand)
+    keep = (r1_start >= 0) & (r2_start >= 0)
+    return {
+        'cell_idx': cell_idx[keep],
+        'frag_no': frag_no[keep],
+        'read_length': read_length[keep],
+        'r1_start': r1_start[keep],
+        'r1_end': r1_start[keep] + read_length[keep],
+        'r1_strand': r1_strand[keep],
+        'r2_start': r2_start[keep],
+        'r2_end': r2_start[keep] + read_length[keep],
+        'r2_strand': -r1_strand[keep]
+        }
+
+
+def sample_read_pairs(rng, templates, count_vec, jitter_size, read_len, random_noise_mode, region_start, region_end, shift_number=0):
+    """Sample synthetic read pairs of a feature from its read templates and synthetic counts.
+
+    Parameters
+    ----------
+    rng: `numpy.random.Generator`
+        Random generator of the feature (see `Utility.feature_rng`).
+    templates: `numpy.ndarray`
+        Read templates of the feature (see `Utility.TemplateStore.region_templates`).
+    count_vec: `numpy.ndarray`
+        Synthetic read count of each cell. Each cell gets ceil(count / 2) read pairs.
+    jitter_size: `int`
+        Range of random shift of the read pairs.
+    read_len: `int`
+        Length of synthetic reads.
+    random_noise_mode: `bool`
+        Whether to draw read starts uniformly from [`region_start`, `region_end`).
+    region_start: `int`
+        Start of the region the synthetic reads are generated for.
+    region_end: `int`
+        End of the region the synthetic reads are generated for.
+    shift_number: `int` (default: 0)
+        Offset added to the template starts, when the templates come from another region.
+
+    Return
+    ------
+    read_pairs: `dict`
+        Synthetic read pairs, see `synthesize_read_pairs`.
+    npair_read_synthetic: `int`
+        Number of read pairs sampled, including pairs removed for a negative start.
+    """
+    count_frag_vec = np.ceil(np.asarray(count_vec) / 2).astype(np.int64)
+    npair_read_synthetic = int(count_frag_vec.sum())
+    template_sampled = templates[rng.integers(len(templates), size=npair_read_synthetic)]
+    # Sample starting position if random noise mode is on, or use real read starting position
+    if random_noise_mode == True:
+        read_synthetic_start = rng.integers(region_start, region_end, size=npair_read_synthetic)
+    else:
+        read_synthetic_start = template_sampled[:, 0] + shift_number
+    # Add jitter size to read positions
+    jitter_value_vec = rng.integers(-jitter_size, jitter_size, size=npair_read_synthetic)
+    return synthesize_read_pairs(template_sampled, count_frag_vec, read_synthetic_start, jitter_value_vec, read_len), npair_read_synthetic
+
+
+def read_pair_bed_lines(chrom, read_pairs, cellbarcode_list, target_peak_concat):
+    """Format synthetic read pairs as read 1 and read 2 BED lines, named '<cell barcode>:CellNo<cell number>:<target region>#<pair number>'.
+
+    """
+    name_prefix = {cell: "%s:CellNo%d:%s#" % (cellbarcode_list[cell], cell + 1, target_peak_concat) for cell in np.unique(read_pairs['cell_idx']).tolist()}
+    read_names = ["%s%04d" % (name_prefix[cell], frag_no) for cell, frag_no in zip(read_pairs['cell_idx'].tolist(), read_pairs['frag_no'].tolist())]
+    read_length = read_pairs['read_length'].tolist()
+    read1_lines = ["%s\t%d\t%d\t%s\t%d\t%s\n" % (chrom, start, end, name, length, '+' if strand == 1 else '-') for start, end, name, length, strand in zip(read_pairs['r1_start'].tolist(), read_pairs['r1_end'].tolist(), read_names, read_length, read_pairs['r1_strand'].tolist())]
+    read2_lines = ["%s\t%d\t%d\t%s\t%d\t%s\n" % (chrom, start, end, name, length, '+' if strand == 1 else '-') for start, end, name, length, strand in zip(read_pairs['r2_start'].tolist(), read_pairs['r2_end'].tolist(), read_names, read_length, read_pairs['r2_strand'].tolist())]
+    return ''.join(read1_lines), ''.join(read2_lines)
+
+
+# Random stream keys of gray areas: read sampling of each gray area, and the count mask of all gray areas
+GRAY_AREA_RNG_STREAM = 1
+GRAY_AREA_MASK_RNG_STREAM = 2
+
+
+def scATAC_GenerateBAMCoord_shard(shard):
+    """Generate the synthetic read pairs of one shard of features into read 1 and read 2 bed files, sampling from the read template store of a worker set up by `Utility.synthesis_worker_init`, without a BAM handle.
+
+    The shard is a tuple (feature_ids, bed_files, file_mode, settings), see `Utility.run_synthesis_shards`. `settings` holds the synthesis options, with 'feature_mode' set to 'peak' for features of a bed file, 'output' for the rows of a peak assignment file and 'gray' for gray areas, whose counts come from the gray area count matrix (see `scale_gray_area_counts`). Each feature samples from its own random generator, keyed by its index. In 'output' mode, the templates of input peaks are kept in the worker's `Utility.TemplateCache` of settings['template_cache_size'] templates, shared by its shards.
+    """
+    feature_ids, bed_files, file_mode, settings = shard
+    feature_mode = settings["feature_mode"]
+    worker_state = Utility.count_worker_state
+    template_store = worker_state["template_store"]
+    if feature_mode == "output":
+        if "template_cache" not in worker_state:
+            worker_state["template_cache"] = Utility.TemplateCache(template_store, settings["template_cache_size"])
+        template_store = worker_state["template_cache"]
+    count_mat = worker_state["count_mat"]
+    open_peak = worker_state["open_peak"]
+    with Utility.BufferedFileWriter(bed_files, flush_size=settings["flush_size"], mode=file_mode) as bed_writer:
+        for feature_ind in feature_ids:
+            shift_number = 0
+            if feature_mode == "gray":
+                rec = worker_state["grey_area_set"][feature_ind]
+                rng = Utility.feature_rng(settings["random_seed"], feature_ind, GRAY_AREA_RNG_STREAM)
+                count_vec = worker_state["grey_countmat"].row(feature_ind) # Scaled synthetic count of the gray area
+                source_region = rec
+            else:
+                rec = open_peak[feature_ind]
+                rng = Utility.feature_rng(settings["random_seed"], feature_ind)
+                count_vec = count_mat.row(feature_ind) # Synthetic umi count
+                source_region = rec
+                if feature_mode == "output":
+                    if int(rec[2]) - int(rec[1]) == 0:
+                        print("Peak %s has identical start and end position. Skip." % '_'.join(rec))
+                        continue
+                    # Extract reads from true peaks
+                    source_region = rec[3:6]
+                    shift_number = int(rec[1]) - int(rec[4])
+            templates = template_store.region_templates(source_region[0], int(source_region[1]), int(source_region[2]))
+            if len(templates) == 0: # If no real reads exist in the peak, skip
+                continue
+            read_pairs, npair_read_synthetic = sample_read_pairs(rng, templates, count_vec, settings["jitter_size"], settings["read_len"], settings["random_noise_mode"], int(rec[1]), int(rec[2]), shift_number=shift_number)
+            if len(read_pairs['cell_idx']) != npair_read_synthetic:
+                print("[Warning] Synthetic read pair for Peak %s %s has read 1 or read 2 start position negative: synthetic read pair removed!" % (feature_ind, '_'.join(rec)))
+                print("Target read pair %s | Sample synthetic read pair %s" % (npair_read_synthetic, len(read_pairs['cell_idx'])))
+            target_peak_concat = rec[0] + ":" + str(rec[1]) + "-" + str(rec[2])
+            bed_writer.write(*read_pair_bed_lines(rec[0], read_pairs, worker_state["cellbarcode_list"], target_peak_concat))
+
+
+def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=50, random_noise_mode=False, GrayAreaModeling=False, flush_size=16777216, n_cores=1, random_seed=2022, template_store_directory=None, sort_memory="1G", compress=False, compress_threads=1, cellbarcode_whitelist_file=None, cellbarcode_min_distance=1):
     """Generate Synthetic reads in BED format. 
 
     Parameters
@@ -56,7 +281,7 @@ def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file,
     bed_file: `str`
         Features' bed file to generate the synthetic reads (Generated by function `Utility.scATAC_CreateFeatureSets`).
     count_mat_file: `str`
-        The path to the synthetic count matrix generated by `GenerateSyntheticCount.scATAC_GenerateSyntheticCount`.
+        The path to the synthetic count matrix generated by `GenerateSyntheticCount.scATAC_GenerateSyntheticCount`, either a Matrix Market file ('.mtx' or '.mtx.gz') with its '.features.txt' sidecar or a dense text matrix.
 	synthetic_cell_label_file: `str`
         Synthetic cell label file generated by `scATAC_GenerateSyntheticCount`.
     read_bedfile_prename: `str`
@@ -75,19 +300,34 @@ def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file,
         Specify whether to use a uniform distribution of reads.
     GrayAreaModeling: `bool` (default: 'False')
         Specify whether to generate synthetic reads for Gray Areas using non-peak counts. Do not specify 'True' when generating reads for peaks.
+    flush_size: `int` (default: 16777216)
+        Number of characters of synthetic reads buffered in memory before the bed files are written.
+    n_cores: `int` (default: 1)
+        Number of processes generating synthetic reads. The output does not depend on the number of processes.
+    random_seed: `int` (default: 2022)
+        Root seed of the random generators. Each feature samples from its own generator seeded by `random_seed` and the feature index.
+    template_store_directory: `str` (default: None)
+        Directory of the read template store of `INPUT_bamfile` (see `Utility.load_template_store`). The store is built with one pass over the BAM file on first use and reused by later runs on the same BAM file. If None, use `outdirectory`.
+    sort_memory: `str` (default: '1G')
+        Memory budget of sorting the output bed files by coordinate (see `Utility.sort_bed`). Read pairs are sorted by read 1.
+    compress: `bool` (default: False)
+        Whether to write BGZF-compressed bed files ('.read1.bed.gz' and '.read2.bed.gz', the read 1 bed file being tabix-indexed) and gray area count matrix.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of each compressed file.
+    cellbarcode_whitelist_file: `str` (default: None)
+        Barcode whitelist file, e.g. the 10x Genomics whitelist, to sample the 16 bp synthetic cell barcodes from (see `Utility.generate_barcodes`). If None, cell barcodes are drawn at random.
+    cellbarcode_min_distance: `int` (default: 1)
+        Minimum Hamming distance between any two synthetic cell barcodes. Cell barcodes are always distinct.
     """
-    count_mat_df = pd.read_csv("%s" % (count_mat_file), header=None, delimiter="\t")
-	# Remove count matrix first column: feature names
-    count_mat = count_mat_df.iloc[: , 1:].to_numpy()
+    count_mat = Utility.read_countmat(count_mat_file)
     count_mat_cluster = pd.read_csv(synthetic_cell_label_file, header=None, delimiter="\t").to_numpy().flatten()	
-    n_cell = np.shape(count_mat)[1]
-    samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+    n_cell = count_mat.n_cell
     with open(bed_file) as file:
         reader = csv.reader(file, delimiter="\t")
         open_peak = np.asarray(list(reader))
-    peak_nonzero_id = np.nonzero(count_mat.sum(axis=1))[0]
-    random.seed(2022)
-    random_cellbarcode_list = cellbarcode_generator(n_cell, size=16)
+    peak_nonzero_id = np.nonzero(count_mat.row_sums())[0]
+    # Fixed seed, so that the read bed files of all feature sets share the cell barcodes
+    random_cellbarcode_list = cellbarcode_generator(n_cell, size=16, rng=np.random.default_rng(2022), whitelist=cellbarcode_whitelist_file, min_distance=cellbarcode_min_distance)
     with open(OUTPUT_cells_barcode_file, 'w') as f:
         for item in random_cellbarcode_list:
             f.write(item + "\n")
@@ -95,97 +335,16 @@ def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file,
     with open(OUTPUT_cells_barcode_file + ".withSynthCluster", 'w') as f:
         for item in cellbarcode_list_withclusters:
             f.write("\t".join(item) + "\n")
+    template_store = Utility.load_template_store(INPUT_bamfile, outdirectory if template_store_directory is None else template_store_directory, n_cores=n_cores)
+    worker_data = {"count_mat": count_mat, "open_peak": open_peak, "cellbarcode_list": random_cellbarcode_list, "template_store": template_store}
+    settings = {"jitter_size": jitter_size, "read_len": read_len, "random_noise_mode": random_noise_mode, "random_seed": random_seed, "flush_size": flush_size}
     # Create read 1 and read 2 files
-    with open("%s/%s.read1.bed" % (outdirectory, read_bedfile_prename), 'w') as f_1:
-        pass
-    with open("%s/%s.read2.bed" % (outdirectory, read_bedfile_prename), 'w') as f_2:
-        pass
     print("[scReadSim] Generating Synthetic Reads for Feature Set: %s" % (bed_file))
-    for relative_peak_ind in tqdm(range(len(peak_nonzero_id))):
-        peak_ind = peak_nonzero_id[relative_peak_ind]
-        rec = open_peak[peak_ind]
-        rec_name = '_'.join(rec)
-        reads = samfile.fetch(rec[0], int(rec[1]), int(rec[2]))
-        # tic = time.time()
-        # Extract read information
-        reads_str = []
-        for read in reads:
-            if read.is_reverse==1:
-                strand = -1
-            else:
-                strand = 1
-            if read.is_read1==1:
-                read_order = 1
-            else:
-                read_order = 2
-            start = read.reference_start
-            mate_start = read.next_reference_start
-            read_len_cur = read.query_alignment_length
-            read_info = [start, mate_start, read_len_cur, read_order, strand]
-            reads_str.append(read_info)
-        if len(reads_str) > 0: # If no real reads exist in the peak, skip
-            count_vec = count_mat[peak_ind,:] # Synthetic umi count
-            count_frag_vec = np.ceil(count_vec/2).astype(int)
-            npair_read_synthetic = np.sum(count_frag_vec).astype(int) # nrow(reads_cur) should equal to nfrag_cur
-            # npair_read_synthetic = np.ceil(np.sum(count_vec)/2).astype(int) # total number of synthetic reads
-            read_sampled_unsplit = np.array(reads_str)[np.random.choice(len(reads_str), size=npair_read_synthetic, replace=True),:]
-            # Sample starting position if random noise mode is on, or use real read starting position
-            if random_noise_mode == True:
-                read_synthetic_start = np.random.randint(int(rec[1]), int(rec[2]), size=npair_read_synthetic)
-            else:
-                read_synthetic_start = read_sampled_unsplit[:,0].astype(int)
-            # Generate Read Name
-            nonempty_cell_ind = np.where(count_frag_vec != 0)[0]
-            target_peak_concat = rec[0] + ":" + str(rec[1]) + "-" + str(rec[2])
-            read_name_list = [random_cellbarcode_list[nonempty_cell_ind[ind]] + "CellNo" + str(nonempty_cell_ind[ind] + 1) + ":" + str(target_peak_concat) + "#" + str(count).zfill(4) for ind in range(len(nonempty_cell_ind)) for count in range(count_frag_vec[nonempty_cell_ind[ind]])]
-            # Create dataframe for unspiltted sampled reads
-            reads_cur = pd.DataFrame({
-                'chr': rec[0],
-                'r_start': read_synthetic_start,
-                'mate_start': read_sampled_unsplit[:,1].astype(int) + read_synthetic_start - read_sampled_unsplit[:,0].astype(int),
-                'read_name': read_name_list,
-                'length': read_sampled_unsplit[:,2],
-                'read_order': read_sampled_unsplit[:,3].astype(int),
-                'strand': read_sampled_unsplit[:,4].astype(int),
-                'mate_strand': -read_sampled_unsplit[:,4].astype(int)
-                })
-            contain_read_indicator = read_sampled_unsplit[:,0] == read_sampled_unsplit[:,1]
-            reads_cur['read_length'] = read_len
-            reads_cur['read_length'][contain_read_indicator] = abs(reads_cur['length'].astype(int)[contain_read_indicator])
-            # Add jitter size to read positions
-            jitter_value_vec = np.random.randint(-jitter_size,jitter_size,size=npair_read_synthetic).astype(int)  # nrow(reads_cur) should equal to nfrag_cur
-            reads_cur['r_start_shifted'] = reads_cur['r_start'].astype(int)  + jitter_value_vec
-            reads_cur['mate_start_shifted'] = reads_cur['mate_start'].astype(int)  + jitter_value_vec
-            reads_cur['r_end_shifted'] = reads_cur['r_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            reads_cur['mate_end_shifted'] = reads_cur['mate_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            # Split read 1 and read 2
-            read_1_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r1_start_shifted', 'r_end_shifted':'r1_end_shifted'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r1_start_shifted', 'mate_end_shifted':'r1_end_shifted', 'mate_strand': 'strand'})], ignore_index=True)
-            read_2_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r2_start_shifted', 'mate_end_shifted':'r2_end_shifted', 'mate_strand': 'strand'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r2_start_shifted', 'r_end_shifted':'r2_end_shifted'}), ], ignore_index=True)
-            read_1_df['read_name'] = read_name_list
-            read_2_df['read_name'] = read_name_list
-            # read_1_df['read_length'] = read_len
-            # read_2_df['read_length'] = read_len
-            read_1_df['strand'] = ['+' if x == 1  else '-' for x in read_1_df['strand']]
-            read_2_df['strand'] = ['+' if x == 1  else '-' for x in read_2_df['strand']]
-            read_1_df_order = read_1_df[['chr','r1_start_shifted', 'r1_end_shifted', 'read_name', 'read_length', 'strand']]
-            read_2_df_order = read_2_df[['chr','r2_start_shifted', 'r2_end_shifted', 'read_name', 'read_length', 'strand']]
-            if read_1_df_order.shape[0] != read_2_df_order.shape[0]:
-                print("[Warning] Peak %s read 1 and read 2 not identical!", relative_peak_ind)
-            if np.sum(np.array(read_1_df_order[['r1_start_shifted']] < 0)) + np.sum(np.array(read_2_df_order[['r2_start_shifted']] < 0)) > 0:
-                print("[Warning] Synthetic read pair for Peak %s %s has read 1 or read 2 start position negative: synthetic read pair removed!" % (relative_peak_ind, rec_name))
-                ind_preserve = np.array(read_1_df_order[['r1_start_shifted']] >= 0) * np.array(read_2_df_order[['r2_start_shifted']] >= 0) # Remove rows with read 1 or read 2's start position negative
-                read_1_df_order_removeNegRead = read_1_df_order.loc[ind_preserve]
-                read_2_df_order_removeNegRead = read_2_df_order.loc[ind_preserve]
-            else:
-                read_1_df_order_removeNegRead = read_1_df_order
-                read_2_df_order_removeNegRead = read_2_df_order
-            read_1_df_order_removeNegRead.to_csv("%s/%s.read1.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
-            read_2_df_order_removeNegRead.to_csv("%s/%s.read2.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
-            if npair_read_synthetic != read_1_df_order_removeNegRead.shape[0]:
-                print("Target read pair %s | Sample synthetic read pair %s" % (npair_read_synthetic, read_1_df_order_removeNegRead.shape[0]))
+    suffix = Utility.output_suffix(compress)
+    Utility.run_synthesis_shards(scATAC_GenerateBAMCoord_shard, peak_nonzero_id, ["%s/%s.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix), "%s/%s.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix)], None, worker_data, dict(settings, feature_mode="peak"), n_cores=n_cores, sort_memory=sort_memory, compress_threads=compress_threads)
     print("\n[scReadSim] Created:")
-    print("[scReadSim] Read 1 bed file: %s/%s.read1.bed" % (outdirectory, read_bedfile_prename))
-    print("[scReadSim] Read 2 bed file: %s/%s.read2.bed" % (outdirectory, read_bedfile_prename))
+    print("[scReadSim] Read 1 bed file: %s/%s.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix))
+    print("[scReadSim] Read 2 bed file: %s/%s.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix))
     # Modeling Gray Areas
     if GrayAreaModeling == True:
         print("\n[scReadSim] Generating reads for Gray Area...")
@@ -193,126 +352,36 @@ def scATAC_GenerateBAMCoord(bed_file, count_mat_file, synthetic_cell_label_file,
         try:
             with open(outdirectory + "/" + "scReadSim.grayareas.bed") as file:
                 reader = csv.reader(file, delimiter="\t")
-                GreyArea_set = np.asarray(list(reader))
+                GreyArea_set = np.asarray([rec[0:3] for rec in reader]).reshape(-1, 3) # No gray areas when the features cover the genome
         except Exception as e:
             print("[Error] Gray Area Bed File not Found: %s" % (outdirectory, scReadSim.grayareas.bed))
-        with open("%s/GrayArea_Assigned_Synthetic_CountMatrix.txt" % outdirectory, 'w') as f_2:
-            pass
+        worker_data["grey_area_set"] = GreyArea_set
+        # Scale the counts of each gray area's left nearest non-peak
+        nonpeak_idx = find_leftnearest_nonpeaks(open_peak, GreyArea_set)
+        grey_countmat = scale_gray_area_counts(count_mat, open_peak, GreyArea_set, nonpeak_idx, Utility.feature_rng(random_seed, 0, GRAY_AREA_MASK_RNG_STREAM))
+        worker_data["grey_countmat"] = grey_countmat
         # Create read 1 and read 2 files
-        with open("%s/%s.GrayArea.read1.bed" % (outdirectory, read_bedfile_prename), 'w') as f_1:
-            pass
-        with open("%s/%s.GrayArea.read2.bed" % (outdirectory, read_bedfile_prename), 'w') as f_2:
-            pass
-        random.seed(2022)
-        for peak_id in tqdm(range(len(GreyArea_set))):
-            grey_area = GreyArea_set[peak_id]
-            rec_name = '_'.join(grey_area)
-            grey_length = int(grey_area[2]) - int(grey_area[1])
-            idx = find_leftnearest_nonpeak(open_peak, grey_area)
-            nonpeak_cur_count = count_mat[idx,:]
-            nonpeak_cur_length = int(open_peak[idx,2]) - int(open_peak[idx,1])
-            if np.sum(nonpeak_cur_count) == 0:
-                grey_count_vec = pd.DataFrame(np.zeros(n_cell, dtype=int)).T
-                grey_count_vec.to_csv("%s/GrayArea_Assigned_Synthetic_CountMatrix.txt" % outdirectory, header=None, index=None, sep='\t', mode='a')
-                continue # print zero counts for grey area if no reads in non-peak count mat
-            # scaled_grey_count = np.round(nonpeak_cur_count * grey_length / nonpeak_cur_length).astype(int)
-            scaled_grey_count = nonpeak_cur_count * np.random.binomial(1, min(grey_length / nonpeak_cur_length, 1), len(nonpeak_cur_count))
-            # Write out grey area synthetic count matrix (optional)
-            grey_count_vec = pd.DataFrame(np.append(rec_name, scaled_grey_count)).T
-            grey_count_vec.to_csv("%s/GrayArea_Assigned_Synthetic_CountMatrix.txt" % outdirectory, header=None, index=None, sep='\t', mode='a')
-            if np.sum(scaled_grey_count) == 0:
-                continue # if no synthetic count for grey then skip the peak 
-            reads = samfile.fetch(grey_area[0], int(grey_area[1]), int(grey_area[2]))
-            # Extract read information
-            reads_str = []
-            for read in reads:
-                if read.is_reverse==1:
-                    strand = -1
-                else:
-                    strand = 1
-                if read.is_read1==1:
-                    read_order = 1
-                else:
-                    read_order = 2
-                start = read.reference_start
-                mate_start = read.next_reference_start
-                read_len_cur = read.query_alignment_length
-                read_info = [start, mate_start, read_len_cur, read_order, strand]
-                reads_str.append(read_info)
-            if len(reads_str) == 0: # If no real reads exist in the peak, skip
-                continue
-            count_frag_vec = np.ceil(scaled_grey_count/2).astype(int)
-            npair_read_synthetic = np.sum(count_frag_vec).astype(int) # nrow(reads_cur) should equal to nfrag_cur
-            read_sampled_unsplit = np.array(reads_str)[np.random.choice(len(reads_str), size=npair_read_synthetic, replace=True),:]
-            # Sample starting position if random noise mode is on, or use real read starting position
-            if random_noise_mode == True:
-                read_synthetic_start = np.random.randint(int(grey_area[1]), int(grey_area[2]), size=npair_read_synthetic)
-            else:
-                read_synthetic_start = read_sampled_unsplit[:,0].astype(int)
-            # Generate Read Name
-            nonempty_cell_ind = np.where(count_frag_vec != 0)[0]
-            target_peak_concat = grey_area[0] + ":" + str(grey_area[1]) + "-" + str(grey_area[2])
-            read_name_list = [random_cellbarcode_list[nonempty_cell_ind[ind]] + ":" + "CellNo" + str(nonempty_cell_ind[ind] + 1) + ":" + str(target_peak_concat) + "#" + str(count).zfill(4) for ind in range(len(nonempty_cell_ind)) for count in range(count_frag_vec[nonempty_cell_ind[ind]])]
-            # Create dataframe for unspiltted sampled reads
-            reads_cur = pd.DataFrame({
-                'chr': grey_area[0],
-                'r_start': read_synthetic_start,
-                'mate_start': read_sampled_unsplit[:,1].astype(int) + read_synthetic_start - read_sampled_unsplit[:,0].astype(int),
-                'read_name': read_name_list,
-                'length': read_sampled_unsplit[:,2],
-                'read_order': read_sampled_unsplit[:,3].astype(int),
-                'strand': read_sampled_unsplit[:,4].astype(int),
-                'mate_strand': -read_sampled_unsplit[:,4].astype(int)
-                })
-            contain_read_indicator = read_sampled_unsplit[:,0] == read_sampled_unsplit[:,1]
-            reads_cur['read_length'] = read_len
-            reads_cur['read_length'][contain_read_indicator] = abs(reads_cur['length'].astype(int)[contain_read_indicator])
-            # Add jitter size to read positions
-            jitter_value_vec = np.random.randint(-jitter_size,jitter_size,size=npair_read_synthetic).astype(int)  # nrow(reads_cur) should equal to nfrag_cur
-            reads_cur['r_start_shifted'] = reads_cur['r_start'].astype(int)  + jitter_value_vec
-            reads_cur['mate_start_shifted'] = reads_cur['mate_start'].astype(int)  + jitter_value_vec
-            reads_cur['r_end_shifted'] = reads_cur['r_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            reads_cur['mate_end_shifted'] = reads_cur['mate_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            # Split read 1 and read 2
-            read_1_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r1_start_shifted', 'r_end_shifted':'r1_end_shifted'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r1_start_shifted', 'mate_end_shifted':'r1_end_shifted', 'mate_strand': 'strand'})], ignore_index=True)
-            read_2_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r2_start_shifted', 'mate_end_shifted':'r2_end_shifted', 'mate_strand': 'strand'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r2_start_shifted', 'r_end_shifted':'r2_end_shifted'}), ], ignore_index=True)
-            read_1_df['read_name'] = read_name_list
-            read_2_df['read_name'] = read_name_list
-            # read_1_df['read_length'] = read_len
-            # read_2_df['read_length'] = read_len
-            read_1_df['strand'] = ['+' if x == 1  else '-' for x in read_1_df['strand']]
-            read_2_df['strand'] = ['+' if x == 1  else '-' for x in read_2_df['strand']]
-            read_1_df_order = read_1_df[['chr','r1_start_shifted', 'r1_end_shifted', 'read_name', 'read_length', 'strand']]
-            read_2_df_order = read_2_df[['chr','r2_start_shifted', 'r2_end_shifted', 'read_name', 'read_length', 'strand']]
-            if read_1_df_order.shape[0] != read_2_df_order.shape[0]:
-                print("[Warning] Gray Area %s read 1 and read 2 not identical!", peak_id)
-            if np.sum(np.array(read_1_df_order[['r1_start_shifted']] < 0)) + np.sum(np.array(read_2_df_order[['r2_start_shifted']] < 0)) > 0:
-                print("[Warning] Synthetic read pair for Peak %s %s has read 1 or read 2 start position negative: synthetic read pair removed!" % (peak_id, rec_name))
-                ind_preserve = np.array(read_1_df_order[['r1_start_shifted']] >= 0) * np.array(read_2_df_order[['r2_start_shifted']] >= 0) # Remove rows with read 1 or read 2's start position negative
-                read_1_df_order_removeNegRead = read_1_df_order.loc[ind_preserve]
-                read_2_df_order_removeNegRead = read_2_df_order.loc[ind_preserve]
-            else:
-                read_1_df_order_removeNegRead = read_1_df_order
-                read_2_df_order_removeNegRead = read_2_df_order
-            read_1_df_order_removeNegRead.to_csv("%s/%s.GrayArea.read1.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
-            read_2_df_order_removeNegRead.to_csv("%s/%s.GrayArea.read2.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
-            if npair_read_synthetic != read_1_df_order_removeNegRead.shape[0]:
-                print("Target read pair %s | Sample synthetic read pair %s" % (npair_read_synthetic, read_1_df_order_removeNegRead.shape[0]))
+        grey_nonzero_id = np.nonzero(grey_countmat.row_sums())[0]
+        Utility.run_synthesis_shards(scATAC_GenerateBAMCoord_shard, grey_nonzero_id, ["%s/%s.GrayArea.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix), "%s/%s.GrayArea.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix)], None, worker_data, dict(settings, feature_mode="gray"), n_cores=n_cores, sort_memory=sort_memory, compress_threads=compress_threads)
+        # Write out grey area synthetic count matrix
+        Utility.write_countmat_txt("%s/GrayArea_Assigned_Synthetic_CountMatrix.txt%s" % (outdirectory, suffix), grey_countmat, threads=compress_threads)
         print("\n[scReadSim] Created:")
-        print("[scReadSim] Read 1 Bed File: %s/%s.GrayArea.read1.bed" % (outdirectory, read_bedfile_prename))
-        print("[scReadSim] Read 2 Bed File: %s/%s.GrayArea.read2.bed" % (outdirectory, read_bedfile_prename))
+        print("[scReadSim] Read 1 Bed File: %s/%s.GrayArea.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix))
+        print("[scReadSim] Read 2 Bed File: %s/%s.GrayArea.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix))
         print("[scReadSim] Done.")
 
 
-def scATAC_GenerateBAMCoord_OutputPeak(target_peak_assignment_file, count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=50, random_noise_mode = False):
+def scATAC_GenerateBAMCoord_OutputPeak(target_peak_assignment_file, count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=50, random_noise_mode = False, flush_size=16777216, n_cores=1, random_seed=2022, template_store_directory=None, sort_memory="1G", compress=False, compress_threads=1, cellbarcode_whitelist_file=None, cellbarcode_min_distance=1, template_cache_size=2097152):
     """Generate Synthetic reads in BED format. 
 
+    Output peaks are processed grouped by their assigned input peak, whose read templates are gathered once and reused by all of them.
+
     Parameters
     ----------
     target_peak_assignment_file: `str`
         Mapping file between input peaks and output peaks, output by 'FeatureMapping'.
     count_mat_file: `str`
-        The path to the synthetic count matrix generated by `GenerateSyntheticCount.scATAC_GenerateSyntheticCount`.
+        The path to the synthetic count matrix generated by `GenerateSyntheticCount.scATAC_GenerateSyntheticCount`, either a Matrix Market file ('.mtx' or '.mtx.gz') with its '.features.txt' sidecar or a dense text matrix.
     synthetic_cell_label_file: `str`
         Synthetic cell label file generated by `scATAC_GenerateSyntheticCount`.
     read_bedfile_prename: `str`
@@ -329,19 +398,38 @@ def scATAC_GenerateBAMCoord_OutputPeak(target_peak_assignment_file, count_mat_fi
         Specify the length of synthetic reads. Default value is 50 bp.
     random_noise_mode: 'bool' (default: 'False')
         Specify whether to use a uniform distribution of reads.
+    flush_size: `int` (default: 16777216)
+        Number of characters of synthetic reads buffered in memory before the bed files are written.
+    n_cores: `int` (default: 1)
+        Number of processes generating synthetic reads. The output does not depend on the number of processes.
+    random_seed: `int` (default: 2022)
+        Root seed of the random generators. Each feature samples from its own generator seeded by `random_seed` and the feature index.
+    template_store_directory: `str` (default: None)
+        Directory of the read template store of `INPUT_bamfile` (see `Utility.load_template_store`). The store is built with one pass over the BAM file on first use and reused by later runs on the same BAM file. If None, use `outdirectory`.
+    sort_memory: `str` (default: '1G')
+        Memory budget of sorting the output bed files by coordinate (see `Utility.sort_bed`). Read pairs are sorted by read 1.
+    compress: `bool` (default: False)
+        Whether to write BGZF-compressed bed files ('.read1.bed.gz' and '.read2.bed.gz', the read 1 bed file being tabix-indexed) and gray area count matrix.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of each compressed file.
+    cellbarcode_whitelist_file: `str` (default: None)
+        Barcode whitelist file, e.g. the 10x Genomics whitelist, to sample the 16 bp synthetic cell barcodes from (see `Utility.generate_barcodes`). If None, cell barcodes are drawn at random.
+    cellbarcode_min_distance: `int` (default: 1)
+        Minimum Hamming distance between any two synthetic cell barcodes. Cell barcodes are always distinct.
+    template_cache_size: `int` (default: 2097152)
+        Number of read templates of input peaks kept in memory by each process (see `Utility.TemplateCache`), 40 bytes each.
     """
-    count_mat_df = pd.read_csv("%s" % (count_mat_file), header=None, delimiter="\t")
-	# Remove count matrix first column: feature names
-    count_mat = count_mat_df.iloc[: , 1:].to_numpy()
+    count_mat = Utility.read_countmat(count_mat_file)
     count_mat_cluster = pd.read_csv(synthetic_cell_label_file, header=None, delimiter="\t").to_numpy().flatten()	
-    n_cell = np.shape(count_mat)[1]
-    samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+    n_cell = count_mat.n_cell
     with open(target_peak_assignment_file) as open_peak:
         reader = csv.reader(open_peak, delimiter="\t")
         open_peak = np.asarray(list(reader))
-    peak_nonzero_id = np.nonzero(count_mat.sum(axis=1))[0]
-    random.seed(2022)
-    random_cellbarcode_list = cellbarcode_generator(n_cell, size=16)
+    peak_nonzero_id = np.nonzero(count_mat.row_sums())[0]
+    # Group output peaks by input peak, so that each input peak is mostly gathered once
+    peak_nonzero_id = peak_nonzero_id[np.argsort(Utility.source_region_index(open_peak)[peak_nonzero_id], kind="stable")]
+    # Fixed seed, so that the read bed files of all feature sets share the cell barcodes
+    random_cellbarcode_list = cellbarcode_generator(n_cell, size=16, rng=np.random.default_rng(2022), whitelist=cellbarcode_whitelist_file, min_distance=cellbarcode_min_distance)
     with open(OUTPUT_cells_barcode_file, 'w') as f:
         for item in random_cellbarcode_list:
             f.write(item + "\n")
@@ -349,106 +437,23 @@ def scATAC_GenerateBAMCoord_OutputPeak(target_peak_assignment_file, count_mat_fi
     with open(OUTPUT_cells_barcode_file + ".withSynthCluster", 'w') as f:
         for item in cellbarcode_list_withclusters:
             f.write("\t".join(item) + "\n")
-    # Create read 1 and read 2 files
-    with open("%s/%s.read1.bed" % (outdirectory, read_bedfile_prename), 'w') as f_1:
-        pass
-    with open("%s/%s.read2.bed" % (outdirectory, read_bedfile_prename), 'w') as f_2:
-        pass
+    template_store = Utility.load_template_store(INPUT_bamfile, outdirectory if template_store_directory is None else template_store_directory, n_cores=n_cores)
+    worker_data = {"count_mat": count_mat, "open_peak": open_peak, "cellbarcode_list": random_cellbarcode_list, "template_store": template_store}
+    settings = {"jitter_size": jitter_size, "read_len": read_len, "random_noise_mode": random_noise_mode, "random_seed": random_seed, "flush_size": flush_size, "template_cache_size": template_cache_size}
     # w/ Target Peak
     print("[scReadSim] Generating Synthetic Reads for Feature Set: %s" % (target_peak_assignment_file))
-    for relative_peak_ind in tqdm(range(len(peak_nonzero_id))):
-        peak_ind = peak_nonzero_id[relative_peak_ind]
-        rec = open_peak[peak_ind]
-        rec_name = '_'.join(rec)
-        true_peak_concat = rec[3] + ":" + str(rec[4]) + "-" + str(rec[5])
-        target_peak_concat = rec[0] + ":" + str(rec[1]) + "-" + str(rec[2])
-        if int(rec[2]) - int(rec[1]) == 0:
-            print("Peak %s has identical start and end position. Skip.")
-            continue
-        shift_number = int(rec[1]) - int(rec[4])
-        reads = samfile.fetch(rec[3], int(rec[4]), int(rec[5])) # Extract reads from true peaks
-        # tic = time.time()
-        # Extract read information
-        reads_str = []
-        for read in reads:
-            if read.is_reverse==1:
-                strand = -1
-            else:
-                strand = 1
-            if read.is_read1==1:
-                read_order = 1
-            else:
-                read_order = 2
-            start = read.reference_start
-            mate_start = read.next_reference_start
-            read_len_cur = read.query_alignment_length
-            read_info = [start, mate_start, read_len_cur, read_order, strand]
-            reads_str.append(read_info)
-        # Sample npair_read_synthetic read 1 from reads and reserve fragment length 
-        if len(reads_str) > 0: # If no real reads exist in the peak, skip
-            count_vec = count_mat[peak_ind,:] # Synthetic umi count
-            count_frag_vec = np.ceil(count_vec/2).astype(int)
-            npair_read_synthetic = np.sum(count_frag_vec).astype(int) # nrow(reads_cur) should equal to nfrag_cur
-            # npair_read_synthetic = np.ceil(np.sum(count_vec)/2).astype(int) # total number of synthetic reads
-            read_sampled_unsplit = np.array(reads_str)[np.random.choice(len(reads_str), size=npair_read_synthetic, replace=True),:]
-            # Sample starting position if random noise mode is on, or use real read starting position
-            if random_noise_mode == True:
-                read_synthetic_start = np.random.randint(int(rec[1]), int(rec[2]), size=npair_read_synthetic)
-            else:
-                read_synthetic_start = read_sampled_unsplit[:,0].astype(int) + shift_number
-            # Generate Read Name
-            nonempty_cell_ind = np.where(count_frag_vec != 0)[0]
-            target_peak_concat = rec[0] + ":" + str(rec[1]) + "-" + str(rec[2])
-            read_name_list = [random_cellbarcode_list[nonempty_cell_ind[ind]] + ":" +  "CellNo" + str(nonempty_cell_ind[ind] + 1) + ":" + str(target_peak_concat) + "#" + str(count).zfill(4) for ind in range(len(nonempty_cell_ind)) for count in range(count_frag_vec[nonempty_cell_ind[ind]])]
-            # Create dataframe for unspiltted sampled reads
-            reads_cur = pd.DataFrame({
-                'chr': rec[0],
-                'r_start': read_synthetic_start,
-                'mate_start': read_sampled_unsplit[:,1].astype(int) + read_synthetic_start - read_sampled_unsplit[:,0].astype(int),
-                'read_name': read_name_list,
-                'length': read_sampled_unsplit[:,2],
-                'read_order': read_sampled_unsplit[:,3].astype(int),
-                'strand': read_sampled_unsplit[:,4].astype(int),
-                'mate_strand': -read_sampled_unsplit[:,4].astype(int)
-                })
-            contain_read_indicator = read_sampled_unsplit[:,0] == read_sampled_unsplit[:,1]
-            reads_cur['read_length'] = read_len
-            reads_cur['read_length'][contain_read_indicator] = abs(reads_cur['length'].astype(int)[contain_read_indicator])
-            # Add jitter size to read positions
-            jitter_value_vec = np.random.randint(-jitter_size,jitter_size,size=npair_read_synthetic).astype(int)  # nrow(reads_cur) should equal to nfrag_cur
-            reads_cur['r_start_shifted'] = reads_cur['r_start'].astype(int)  + jitter_value_vec
-            reads_cur['mate_start_shifted'] = reads_cur['mate_start'].astype(int)  + jitter_value_vec
-            reads_cur['r_end_shifted'] = reads_cur['r_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            reads_cur['mate_end_shifted'] = reads_cur['mate_start'].astype(int) + reads_cur['read_length'].astype(int) + jitter_value_vec
-            # Split read 1 and read 2
-            read_1_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r1_start_shifted', 'r_end_shifted':'r1_end_shifted'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r1_start_shifted', 'mate_end_shifted':'r1_end_shifted', 'mate_strand': 'strand'})], ignore_index=True)
-            read_2_df = pd.concat([reads_cur.loc[reads_cur['read_order'] == 1, ['chr','mate_start_shifted', 'mate_end_shifted', 'read_length', 'mate_strand']].rename(columns={'mate_start_shifted':'r2_start_shifted', 'mate_end_shifted':'r2_end_shifted', 'mate_strand': 'strand'}), reads_cur.loc[reads_cur['read_order'] == 2, ['chr','r_start_shifted', 'r_end_shifted', 'read_length', 'strand']].rename(columns={'r_start_shifted':'r2_start_shifted', 'r_end_shifted':'r2_end_shifted'}), ], ignore_index=True)
-            read_1_df['read_name'] = read_name_list
-            read_2_df['read_name'] = read_name_list
-            read_1_df['strand'] = ['+' if x == 1  else '-' for x in read_1_df['strand']]
-            read_2_df['strand'] = ['+' if x == 1  else '-' for x in read_2_df['strand']]
-            read_1_df_order = read_1_df[['chr','r1_start_shifted', 'r1_end_shifted', 'read_name', 'read_length', 'strand']]
-            read_2_df_order = read_2_df[['chr','r2_start_shifted', 'r2_end_shifted', 'read_name', 'read_length', 'strand']]
-            if read_2_df_order.shape[0] != read_2_df_order.shape[0]:
-                print("Peak %s read 1 and read 2 not identical!", relative_peak_ind)
-            if np.sum(np.array(read_1_df_order[['r1_start_shifted']] < 0)) + np.sum(np.array(read_2_df_order[['r2_start_shifted']] < 0)) > 0:
-                print("[Warning] Synthetic read pair for Peak %s %s has read 1 or read 2 start position negative: synthetic read pair removed!" % (relative_peak_ind, rec_name))
-                ind_preserve = np.array(read_1_df_order[['r1_start_shifted']] >= 0) * np.array(read_2_df_order[['r2_start_shifted']] >= 0) # Remove rows with read 1 or read 2's start position negative
-                read_1_df_order_removeNegRead = read_1_df_order.loc[ind_preserve]
-                read_2_df_order_removeNegRead = read_2_df_order.loc[ind_preserve]
-            else:
-                read_1_df_order_removeNegRead = read_1_df_order
-                read_2_df_order_removeNegRead = read_2_df_order
-            read_1_df_order_removeNegRead.to_csv("%s/%s.read1.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
-            read_2_df_order_removeNegRead.to_csv("%s/%s.read2.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
+    suffix = Utility.output_suffix(compress)
+    Utility.run_synthesis_shards(scATAC_GenerateBAMCoord_shard, peak_nonzero_id, ["%s/%s.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix), "%s/%s.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix)], None, worker_data, dict(settings, feature_mode="output"), n_cores=n_cores, sort_memory=sort_memory, compress_threads=compress_threads)
     print("\n[scReadSim] Created:")
-    print("[scReadSim] Read 1 bed file: %s/%s.read1.bed" % (outdirectory, read_bedfile_prename))
-    print("[scReadSim] Read 2 bed file: %s/%s.read2.bed" % (outdirectory, read_bedfile_prename))
+    print("[scReadSim] Read 1 bed file: %s/%s.read1.bed%s" % (outdirectory, read_bedfile_prename, suffix))
+    print("[scReadSim] Read 2 bed file: %s/%s.read2.bed%s" % (outdirectory, read_bedfile_prename, suffix))
     print("[scReadSim] Done.")
 
 
-def scATAC_CombineBED(outdirectory, peak_read_bedfile_prename, nonpeak_read_bedfile_prename, BED_filename_combined_pre, GrayAreaModeling=True):
-    """Combine the bed files of foreground and background feature sets into one bed file.
+def scATAC_CombineBED(outdirectory, peak_read_bedfile_prename, nonpeak_read_bedfile_prename, BED_filename_combined_pre, GrayAreaModeling=True, compress=False, compress_threads=1):
+    """Combine the bed files of foreground and background feature sets into one coordinate-sorted bed file.
+
+    The bed files, sorted by `scATAC_GenerateBAMCoord` and compressed or not, are merged with a streaming k-way merge (see `Utility.merge_sorted_beds`). Read pairs are ordered by read 1, so the read 2 bed file keeps the line order of the read 1 bed file.
 
     Parameters
     ----------
@@ -462,96 +467,72 @@ def scATAC_CombineBED(outdirectory, peak_read_bedfile_prename, nonpeak_read_bedf
         Specify the combined syntehtic reads bed file prename. The combined bed file will be output to `outdirectory`.
     GrayAreaModeling: `bool` (default: 'True')
         Specify whether to combine gray area's reads.
+    compress: `bool` (default: False)
+        Whether to write bgzip-compressed bed files ('.read1.bed.gz' and '.read2.bed.gz'). The read 1 bed file is tabix-indexed ('.read1.bed.gz.tbi').
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of each compressed bed file.
    """
+    bed_file_pres = [peak_read_bedfile_prename, nonpeak_read_bedfile_prename]
     if GrayAreaModeling:
-        print("[scReadSim] Combining Synthetic Read 1 Bed Files from Peaks, NonPeaks and GrayAreas.")
-        combine_read1_cmd = "cat %s/%s.read1.bed %s/%s.read1.bed %s/%s.GrayArea.read1.bed > %s/%s.read1.bed" % (outdirectory, peak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, BED_filename_combined_pre)
-        output, error = subprocess.Popen(combine_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create combine synthetic read1 bed files:\n', error.decode())
-        print("[scReadSim] Combining Synthetic Read 2 Bed Files from Peaks, NonPeaks and GrayAreas.")
-        combine_read2_cmd = "cat %s/%s.read2.bed %s/%s.read2.bed %s/%s.GrayArea.read2.bed > %s/%s.read2.bed" % (outdirectory, peak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, BED_filename_combined_pre)
-        output, error = subprocess.Popen(combine_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create combine synthetic read2 bed files:\n', error.decode())
-            # sys.exit('[ERROR] Fail to create combine synthetic read2 bed files:\n', error.decode())
+        print("[scReadSim] Combining Synthetic Read Bed Files from Peaks, NonPeaks and GrayAreas.")
+        bed_file_pres.append(nonpeak_read_bedfile_prename + ".GrayArea")
     else:
-        print("[scReadSim] Combining Synthetic Read 1 Bed Files from Peaks, NonPeaks.")
-        combine_read1_cmd = "cat %s/%s.read1.bed %s/%s.read1.bed > %s/%s.read1.bed" % (outdirectory, peak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, BED_filename_combined_pre)
-        output, error = subprocess.Popen(combine_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create combine synthetic read1 bed files:\n', error.decode())
-        print("[scReadSim] Combining Synthetic Read 2 Bed Files from Peaks, NonPeaks.")
-        combine_read2_cmd = "cat %s/%s.read2.bed %s/%s.read2.bed > %s/%s.read2.bed" % (outdirectory, peak_read_bedfile_prename, outdirectory, nonpeak_read_bedfile_prename, outdirectory, BED_filename_combined_pre)
-        output, error = subprocess.Popen(combine_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-        if error:
-            print('[ERROR] Fail to create combine synthetic read2 bed files:\n', error.decode())
-            # sys.exit('[ERROR] Fail to create combine synthetic read2 bed files:\n', error.decode())        
+        print("[scReadSim] Combining Synthetic Read Bed Files from Peaks, NonPeaks.")
+    combined_bed_files = ["%s/%s.%s.bed%s" % (outdirectory, BED_filename_combined_pre, read_no, Utility.output_suffix(compress)) for read_no in ["read1", "read2"]]
+    Utility.merge_sorted_beds([[Utility.resolve_output_file("%s/%s.%s.bed" % (outdirectory, bed_file_pre, read_no)) for read_no in ["read1", "read2"]] for bed_file_pre in bed_file_pres], combined_bed_files, compress, threads=compress_threads)
     print("\n[scReadSim] Created:")
-    print("[scReadSim] Combined Read 1 Bed File: %s/%s.read1.bed" % (outdirectory, BED_filename_combined_pre))
-    print("[scReadSim] Combined Read 2 Bed File: %s/%s.read2.bed" % (outdirectory, BED_filename_combined_pre))
+    print("[scReadSim] Combined Read 1 Bed File: %s" % combined_bed_files[0])
+    print("[scReadSim] Combined Read 2 Bed File: %s" % combined_bed_files[1])
     print("[scReadSim] Done.")
 
 
-def scATAC_BED2FASTQ(bedtools_directory, seqtk_directory, referenceGenome_file, outdirectory, BED_filename_combined, synthetic_fastq_prename):
+def scATAC_BED2FASTQ(bedtools_directory, seqtk_directory, referenceGenome_file, outdirectory, BED_filename_combined, synthetic_fastq_prename, compress=False, flush_size=16777216, sort_reads=False, sort_memory="1G", temp_directory=None, n_cores=1, compress_threads=1):
     """Convert Synthetic reads from BED to FASTQ. 
 
     Parameters
     ----------
     bedtools_directory: `str`
-        Directory of software bedtools.
+        Directory of software bedtools. Not used anymore: read sequences are extracted in-process.
     seqtk_directory: `str`
-        Directory of software seqtk.
+        Directory of software seqtk. Not used anymore: FASTQ files are written in-process.
     referenceGenome_file: `str`
-        Directory of the reference genome FASTA file that the synthteic reads should align.
+        Directory of the reference genome FASTA file that the synthteic reads should align. The '.fai' index is built if missing.
     outdirectory: `str`
         Output directory of the synthteic bed file and its corresponding cell barcodes file.
     BED_filename_combined: `str`
-        Specify the base name of output bed file of function 'scATAC_CombineBED'.
+        Specify the base name of output bed file of function 'scATAC_CombineBED', compressed or not.
     synthetic_fastq_prename: `str`
         Specify the base name of the output FASTQ files.
+    compress: `bool` (default: False)
+        Whether to BGZF compress the FASTQ files, named with suffix '.fq.gz' instead of '.fq'. BGZF files are readable by gzip.
+    flush_size: `int` (default: 16777216)
+        Number of characters of FASTQ records buffered in memory before the files are written.
+    sort_reads: `bool` (default: False)
+        Whether to sort the reads by name. Read 1 and read 2 FASTQ files are always written in the same read order, so sorting is not needed for pairing.
+    sort_memory: `str` (default: '1G')
+        Memory budget of the external merge sort (see `Utility.sort_fastq`).
+    temp_directory: `str` (default: None)
+        Directory of the temporary files of the sort. If None, use `outdirectory`.
+    n_cores: `int` (default: 1)
+        Number of processes merging sorted runs.
+    compress_threads: `int` (default: 1)
+        Number of background compression threads of each compressed FASTQ file.
     """
-	# Create FASTA
-    print('[scReadSim] Generating Synthetic Read FASTA files...')
-    fasta_read1_cmd = "%s/bedtools getfasta -s -fi %s -bed %s/%s.read1.bed -fo %s/%s.read1.bed2fa.strand.fa -nameOnly" % (bedtools_directory, referenceGenome_file, outdirectory, BED_filename_combined, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(fasta_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print(error.decode())
-    fasta_read2_cmd = "%s/bedtools getfasta -s -fi %s -bed %s/%s.read2.bed -fo %s/%s.read2.bed2fa.strand.fa -nameOnly" % (bedtools_directory, referenceGenome_file, outdirectory, BED_filename_combined, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(fasta_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print(error.decode())
- 	# remove (-) or (+)
-    org_fasta_read1_cmd = "sed '/^>/s/.\{3\}$//' %s/%s.read1.bed2fa.strand.fa > %s/%s.read1.bed2fa.fa" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(org_fasta_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to remove strand infomormation from synthetic read1 fasta file:', error.decode())
-    org_fasta_read2_cmd = "sed '/^>/s/.\{3\}$//' %s/%s.read2.bed2fa.strand.fa > %s/%s.read2.bed2fa.fa" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(org_fasta_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to remove strand infomormation from synthetic read2 fasta file:', error.decode())
-	# FASTA to FASTQ
+    fastq_suffix = "fq" + Utility.output_suffix(compress)
+    read_files = [Utility.resolve_output_file("%s/%s.%s.bed" % (outdirectory, BED_filename_combined, read_no)) for read_no in ["read1", "read2"]]
+    sorted_fastq_files = ["%s/%s.read1.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix), "%s/%s.read2.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix)]
+    fastq_files = ["%s/%s.read1.bed2fa.fq" % (outdirectory, synthetic_fastq_prename), "%s/%s.read2.bed2fa.fq" % (outdirectory, synthetic_fastq_prename)] if sort_reads else sorted_fastq_files
     print('[scReadSim] Generating Synthetic Read FASTQ files...')
-    fastq_read1_cmd = "%s/seqtk seq -F 'F' %s/%s.read1.bed2fa.fa > %s/%s.read1.bed2fa.fq" % (seqtk_directory, outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to convert read1 synthetic fasta file to fastq file:', error.decode())
-    fastq_read2_cmd = "%s/seqtk seq -F 'F' %s/%s.read2.bed2fa.fa > %s/%s.read2.bed2fa.fq" % (seqtk_directory, outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to convert read2 synthetic fasta file to fastq file:', error.decode())
-    print('[scReadSim] Sorting FASTQ files...')
-    sort_fastq_read1_cmd = "cat %s/%s.read1.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(sort_fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to sort read1 synthetic fastq file:', error.decode())
-    sort_fastq_read2_cmd = "cat %s/%s.read2.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-    output, error = subprocess.Popen(sort_fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-    if error:
-        print('[ERROR] Fail to sort read2 synthetic fastq file:', error.decode())
+    n_skipped = Utility.bed2fastq(read_files, fastq_files, referenceGenome_file, flush_size=flush_size, compress_threads=compress_threads)
+    if n_skipped > 0:
+        print("[Warning] %d synthetic read pairs outside the reference genome were skipped." % n_skipped)
+    if sort_reads:
+        print('[scReadSim] Sorting FASTQ files...')
+        for fastq_file, sorted_fastq_file in zip(fastq_files, sorted_fastq_files):
+            Utility.order_fastq(fastq_file, sorted_fastq_file, True, sort_memory, temp_directory, n_cores, compress_threads)
     print("\n[scReadSim] Created:")
-    print("[scReadSim] Read 1 FASTQ File: %s/%s.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
-    print("[scReadSim] Read 2 FASTQ File: %s/%s.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
+    print("[scReadSim] Read 1 FASTQ File: %s/%s.read1.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix))
+    print("[scReadSim] Read 2 FASTQ File: %s/%s.read2.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix))
     print("[scReadSim] Done.")
 
 
@@ -601,135 +582,154 @@ def AlignSyntheticBam_Pair(bowtie2_directory, samtools_directory, outdirectory,
     print("[scReadSim] Done.")
 
 
-def ErrorBase(base, prop, base_call_ref):
-	"""Sample random errors. 
+def scATAC_BED2BAM(referenceGenome_file, outdirectory, BED_filename_combined, output_BAM_pre, n_threads=1, sort_memory="768M", chunk_size=500000, max_insert=1200):
+    """Write synthetic read pairs from BED directly to a BAM file aligned at their true positions, skipping the FASTQ conversion and realignment with `scATAC_BED2FASTQ` and `AlignSyntheticBam_Pair`.
 
-	"""
-	err_base_call_id = np.random.choice(a=[0, 1, 2], size=1, p=prop)[0]      
-	err_base_call = base_call_ref[base][err_base_call_id]
-	return err_base_call
+    Read sequences come from the indexed reference genome. Each read gets CIGAR '<length>M', mate fields and a 'CB' tag with the cell barcode of its name. Use `AlignSyntheticBam_Pair` instead when aligner artifacts are needed.
 
+    Parameters
+    ----------
+    referenceGenome_file: `str`
+        Reference genome FASTA file that the synthteic reads come from. The '.fai' index is built if missing.
+    outdirectory: `str`
+        Directory of the combined bed files and of the output BAM file.
+    BED_filename_combined: `str`
+        Base name of the combined bed files output by function `scATAC_CombineBED`.
+    output_BAM_pre: `str`
+        Specify the base name of the output BAM file.
+    n_threads: `int` (default: 1)
+        Number of threads for BAM compression and sorting.
+    sort_memory: `str` (default: '768M')
+        Memory per thread for sorting the BAM file.
+    chunk_size: `int` (default: 500000)
+        Number of read pairs loaded from the bed files at a time.
+    max_insert: `int` (default: 1200)
+        Maximum fragment length of properly paired reads, as bowtie2 '--maxins 1200' in `AlignSyntheticBam_Pair`. Pairs with a longer fragment, e.g. sampled from discordant read templates, are not flagged as properly paired (0x2).
+    """
+    print('[scReadSim] Writing Synthetic Read Pairs at their True Positions to BAM file...')
+    reference_genome = Utility.ReferenceGenome(referenceGenome_file)
+    header = Utility.truth_bam_header(reference_genome)
+    unsorted_bamfile = "%s/%s.synthetic.unsorted.bam" % (outdirectory, output_BAM_pre)
+    n_skipped = 0
+    with pysam.AlignmentFile(unsorted_bamfile, "wb", header=header, threads=n_threads) as bamfile:
+        for read1_df, read2_df in zip(Utility.read_bed_chunks("%s/%s.read1.bed" % (outdirectory, BED_filename_combined), chunk_size), Utility.read_bed_chunks("%s/%s.read2.bed" % (outdirectory, BED_filename_combined), chunk_size)):
+            for chrom, name, r1_start, r1_end, r1_strand, r2_start, r2_end, r2_strand in zip(read1_df["chrom"].tolist(), read1_df["name"].tolist(), read1_df["start"].tolist(), read1_df["end"].tolist(), read1_df["strand"].tolist(), read2_df["start"].tolist(), read2_df["end"].tolist(), read2_df["strand"].tolist()):
+                if chrom not in reference_genome.chrom_size:
+                    n_skipped += 1
+                    continue
+                chrom_seq = reference_genome.chromosome(chrom)
+                # Pairs with a read running off the chromosome end are skipped, as bedtools getfasta skips such reads
+                if max(r1_end, r2_end) > len(chrom_seq) or r1_end <= r1_start or r2_end <= r2_start:
+                    n_skipped += 1
+                    continue
+                tid = header.get_tid(chrom)
+                tags = [("CB", name.split(':', 1)[0], "Z")]
+                fragment_length = max(r1_end, r2_end) - min(r1_start, r2_start)
+                r1_is_left = r1_start <= r2_start
+                proper_pair_flag = 0x2 if fragment_length <= max_insert else 0
+                r1_flag = 0x1 | proper_pair_flag | 0x40 | (0x10 if r1_strand == '-' else 0) | (0x20 if r2_strand == '-' else 0)
+                r2_flag = 0x1 | proper_pair_flag | 0x80 | (0x10 if r2_strand == '-' else 0) | (0x20 if r1_strand == '-' else 0)
+                read1 = Utility.truth_aligned_segment(header, name, tid, r1_start, chrom_seq[r1_start:r1_end], r1_flag, tags)
+                read2 = Utility.truth_aligned_segment(header, name, tid, r2_start, chrom_seq[r2_start:r2_end], r2_flag, tags)
+                read1.next_reference_id, read1.next_reference_start, read1.template_length = tid, r2_start, fragment_length if r1_is_left else -fragment_length
+                read2.next_reference_id, read2.next_reference_start, read2.template_length = tid, r1_start, -fragment_length if r1_is_left else fragment_length
+                bamfile.write(read1)
+                bamfile.write(read2)
+    reference_genome.close()
+    if n_skipped > 0:
+        print("[Warning] %d synthetic read pairs outside the reference genome were skipped." % n_skipped)
+    print('[scReadSim] Sorting and Indexing BAM file...')
+    Utility.sort_index_bam(unsorted_bamfile, "%s/%s.synthetic.sorted.bam" % (outdirectory, output_BAM_pre), n_threads, sort_memory)
+    print("\n[scReadSim] Created:")
+    print("[scReadSim] Synthetic Read BAM File: %s/%s.synthetic.sorted.bam" % (outdirectory, output_BAM_pre))
+    print("[scReadSim] Done.")
 
-def ErroneousRead(real_error_rate_read, read_df, output_fq_file):
-	"""Generate random errors according to input real data error rates. 
+
+def ErroneousRead(real_error_rate_read, input_fq_file, output_fq_file, chunk_size=65536, n_cores=1, random_seed=2022, stream=0, compress_threads=1):
+	"""Generate random errors according to input real data error rates, streaming the FASTQ file in chunks (see `Utility.add_substitution_errors`). 
 
 	"""
-	n_read = int(np.shape(read_df)[0]/4)
-	## Prepare Error rate
-	real_error_rate_read_A = real_error_rate_read[['a_to_c_error_rate', 'a_to_g_error_rate', 'a_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_A_prop = real_error_rate_read_A/real_error_rate_read_A.sum(axis=1,keepdims=1)
-	real_error_rate_read_A_prop[np.isnan(real_error_rate_read_A_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_C = real_error_rate_read[['c_to_a_error_rate', 'c_to_g_error_rate', 'c_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_C_prop = real_error_rate_read_C/real_error_rate_read_C.sum(axis=1,keepdims=1)
-	real_error_rate_read_C_prop[np.isnan(real_error_rate_read_C_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_G = real_error_rate_read[['g_to_a_error_rate', 'g_to_c_error_rate', 'g_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_G_prop = real_error_rate_read_G/real_error_rate_read_G.sum(axis=1,keepdims=1)
-	real_error_rate_read_G_prop[np.isnan(real_error_rate_read_G_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_T = real_error_rate_read[['t_to_a_error_rate', 't_to_c_error_rate', 't_to_g_error_rate']].to_numpy() 
-	real_error_rate_read_T_prop = real_error_rate_read_T/real_error_rate_read_T.sum(axis=1,keepdims=1)
-	real_error_rate_read_T_prop[np.isnan(real_error_rate_read_T_prop).any(axis=1),:] = 1/3
-	# Base decision matrix
-	real_error_rate_read_prop_dict = {'A': real_error_rate_read_A_prop, 'C': real_error_rate_read_C_prop, 'G': real_error_rate_read_G_prop, 'T': real_error_rate_read_T_prop}
-	# Error decision vector
-	real_error_rate_read_perbase = real_error_rate_read['error_rate'].to_numpy()
-	## Decide whether error occurs for each read
-	read_length = real_error_rate_read.shape[0]
-	error_read_perbase_indicator = np.zeros((n_read, read_length), dtype=int)
-	random.seed(1)
-	for base_id in range(read_length):
-		error_read_perbase_indicator[:,base_id] = np.random.binomial(n=1, p=real_error_rate_read_perbase[base_id], size=n_read)
-	erroneous_read_id = np.where(np.sum(error_read_perbase_indicator, axis=1) > 0)[0]
-	## For erroneous reads, generate erroneous base based on the probability matrix
-	base_call_ref = {'A': ['C', 'G', 'T'], 'C': ['A', 'G', 'T'], 'G': ['A', 'C', 'T'], 'T': ['A', 'C', 'G']}
-	random.seed(2021)
-	read_df_witherror = read_df
-	for read_id_tqdm in tqdm(range(len(erroneous_read_id))):
-		read_id = erroneous_read_id[read_id_tqdm]
-		read_cur = read_df[(read_id*4) : (read_id*4 + 4)]
-		bases = list(read_cur[1][0].upper())
-		Qscores = list(read_cur[3][0])
-		for errorneous_base_id in np.where(error_read_perbase_indicator[read_id,:] > 0)[0]:
-			if errorneous_base_id < len(bases):
-				base_cur = bases[errorneous_base_id]
-				if base_cur in real_error_rate_read_prop_dict:
-					prop = real_error_rate_read_prop_dict[base_cur][errorneous_base_id]
-					# Decide error base
-					err_base_call = ErrorBase(base_cur, prop, base_call_ref)
-					bases[errorneous_base_id] = err_base_call
-					# Decide Q score
-					# Use 9 (Phred score 24) for erroneous base
-					Qscores[errorneous_base_id] = '9'
-		read_df_witherror[read_id*4+1] = ''.join(bases)
-		read_df_witherror[read_id*4+3] = ''.join(Qscores)
-	## Write out
-	np.savetxt(output_fq_file, read_df_witherror, fmt='%s')
-
-
-def SubstiError_Pair(real_error_rate_file, outdirectory, synthetic_fastq_prename):
+	Utility.add_substitution_errors(input_fq_file, output_fq_file, real_error_rate_read, chunk_size, n_cores, random_seed, stream, compress_threads)
+
+
+def SubstiError_Pair(real_error_rate_file, outdirectory, synthetic_fastq_prename, chunk_size=65536, n_cores=1, random_seed=2022, compress=False, compress_threads=1):
 	"""Generate random errors for paired-end sequencing reads according to input real data error rates. 
 
 	Parameters
 	----------
 	real_error_rate_file: `str`
-		Path to software fgbio jar script.
+		Path to the per read position error rate table output by `Utility.profile_error_rates` (or fgbio ErrorRateByReadPosition).
 	outdirectory: `str`
 		Specify the output directory of the synthteic FASTQ file with random errors.
 	synthetic_fastq_prename: `str`
 		Specify the base name of the synthetic erroneous reads' FASTQ files.
+	chunk_size: `int` (default: 65536)
+		Number of reads processed at a time.
+	n_cores: `int` (default: 1)
+		Number of processes introducing errors.
+	random_seed: `int` (default: 2022)
+		Random seed of the errors.
+	compress: `bool` (default: False)
+		Whether to BGZF compress the output FASTQ files. Input FASTQ files ending with '.fq.gz' are read when the '.fq' ones do not exist.
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of each compressed FASTQ file.
 	"""
 	# Read in real error rates
 	real_error_rate_dir = real_error_rate_file
 	real_error_rate = pd.read_csv(real_error_rate_dir, header=0, delimiter="\t")
-	real_error_rate_read1 = real_error_rate[real_error_rate['read_number'] == 1]
-	real_error_rate_read2 = real_error_rate[real_error_rate['read_number'] == 2]
-	# Read in perfect reads
-	read1_fq = outdirectory  + "/" + synthetic_fastq_prename + ".read1.bed2fa.fq"
-	read2_fq = outdirectory  + "/" + synthetic_fastq_prename + ".read2.bed2fa.fq"
-	read1_df = pd.read_csv(read1_fq, header=None).to_numpy()
-	read2_df = pd.read_csv(read2_fq, header=None).to_numpy()
 	# Generate random error according to Real data
-	ErroneousRead(real_error_rate_read1, read1_df, outdirectory + "/" + synthetic_fastq_prename + ".ErrorIncluded.read1.bed2fa.fq") 
-	ErroneousRead(real_error_rate_read2, read2_df, outdirectory + "/" + synthetic_fastq_prename + ".ErrorIncluded.read2.bed2fa.fq") 
+	for read_number in [1, 2]:
+		real_error_rate_read = real_error_rate[real_error_rate['read_number'] == read_number]
+		read_fq = Utility.resolve_output_file("%s/%s.read%d.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, read_number))
+		ErroneousRead(real_error_rate_read, read_fq, "%s/%s.ErrorIncluded.read%d.bed2fa.fq%s" % (outdirectory, synthetic_fastq_prename, read_number, Utility.output_suffix(compress)), chunk_size, n_cores, random_seed, read_number, compress_threads)
 
 
-def scATAC_ErrorBase(fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory, synthetic_fastq_prename):
+def scATAC_ErrorBase(fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory, synthetic_fastq_prename, sort_reads=False, sort_memory="1G", temp_directory=None, n_cores=1, random_seed=2022, n_profile_reads=100000, compress=False, compress_threads=1):
 	"""Introduce random substitution errors into synthetic reads according to real data error rates.
 
 	Parameters
 	----------
 	fgbio_jarfile: `str`
-		Path to software fgbio jar script.
+		Path to software fgbio jar script. Not used anymore: error rates are profiled in-process (see `Utility.profile_error_rates`).
 	INPUT_bamfile: `str`
-		Input BAM file for anlaysis.
+		Input BAM file for anlaysis, coordinate-sorted and indexed.
 	referenceGenome_file: 'str'
 		Reference genome FASTA file that the synthteic reads should align.
 	outdirectory: `str`
 		Specify the output directory of the synthteic FASTQ file with random errors.
 	synthetic_fastq_prename: `str`
 		Base name of the synthetic FASTQ files output by function `scATAC_BED2FASTQ`.
+	sort_reads: `bool` (default: False)
+		Whether to sort the reads by name. Reads keep the order of the input FASTQ files otherwise, which is the same for read 1 and read 2.
+	sort_memory: `str` (default: '1G')
+		Memory budget of the external merge sort (see `Utility.sort_fastq`).
+	temp_directory: `str` (default: None)
+		Directory of the temporary files of the sort. If None, use `outdirectory`.
+	n_cores: `int` (default: 1)
+		Number of processes introducing errors and merging sorted runs.
+	random_seed: `int` (default: 2022)
+		Random seed of the errors. The output does not depend on `n_cores`.
+	n_profile_reads: `int` (default: 100000)
+		Number of reads sampled from the start of each chromosome to estimate the error rates. If None, use all reads.
+	compress: `bool` (default: False)
+		Whether to BGZF compress the output FASTQ files, named with suffix '.fq.gz' instead of '.fq'. Compressed synthetic FASTQ files of `scATAC_BED2FASTQ` are read when the uncompressed ones do not exist.
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of each compressed FASTQ file.
 	"""
 	print('[scReadSim] Substitution Error Calculating...')
-	combine_read1_cmd = "java -jar %s ErrorRateByReadPosition -i %s -r %s -o %s/Real --collapse false" % (fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory)
-	output, error = subprocess.Popen(combine_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print('[Messages] Running fgbio on real bam file:\n', error.decode())
+	real_error_rate_file = outdirectory + "/" + "Real.error_rate_by_read_position.txt"
+	Utility.profile_error_rates(INPUT_bamfile, referenceGenome_file, real_error_rate_file, n_profile_reads, n_cores=n_cores)
 	# Generate Errors into fastq files
 	print('[scReadSim] Generting Synthetic Read FASTQ Files with Substitution Errors...')
-	real_error_rate_file = outdirectory + "/" + "Real.error_rate_by_read_position.txt"
-	SubstiError_Pair(real_error_rate_file, outdirectory, synthetic_fastq_prename)
-	# Combine FASTQs
-	print('[scReadSim] Sorting FASTQ files...')
-	sort_fastq_read1_cmd = "cat %s/%s.ErrorIncluded.read1.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print('[ERROR] Fail to sort read1 synthetic fastq file:', error.decode())
-	sort_fastq_read2_cmd = "cat %s/%s.ErrorIncluded.read2.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to sort read2 synthetic fastq file:', error.decode())
+	SubstiError_Pair(real_error_rate_file, outdirectory, synthetic_fastq_prename, n_cores=n_cores, random_seed=random_seed, compress=compress, compress_threads=compress_threads)
+	if sort_reads:
+		print('[scReadSim] Sorting FASTQ files...')
+	suffix = Utility.output_suffix(compress)
+	for read_no in ["read1", "read2"]:
+		Utility.order_fastq("%s/%s.ErrorIncluded.%s.bed2fa.fq%s" % (outdirectory, synthetic_fastq_prename, read_no, suffix), "%s/%s.ErrorIncluded.%s.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, read_no, suffix), sort_reads, sort_memory, temp_directory, n_cores, compress_threads)
 	print("\n[scReadSim] Created:")
-	print("[scReadSim] Read 1 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
-	print("[scReadSim] Read 2 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
+	print("[scReadSim] Read 1 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix))
+	print("[scReadSim] Read 2 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix))
 	print("[scReadSim] Done.")
 
 
@@ -7,12 +7,12 @@ import sys
 import os
 pd.options.mode.chained_assignment = None  # default='warn'
 import string
-import random
 import subprocess
 from tqdm import tqdm
 from pathlib import Path
 from joblib import Parallel, delayed
 import pysam
+import scReadSim.Utility as Utility
 from collections import defaultdict
 
 
@@ -26,8 +26,8 @@ def flatten(x):
 		return [x]
 
 
-def cellbarcode_generator(length, size=10):
-	"""Generate random cellbarcode.
+def cellbarcode_generator(length, size=10, rng=None, whitelist=None, min_distance=1, groups=None):
+	"""Generate distinct random cell barcodes or UMIs (see `Utility.generate_barcodes`).
 
 	Parameters
 	----------
@@ -35,15 +35,144 @@ def cellbarcode_generator(length, size=10):
 		Number of cells.
 	size: `int` (default: '10')
 		Size of cell barcode. Default value is 10 bp.
+	rng: `numpy.random.Generator` (default: None)
+		Random generator to draw the barcodes from. If None, use a generator seeded with 2022.
+	whitelist: `str` (default: None)
+		Barcode whitelist file to sample the barcodes from.
+	min_distance: `int` (default: 1)
+		Minimum Hamming distance between any two barcodes.
+	groups: `numpy.ndarray` (default: None)
+		Group index of each barcode, e.g. the cell of each UMI, if barcodes only need to be distinct within their group.
 
 	Return
 	------
 	cb_list: `list`
 		List of randomly generated cell barcodes.
 	"""
-	chars = 'ACGT'
-	cb_list = [''.join(random.choice(chars) for _ in range(size)) for cell in range(length)]
-	return cb_list
+	return Utility.generate_barcodes(length, size, rng, whitelist, min_distance, groups)
+
+
+def umi_read_index(samfile, chrom, start, end, UMI_tag):
+	"""Collect the reads of a feature carrying a UMI tag, grouped by UMI.
+
+	Parameters
+	----------
+	samfile: `pysam.AlignmentFile`
+		Input BAM file.
+	chrom: `str`
+		Chromosome of the feature.
+	start: `int`
+		Start of the feature.
+	end: `int`
+		End of the feature.
+	UMI_tag: `str`
+		UMI tag of the input BAM file.
+
+	Return
+	------
+	umi_offsets: `numpy.ndarray`
+		Offsets of the reads of each UMI, in order of first appearance, into `read_starts` and `read_strands`, of length the number of UMIs + 1.
+	read_starts: `numpy.ndarray`
+		Start (int32) of each read.
+	read_strands: `numpy.ndarray`
+		Strand (int8) of each read, 1 for '+' and 0 for '-'.
+	"""
+	umi_index = {}
+	read_umi = []
+	read_starts = []
+	read_strands = []
+	for read in samfile.fetch(chrom, start, end):
+		if read.has_tag(UMI_tag):
+			read_umi.append(umi_index.setdefault(read.get_tag(UMI_tag), len(umi_index)))
+			read_starts.append(read.reference_start)
+			read_strands.append(not read.is_reverse)
+	read_umi = np.asarray(read_umi, dtype=np.int64)
+	order = np.argsort(read_umi, kind='stable')
+	umi_offsets = np.zeros(len(umi_index) + 1, dtype=np.int64)
+	np.cumsum(np.bincount(read_umi, minlength=len(umi_index)), out=umi_offsets[1:])
+	return umi_offsets, np.asarray(read_starts, dtype=np.int32)[order], np.asarray(read_strands, dtype=np.int8)[order]
+
+
+def sample_umi_reads(rng, umi_offsets, read_starts, read_strands, UMI_count_vec, jitter_size):
+	"""Sample the synthetic UMIs and reads of a feature from its real UMIs and synthetic UMI counts.
+
+	Each synthetic UMI copies the read number and reads of a real UMI drawn uniformly, i.e. its read number follows the empirical distribution of the real UMIs and its reads are drawn with replacement from a real UMI of that read number. All draws are bulk operations on integer arrays.
+
+	Parameters
+	----------
+	rng: `numpy.random.Generator`
+		Random generator of the feature (see `Utility.feature_rng`).
+	umi_offsets: `numpy.ndarray`
+		Offsets of the reads of each real UMI (see `umi_read_index`).
+	read_starts: `numpy.ndarray`
+		Start of each real read.
+	read_strands: `numpy.ndarray`
+		Strand of each real read.
+	UMI_count_vec: `numpy.ndarray`
+		Synthetic UMI count of each cell.
+	jitter_size: `int`
+		Range of random shift of the reads.
+
+	Return
+	------
+	umi_reads: `dict`
+		Synthetic UMIs, with 'umi_cell' (cell index) and 'umi' (UMI string) of each UMI, and synthetic reads in order of cells and UMIs, with 'read_umi' (UMI index), 'frag_no' (read number within its cell), 'start' and 'strand' of each read.
+	"""
+	UMI_count_vec = np.asarray(UMI_count_vec, dtype=np.int64)
+	nonzero_cells = np.nonzero(UMI_count_vec)[0]
+	umi_cell = np.repeat(nonzero_cells, UMI_count_vec[nonzero_cells])
+	nread_perUMI = np.diff(umi_offsets)
+	source_umi = rng.integers(len(nread_perUMI), size=len(umi_cell))
+	nread_synthetic_perUMI = nread_perUMI[source_umi]
+	read_umi = np.repeat(np.arange(len(umi_cell)), nread_synthetic_perUMI)
+	read_index = umi_offsets[source_umi][read_umi] + rng.integers(nread_synthetic_perUMI[read_umi])
+	# Synthetic UMI strings, distinct within each cell
+	UMI_cell_groups = np.repeat(np.arange(len(nonzero_cells)), UMI_count_vec[nonzero_cells])
+	umi = cellbarcode_generator(len(umi_cell), size=10, rng=rng, groups=UMI_cell_groups)
+	read_cell = umi_cell[read_umi]
+	jitter_value_vec = rng.integers(-jitter_size, jitter_size, size=len(read_index))
+	return {
+		'umi_cell': umi_cell,
+		'umi': umi,
+		'read_umi': read_umi,
+		'frag_no': np.arange(len(read_cell)) - np.searchsorted(read_cell, read_cell),
+		'start': read_starts[read_index].astype(np.int64) - 1 + jitter_value_vec, # -1 accounts for the BAM coordinates is +1 compared with getfasta bedtools
+		'strand': read_strands[read_index],
+		}
+
+
+def umi_read_bed_lines(chrom, umi_reads, cellbarcode_list, rec_name, read_len):
+	"""Format synthetic reads as BED lines, named '<cell barcode><UMI>:CellNo<cell number>:<feature>#<read number>'.
+
+	"""
+	name_prefix = ["%s%s:CellNo%d:%s#" % (cellbarcode_list[cell], umi, cell + 1, rec_name) for cell, umi in zip(umi_reads['umi_cell'].tolist(), umi_reads['umi'])]
+	return ''.join(["%s\t%d\t%d\t%s%04d\t%d\t%s\n" % (chrom, start, start + read_len, name_prefix[umi_ind], frag_no, read_len, '+' if strand == 1 else '-') for start, umi_ind, frag_no, strand in zip(umi_reads['start'].tolist(), umi_reads['read_umi'].tolist(), umi_reads['frag_no'].tolist(), umi_reads['strand'].tolist())])
+
+
+def scRNA_GenerateBAMCoord_shard(shard):
+	"""Generate the synthetic reads of one shard of features into a bed file, with the persistent BAM handle of a worker set up by `Utility.synthesis_worker_init`.
+
+	The shard is a tuple (feature_ids, bed_files, file_mode, settings), see `Utility.run_synthesis_shards`. Each feature samples from its own random generator, keyed by its index.
+	"""
+	feature_ids, bed_files, file_mode, settings = shard
+	worker_state = Utility.count_worker_state
+	samfile = worker_state["samfile"]
+	UMI_count_mat = worker_state["count_mat"]
+	open_peak = worker_state["open_peak"]
+	random_cellbarcode_list = worker_state["cellbarcode_list"]
+	UMI_tag = settings["UMI_tag"]
+	read_len = settings["read_len"]
+	jitter_size = settings["jitter_size"]
+	with Utility.BufferedFileWriter(bed_files, flush_size=settings["flush_size"], mode=file_mode) as bed_writer:
+		for peak_ind in feature_ids:
+			rec = open_peak[peak_ind]
+			rec_name = '_'.join(rec)
+			rng = Utility.feature_rng(settings["random_seed"], peak_ind)
+			umi_offsets, read_starts, read_strands = umi_read_index(samfile, rec[0], int(rec[1]), int(rec[2]), UMI_tag)
+			if len(umi_offsets) == 1: # If no real UMIs exist in the gene, skip
+				continue
+			umi_reads = sample_umi_reads(rng, umi_offsets, read_starts, read_strands, UMI_count_mat.row(peak_ind), jitter_size)
+			bed_writer.write(umi_read_bed_lines(rec[0], umi_reads, random_cellbarcode_list, rec_name, read_len))
 
 
 # # Test 
@@ -51,7 +180,7 @@ def cellbarcode_generator(length, size=10):
 # outdirectory = "/home/guanao/Projects/scIsoSim/results/20230204"
 # cell_label_file = outdirectory+"/"+"NGS_H2228_H1975_A549_H838_HCC827_Mixture_10X.UMIcountmatrix" + ".scDesign2Simulated.CellTypeLabel.txt"
 
-def scRNA_GenerateBAMCoord(bed_file, UMI_count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=90, UMI_tag='UB:Z'):
+def scRNA_GenerateBAMCoord(bed_file, UMI_count_mat_file, synthetic_cell_label_file, read_bedfile_prename, INPUT_bamfile, outdirectory, OUTPUT_cells_barcode_file, jitter_size=5, read_len=90, UMI_tag='UB:Z', flush_size=16777216, n_cores=1, random_seed=2022, sort_memory="1G", compress=False, compress_threads=1, cellbarcode_whitelist_file=None, cellbarcode_min_distance=1):
 	"""Generate Synthetic reads in BED format.
 
 	Parameters
@@ -59,7 +188,7 @@ def scRNA_GenerateBAMCoord(bed_file, UMI_count_mat_file, synthetic_cell_label_fi
 	bed_file: `str`
 		Features' bed file to generate the synthetic reads (Generated by function `Utility.scRNA_CreateFeatureSets`).
 	UMI_count_mat_file: `str`
-		The path to synthetic UMI count matrix.
+		The path to synthetic UMI count matrix, either a Matrix Market file ('.mtx' or '.mtx.gz') with its '.features.txt' sidecar or a dense text matrix.
 	synthetic_cell_label_file: `str`
 		Synthetic cell label file generated by `scRNA_GenerateSyntheticCount`.
 	read_bedfile_prename: `str`
@@ -76,19 +205,32 @@ def scRNA_GenerateBAMCoord(bed_file, UMI_count_mat_file, synthetic_cell_label_fi
 		Specify the length of synthetic reads. Default value is 90 bp.
 	UMI_tag: `str` (default: 'UB:Z')
 		If UMI_modeling is set to True, specify the UMI tag of input BAM file, default value 'UB:Z' is the UMI tag for 10x scRNA-seq.
+	flush_size: `int` (default: 16777216)
+		Number of characters of synthetic reads buffered in memory before the bed file is written.
+	n_cores: `int` (default: 1)
+		Number of processes generating synthetic reads. The output does not depend on the number of processes.
+	random_seed: `int` (default: 2022)
+		Root seed of the random generators. Each feature samples from its own generator seeded by `random_seed` and the feature index.
+	sort_memory: `str` (default: '1G')
+		Memory budget of sorting the output bed file by coordinate (see `Utility.sort_bed`).
+	compress: `bool` (default: False)
+		Whether to write a BGZF-compressed, tabix-indexed bed file ('.read.bed.gz').
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of the compressed bed file.
+	cellbarcode_whitelist_file: `str` (default: None)
+		Barcode whitelist file, e.g. the 10x Genomics whitelist, to sample the 16 bp synthetic cell barcodes from (see `Utility.generate_barcodes`). If None, cell barcodes are drawn at random.
+	cellbarcode_min_distance: `int` (default: 1)
+		Minimum Hamming distance between any two synthetic cell barcodes. Cell barcodes are always distinct.
 	"""
-	UMI_count_mat_df = pd.read_csv("%s" % (UMI_count_mat_file), header=None, delimiter="\t")
-	# Remove count matrix first column: feature names
-	UMI_count_mat = UMI_count_mat_df.iloc[: , 1:].to_numpy()
+	UMI_count_mat = Utility.read_countmat(UMI_count_mat_file)
 	UMI_count_mat_cluster = pd.read_csv(synthetic_cell_label_file, header=None, delimiter="\t").to_numpy().flatten()	
-	n_cell = np.shape(UMI_count_mat)[1]
-	samfile = pysam.AlignmentFile(INPUT_bamfile, "rb")
+	n_cell = UMI_count_mat.n_cell
 	with open(bed_file) as open_peak:
 		reader = csv.reader(open_peak, delimiter="\t")
 		open_peak = np.asarray(list(reader))
-	peak_nonzero_id = np.nonzero(UMI_count_mat.sum(axis=1))[0]
-	random.seed(2022)
-	random_cellbarcode_list = cellbarcode_generator(n_cell, size=16)
+	peak_nonzero_id = np.nonzero(UMI_count_mat.row_sums())[0]
+	# Fixed seed, so that the read bed files of all feature sets share the cell barcodes
+	random_cellbarcode_list = cellbarcode_generator(n_cell, size=16, rng=np.random.default_rng(2022), whitelist=cellbarcode_whitelist_file, min_distance=cellbarcode_min_distance)
 	with open(OUTPUT_cells_barcode_file, 'w') as f:
 		for item in random_cellbarcode_list:
 			f.write(item + "\n")
@@ -96,79 +238,19 @@ def scRNA_GenerateBAMCoord(bed_file, UMI_count_mat_file, synthetic_cell_label_fi
 	with open(OUTPUT_cells_barcode_file + ".withSynthCluster", 'w') as f:
 		for item in cellbarcode_list_withclusters:
 			f.write("\t".join(item) + "\n")
-	with open("%s/%s.read.bed" % (outdirectory, read_bedfile_prename), 'w') as fp:
-		pass
+	worker_data = {"count_mat": UMI_count_mat, "open_peak": open_peak, "cellbarcode_list": random_cellbarcode_list}
+	settings = {"jitter_size": jitter_size, "read_len": read_len, "UMI_tag": UMI_tag, "random_seed": random_seed, "flush_size": flush_size}
 	print("[scReadSim] Generating Synthetic Reads for Feature Set: %s" % (bed_file))
-	for relative_peak_ind in tqdm(range(len(peak_nonzero_id))):
-		peak_ind = peak_nonzero_id[relative_peak_ind]
-		rec = open_peak[peak_ind]
-		rec_name = '_'.join(rec)
-		UMI_read_dict_pergene = defaultdict(lambda: [])
-		reads = samfile.fetch(rec[0], int(rec[1]), int(rec[2]))
-		for read in reads:
-			if read.has_tag(UMI_tag):
-				UMI = read.get_tag(UMI_tag)
-				start = read.reference_start
-				if read.is_reverse==1:
-					strand = "-" 
-				else:
-					strand = "+"
-				# strand = read.is_reverse
-				UMI_read_dict_pergene[UMI].append(str(start) + ":" + str(strand))
-		## Real data: Obtain the empirical distribution of # reads of UMI in the gene 
-		UMI_real_vec = list(UMI_read_dict_pergene.keys())
-		nread_perUMI = [len(x) for x in UMI_read_dict_pergene.values()] # return a vector with the length of # UMIs in the gene
-		# nread_perUMI_prob = nread_perUMI / np.sum(nread_perUMI)
-		## Synthetic data
-		# Sample syntheitc UMI's read number and assign real UMI to synthetic UMI (only for sampling reads)
-		UMI_count_vec = UMI_count_mat[peak_ind,:] # Synthetic umi count
-		nonzer_UMI_zero_id = np.nonzero(UMI_count_vec)[0]
-		synthetic_nread_perUMI_percell = [np.random.choice(nread_perUMI, size=UMI_count_vec[i], replace=True) for i in nonzer_UMI_zero_id] # return a vector with the length of non-zero count cells, each entry idnicates the number of reads for each UMI
-		nread_synthetic = sum(np.sum(x) for x in synthetic_nread_perUMI_percell) # total number of synthetic reads
-		# Assign real UMI to synthetic UMI based on read number per UMI
-		# Construct a dic with keys as number of reasd per UMI and values as the corresponding UMI strings
-		nread_UMI_dic = defaultdict(lambda: [])
-		for i,item in enumerate(nread_perUMI):
-			nread_UMI_dic[item].append(UMI_real_vec[i])
-		synthetic_nread_perUMI_percell_unlist = [xs for x in synthetic_nread_perUMI_percell for xs in list(x)]
-		synthetic_realUMI_assign_array = np.array(synthetic_nread_perUMI_percell_unlist).astype(str)
-		synthetic_nread_perUMI_percell_unlist_array = np.array(synthetic_nread_perUMI_percell_unlist)
-		for i in set(synthetic_nread_perUMI_percell_unlist):
-			tmp_ind = np.where(synthetic_nread_perUMI_percell_unlist_array == i)[0]
-			synthetic_realUMI_assign_array[tmp_ind] = np.random.choice(nread_UMI_dic[i], size=len(tmp_ind), replace=True)
-		synthetic_realUMI_assign_vec = list(synthetic_realUMI_assign_array) # a vectir sane length to synthetic_nread_perUMI_percell_unlist, synthetic UMI's number 
-		# synthetic_realUMI_assign_vec = [np.random.choice(nread_UMI_dic[nread], size=1, replace=True) for nread in synthetic_nread_perUMI_percell_unlist]
-		# Sample reads for each synthetic UMI
-		synthetic_read_list = [np.random.choice(UMI_read_dict_pergene[synthetic_realUMI_assign_vec[id]], size=synthetic_nread_perUMI_percell_unlist[id], replace=True) for id in range(len(synthetic_realUMI_assign_vec))]
-		synthetic_read_unlist = [xs for x in synthetic_read_list for xs in list(x)]
-		synthetic_read_start_list = [int(xs.split(':', 1)[0]) - 1  for xs in synthetic_read_unlist]  # -1 accounts for the BAM coordinates is +1 compared with getfasta bedtools
-		synthetic_read_strand_list = [str(xs.split(':', 1)[1]) for xs in synthetic_read_unlist]
-		# Creat synthetic UMI string
-		UMI_synthetic_uniq = cellbarcode_generator(np.sum(UMI_count_vec), size=10)
-		UMI_synthetic_list = np.repeat(np.array(UMI_synthetic_uniq), synthetic_nread_perUMI_percell_unlist)
-		# Create syntheitc CB string
-		CB_synthetic_repeat = [np.sum(x) for x in synthetic_nread_perUMI_percell] # same length to nozero cells
-		CB_synthetic_list = np.repeat(np.array(random_cellbarcode_list)[nonzer_UMI_zero_id], CB_synthetic_repeat)
-		# Create syntheitc read name string
-		read_name_remaining_list = ["CellNo" + str(nonzer_UMI_zero_id[ind] + 1) + ":" + str(rec_name) + "#" + str(count).zfill(4) for ind in range(len(CB_synthetic_repeat)) for count in range(CB_synthetic_repeat[ind])]
-		read_name_list = [CB_synthetic_list[id] + UMI_synthetic_list[id] + ":" + read_name_remaining_list[id] for id in range(nread_synthetic)]
-		# Create output table
-		jitter_value_vec = np.random.randint(-jitter_size,jitter_size,size=nread_synthetic)  # nrow(reads_cur) should equal to nfrag_cur
-		reads_cur = pd.DataFrame({
-			'chr': rec[0],
-			'r1_start_shifted': synthetic_read_start_list  + jitter_value_vec,
-			'r1_end_shifted': synthetic_read_start_list + jitter_value_vec + read_len,
-			'read_name': read_name_list,
-			'read_length': read_len,
-			'strand': synthetic_read_strand_list
-			})
-		reads_cur.to_csv("%s/%s.read.bed" % (outdirectory, read_bedfile_prename), header=None, index=None, sep='\t', mode='a')
+	suffix = Utility.output_suffix(compress)
+	Utility.run_synthesis_shards(scRNA_GenerateBAMCoord_shard, peak_nonzero_id, ["%s/%s.read.bed%s" % (outdirectory, read_bedfile_prename, suffix)], INPUT_bamfile, worker_data, settings, n_cores=n_cores, sort_memory=sort_memory, compress_threads=compress_threads)
 	print("\n[scReadSim] Created:")
-	print("[scReadSim] Read bed file: %s/%s.read.bed" % (outdirectory, read_bedfile_prename))
+	print("[scReadSim] Read bed file: %s/%s.read.bed%s" % (outdirectory, read_bedfile_prename, suffix))
+
 
+def scRNA_CombineBED(outdirectory, gene_read_bedfile_prename, intergene_read_bedfile_prename, BED_filename_combined_pre, compress=False, compress_threads=1):
+	"""Combine the bed files of foreground and background feature sets into one coordinate-sorted bed file.
 
-def scRNA_CombineBED(outdirectory, gene_read_bedfile_prename, intergene_read_bedfile_prename, BED_filename_combined_pre):
-	"""Combine the bed files of foreground and background feature sets into one bed file.
+	The bed files, sorted by `scRNA_GenerateBAMCoord` and compressed or not, are merged with a streaming k-way merge (see `Utility.merge_sorted_beds`).
 
 	Parameters
 	----------
@@ -180,73 +262,66 @@ def scRNA_CombineBED(outdirectory, gene_read_bedfile_prename, intergene_read_bed
 		File prename of background synthetic reads bed file.
 	BED_filename_combined_pre: 'str'
 		Specify the combined syntehtic reads bed file prename. The combined bed file will be output to `outdirectory`.
+	compress: `bool` (default: False)
+		Whether to write a bgzip-compressed, tabix-indexed bed file ('.read.bed.gz' and '.read.bed.gz.tbi').
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of the compressed bed file.
 	"""
 	print("[scReadSim] Combining Synthetic Read Bed Files from Genes and InterGenes.")
-	combine_read_cmd = "cat %s/%s.read.bed %s/%s.read.bed | sort -k1,1 -k2,2n > %s/%s.read.bed" % (outdirectory, gene_read_bedfile_prename, outdirectory, intergene_read_bedfile_prename, outdirectory, BED_filename_combined_pre)
-	output, error = subprocess.Popen(combine_read_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print('[ERROR] Fail to create combine synthetic read bed files:\n', error.decode())
+	combined_bed_file = "%s/%s.read.bed%s" % (outdirectory, BED_filename_combined_pre, Utility.output_suffix(compress))
+	Utility.merge_sorted_beds([[Utility.resolve_output_file("%s/%s.read.bed" % (outdirectory, bed_file_pre))] for bed_file_pre in [gene_read_bedfile_prename, intergene_read_bedfile_prename]], [combined_bed_file], compress, threads=compress_threads)
 	print("\n[scReadSim] Created:")
-	print("[scReadSim] Combined Read Bed File: %s/%s.read.bed" % (outdirectory, BED_filename_combined_pre))
+	print("[scReadSim] Combined Read Bed File: %s" % combined_bed_file)
 	print("[scReadSim] Done.")
 
 
-def scRNA_BED2FASTQ(bedtools_directory, seqtk_directory, referenceGenome_file, outdirectory, BED_filename_combined, synthetic_fastq_prename):
+def scRNA_BED2FASTQ(bedtools_directory, seqtk_directory, referenceGenome_file, outdirectory, BED_filename_combined, synthetic_fastq_prename, compress=False, flush_size=16777216, sort_reads=False, sort_memory="1G", temp_directory=None, n_cores=1, compress_threads=1):
 	"""Convert Synthetic reads from BED to FASTQ. 
 
 	Parameters
 	----------
 	bedtools_directory: `str`
-		Path to software bedtools.
+		Path to software bedtools. Not used anymore: read sequences are extracted in-process.
 	seqtk_directory: `str`
-		Path to software seqtk.
+		Path to software seqtk. Not used anymore: FASTQ files are written in-process.
 	referenceGenome_file: `str`
-		Reference genome FASTA file that the synthteic reads should align.
+		Reference genome FASTA file that the synthteic reads should align. The '.fai' index is built if missing.
 	outdirectory: `str`
 		Output directory of the synthteic bed file and its corresponding cell barcodes file.
 	BED_filename_combined: `str`
-		Base name of the combined bed file output by function `scRNA_CombineBED`.
+		Base name of the combined bed file output by function `scRNA_CombineBED`, compressed or not.
 	synthetic_fastq_prename
 		Specify the base name of the output FASTQ files.
+	compress: `bool` (default: False)
+		Whether to BGZF compress the FASTQ files, named with suffix '.fq.gz' instead of '.fq'. BGZF files are readable by gzip.
+	flush_size: `int` (default: 16777216)
+		Number of characters of FASTQ records buffered in memory before the files are written.
+	sort_reads: `bool` (default: False)
+		Whether to sort the reads by name. Read 1 and read 2 FASTQ files are always written in the same read order, so sorting is not needed for pairing.
+	sort_memory: `str` (default: '1G')
+		Memory budget of the external merge sort (see `Utility.sort_fastq`).
+	temp_directory: `str` (default: None)
+		Directory of the temporary files of the sort. If None, use `outdirectory`.
+	n_cores: `int` (default: 1)
+		Number of processes merging sorted runs.
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of each compressed FASTQ file.
 	"""
-	# Create FASTA
-	print('[scReadSim] Generating Synthetic Read FASTA files...')
-	fasta_read2_cmd = "%s/bedtools getfasta -s -nameOnly -fi %s -bed %s/%s.read.bed -fo %s/%s.read2.strand.bed2fa.fa" % (bedtools_directory, referenceGenome_file, outdirectory, BED_filename_combined, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(fasta_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print(error.decode())
-	# remove (-) or (+)
-	org_fasta_read2_cmd = "sed '/^>/s/.\{3\}$//' %s/%s.read2.strand.bed2fa.fa > %s/%s.read2.bed2fa.fa" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(org_fasta_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print('[ERROR] Fail to remove strand infomormation from synthetic read fasta file:\n', error.decode())
-	# Create Read 1 from Read 2
-	fasta_read1_cmd = "awk 'NR%%2==0 {print substr(p,2,26);} NR%%2 {p=$0;print p;}' %s/%s.read2.bed2fa.fa > %s/%s.read1.bed2fa.fa" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(fasta_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print(error.decode())
-	# FASTA to FASTQ
+	fastq_suffix = "fq" + Utility.output_suffix(compress)
+	sorted_fastq_files = ["%s/%s.read1.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix), "%s/%s.read2.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix)]
+	fastq_files = ["%s/%s.read1.bed2fa.fq" % (outdirectory, synthetic_fastq_prename), "%s/%s.read2.bed2fa.fq" % (outdirectory, synthetic_fastq_prename)] if sort_reads else sorted_fastq_files
+	# Read 2 holds the cDNA sequence and read 1 the cell barcode and UMI leading the read name
 	print('[scReadSim] Generating Synthetic Read FASTQ files...')
-	fastq_read1_cmd = "%s/seqtk seq -F 'F' %s/%s.read1.bed2fa.fa > %s/%s.read1.bed2fa.fq" % (seqtk_directory, outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to convert read1 synthetic fasta file to fastq file:', error.decode())
-	fastq_read2_cmd = "%s/seqtk seq -F 'F' %s/%s.read2.bed2fa.fa > %s/%s.read2.bed2fa.fq" % (seqtk_directory, outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to convert read2 synthetic fasta file to fastq file:', error.decode())
-	print('[scReadSim] Sorting FASTQ files...')
-	sort_fastq_read1_cmd = "cat %s/%s.read1.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to sort read1 synthetic fastq file:', error.decode())
-	sort_fastq_read2_cmd = "cat %s/%s.read2.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to sort read2 synthetic fastq file:', error.decode())
+	n_skipped = Utility.bed2fastq([Utility.resolve_output_file("%s/%s.read.bed" % (outdirectory, BED_filename_combined))], [fastq_files[1]], referenceGenome_file, barcode_fastq_file=fastq_files[0], barcode_length=26, flush_size=flush_size, compress_threads=compress_threads)
+	if n_skipped > 0:
+		print("[Warning] %d synthetic reads outside the reference genome were skipped." % n_skipped)
+	if sort_reads:
+		print('[scReadSim] Sorting FASTQ files...')
+		for fastq_file, sorted_fastq_file in zip(fastq_files, sorted_fastq_files):
+			Utility.order_fastq(fastq_file, sorted_fastq_file, True, sort_memory, temp_directory, n_cores, compress_threads)
 	print("\n[scReadSim] Created:")
-	print("[scReadSim] Read 1 FASTQ File: %s/%s.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
-	print("[scReadSim] Read 2 FASTQ File: %s/%s.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
+	print("[scReadSim] Read 1 FASTQ File: %s/%s.read1.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix))
+	print("[scReadSim] Read 2 FASTQ File: %s/%s.read2.bed2fa.sorted.%s" % (outdirectory, synthetic_fastq_prename, fastq_suffix))
 	print("[scReadSim] Done.")
 
 
@@ -296,131 +371,146 @@ def AlignSyntheticBam_Single(bowtie2_directory, samtools_directory, outdirectory
 	print("[scReadSim] Done.")
 
 
-## Error rate
-def ErrorBase(base, prop, base_call_ref):
-	"""Sample random errors. 
+def scRNA_BED2BAM(referenceGenome_file, outdirectory, BED_filename_combined, output_BAM_pre, n_threads=1, sort_memory="768M", chunk_size=500000):
+	"""Write synthetic reads from BED directly to a BAM file aligned at their true positions, skipping the FASTQ conversion and realignment with `scRNA_BED2FASTQ` and `AlignSyntheticBam_Single`.
+
+	Read sequences come from the indexed reference genome. Each read gets CIGAR '<length>M' and the 'CB' and 'UB' tags of its name. Use `AlignSyntheticBam_Single` instead when aligner artifacts are needed.
 
+	Parameters
+	----------
+	referenceGenome_file: `str`
+		Reference genome FASTA file that the synthteic reads come from. The '.fai' index is built if missing.
+	outdirectory: `str`
+		Directory of the combined bed file and of the output BAM file.
+	BED_filename_combined: `str`
+		Base name of the combined bed file output by function `scRNA_CombineBED`, compressed or not.
+	output_BAM_pre: `str`
+		Specify the base name of the output BAM file.
+	n_threads: `int` (default: 1)
+		Number of threads for BAM compression and sorting.
+	sort_memory: `str` (default: '768M')
+		Memory per thread for sorting the BAM file.
+	chunk_size: `int` (default: 500000)
+		Number of reads loaded from the bed file at a time.
 	"""
-	err_base_call_id = np.random.choice(a=[0, 1, 2], size=1, p=prop)[0]      
-	err_base_call = base_call_ref[base][err_base_call_id]
-	return err_base_call
+	print('[scReadSim] Writing Synthetic Reads at their True Positions to BAM file...')
+	reference_genome = Utility.ReferenceGenome(referenceGenome_file)
+	header = Utility.truth_bam_header(reference_genome)
+	unsorted_bamfile = "%s/%s.synthetic.unsorted.bam" % (outdirectory, output_BAM_pre)
+	n_skipped = 0
+	with pysam.AlignmentFile(unsorted_bamfile, "wb", header=header, threads=n_threads) as bamfile:
+		for read_df in Utility.read_bed_chunks("%s/%s.read.bed" % (outdirectory, BED_filename_combined), chunk_size):
+			for chrom, name, start, end, strand in zip(read_df["chrom"].tolist(), read_df["name"].tolist(), read_df["start"].tolist(), read_df["end"].tolist(), read_df["strand"].tolist()):
+				if chrom not in reference_genome.chrom_size:
+					n_skipped += 1
+					continue
+				chrom_seq = reference_genome.chromosome(chrom)
+				# Reads running off the chromosome end are skipped, as bedtools getfasta does
+				if end > len(chrom_seq) or end <= start:
+					n_skipped += 1
+					continue
+				# Read names start with the 16 bp cell barcode followed by the UMI
+				barcode_umi = name.split(':', 1)[0]
+				tags = [("CB", barcode_umi[:16], "Z"), ("UB", barcode_umi[16:], "Z")]
+				bamfile.write(Utility.truth_aligned_segment(header, name, header.get_tid(chrom), start, chrom_seq[start:end], 0x10 if strand == '-' else 0, tags))
+	reference_genome.close()
+	if n_skipped > 0:
+		print("[Warning] %d synthetic reads outside the reference genome were skipped." % n_skipped)
+	print('[scReadSim] Sorting and Indexing BAM file...')
+	Utility.sort_index_bam(unsorted_bamfile, "%s/%s.synthetic.sorted.bam" % (outdirectory, output_BAM_pre), n_threads, sort_memory)
+	print("\n[scReadSim] Created:")
+	print("[scReadSim] Synthetic Read BAM File: %s/%s.synthetic.sorted.bam" % (outdirectory, output_BAM_pre))
+	print("[scReadSim] Done.")
 
 
-def ErroneousRead(real_error_rate_read, read_df, output_fq_file):
-	"""Generate random errors according to input real data error rates. 
+## Error rate
+def ErroneousRead(real_error_rate_read, input_fq_file, output_fq_file, chunk_size=65536, n_cores=1, random_seed=2022, stream=0, compress_threads=1):
+	"""Generate random errors according to input real data error rates, streaming the FASTQ file in chunks (see `Utility.add_substitution_errors`). 
 
 	"""
-	n_read = int(np.shape(read_df)[0]/4)
-	## Prepare Error rate
-	real_error_rate_read_A = real_error_rate_read[['a_to_c_error_rate', 'a_to_g_error_rate', 'a_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_A_prop = real_error_rate_read_A/real_error_rate_read_A.sum(axis=1,keepdims=1)
-	real_error_rate_read_A_prop[np.isnan(real_error_rate_read_A_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_C = real_error_rate_read[['c_to_a_error_rate', 'c_to_g_error_rate', 'c_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_C_prop = real_error_rate_read_C/real_error_rate_read_C.sum(axis=1,keepdims=1)
-	real_error_rate_read_C_prop[np.isnan(real_error_rate_read_C_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_G = real_error_rate_read[['g_to_a_error_rate', 'g_to_c_error_rate', 'g_to_t_error_rate']].to_numpy() 
-	real_error_rate_read_G_prop = real_error_rate_read_G/real_error_rate_read_G.sum(axis=1,keepdims=1)
-	real_error_rate_read_G_prop[np.isnan(real_error_rate_read_G_prop).any(axis=1),:] = 1/3
-	real_error_rate_read_T = real_error_rate_read[['t_to_a_error_rate', 't_to_c_error_rate', 't_to_g_error_rate']].to_numpy() 
-	real_error_rate_read_T_prop = real_error_rate_read_T/real_error_rate_read_T.sum(axis=1,keepdims=1)
-	real_error_rate_read_T_prop[np.isnan(real_error_rate_read_T_prop).any(axis=1),:] = 1/3
-	# Base decision matrix
-	real_error_rate_read_prop_dict = {'A': real_error_rate_read_A_prop, 'C': real_error_rate_read_C_prop, 'G': real_error_rate_read_G_prop, 'T': real_error_rate_read_T_prop}
-	# Error decision vector
-	real_error_rate_read_perbase = real_error_rate_read['error_rate'].to_numpy()
-	## Decide whether error occurs for each read
-	read_length = real_error_rate_read.shape[0]
-	error_read_perbase_indicator = np.zeros((n_read, read_length), dtype=int)
-	random.seed(1)
-	for base_id in range(read_length):
-		error_read_perbase_indicator[:,base_id] = np.random.binomial(n=1, p=real_error_rate_read_perbase[base_id], size=n_read)
-	erroneous_read_id = np.where(np.sum(error_read_perbase_indicator, axis=1) > 0)[0]
-	## For erroneous reads, generate erroneous base based on the probability matrix
-	base_call_ref = {'A': ['C', 'G', 'T'], 'C': ['A', 'G', 'T'], 'G': ['A', 'C', 'T'], 'T': ['A', 'C', 'G']}
-	random.seed(2021)
-	read_df_witherror = read_df
-	for read_id_tqdm in tqdm(range(len(erroneous_read_id))):
-		read_id = erroneous_read_id[read_id_tqdm]
-		read_cur = read_df[(read_id*4) : (read_id*4 + 4)]
-		bases = list(read_cur[1][0].upper())
-		Qscores = list(read_cur[3][0])
-		for errorneous_base_id in np.where(error_read_perbase_indicator[read_id,:] > 0)[0]:
-			if errorneous_base_id < len(bases):
-				base_cur = bases[errorneous_base_id]
-				if base_cur in real_error_rate_read_prop_dict:
-					prop = real_error_rate_read_prop_dict[base_cur][errorneous_base_id]
-					# Decide error base
-					err_base_call = ErrorBase(base_cur, prop, base_call_ref)
-					bases[errorneous_base_id] = err_base_call
-					# Decide Q score
-					# Use 9 (Phred score 24) for erroneous base
-					Qscores[errorneous_base_id] = '9'
-		read_df_witherror[read_id*4+1] = ''.join(bases)
-		read_df_witherror[read_id*4+3] = ''.join(Qscores)
-	## Write out
-	np.savetxt(output_fq_file, read_df_witherror, fmt='%s')
-
-
-def SubstiError(real_error_rate_file, outdirectory, synthetic_fastq_prename):
+	Utility.add_substitution_errors(input_fq_file, output_fq_file, real_error_rate_read, chunk_size, n_cores, random_seed, stream, compress_threads)
+
+
+def SubstiError(real_error_rate_file, outdirectory, synthetic_fastq_prename, chunk_size=65536, n_cores=1, random_seed=2022, compress=False, compress_threads=1):
 	"""Generate random errors for single-end sequencing reads according to input real data error rates. 
 
 	Parameters
 	----------
 	real_error_rate_file: `str`
-		Path to software fgbio jar script.
+		Path to the per read position error rate table output by `Utility.profile_error_rates` (or fgbio ErrorRateByReadPosition).
 	outdirectory: `str`
 		Specify the output directory of the synthteic FASTQ file with random errors.
 	synthetic_fastq_prename: `str`
 		Specify the base name of the synthetic erroneous reads' FASTQ files.
+	chunk_size: `int` (default: 65536)
+		Number of reads processed at a time.
+	n_cores: `int` (default: 1)
+		Number of processes introducing errors.
+	random_seed: `int` (default: 2022)
+		Random seed of the errors.
+	compress: `bool` (default: False)
+		Whether to BGZF compress the output FASTQ file. The input FASTQ file ending with '.fq.gz' is read when the '.fq' one does not exist.
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of the compressed FASTQ file.
 	"""
 	# Read in real error rates
 	real_error_rate_dir = real_error_rate_file
 	real_error_rate = pd.read_csv(real_error_rate_dir, header=0, delimiter="\t")
 	# Read in perfect reads
-	read2_fq = outdirectory  + "/" + synthetic_fastq_prename + ".read2.bed2fa.fq"
-	read2_df = pd.read_csv(read2_fq, header=None).to_numpy()
-	# Real data quality score
-	# Error rate to Qscore
-	ErroneousRead(real_error_rate, read2_df, outdirectory + "/" + synthetic_fastq_prename + ".ErrorIncluded.read2.bed2fa.fq") 
+	read2_fq = Utility.resolve_output_file(outdirectory  + "/" + synthetic_fastq_prename + ".read2.bed2fa.sorted.fq")
+	ErroneousRead(real_error_rate, read2_fq, outdirectory + "/" + synthetic_fastq_prename + ".ErrorIncluded.read2.bed2fa.fq" + Utility.output_suffix(compress), chunk_size, n_cores, random_seed, 2, compress_threads) 
 
 
-def scRNA_ErrorBase(fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory, synthetic_fastq_prename):
+def scRNA_ErrorBase(fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory, synthetic_fastq_prename, sort_reads=False, sort_memory="1G", temp_directory=None, n_cores=1, random_seed=2022, n_profile_reads=100000, compress=False, compress_threads=1):
 	"""Introduce random substitution errors into synthetic reads according to real data error rates.
 
 	Parameters
 	----------
 	fgbio_jarfile: `str`
-		Path to software fgbio jar script.
+		Path to software fgbio jar script. Not used anymore: error rates are profiled in-process (see `Utility.profile_error_rates`).
 	INPUT_bamfile: `str`
-		Input BAM file for anlaysis.
+		Input BAM file for anlaysis, coordinate-sorted and indexed.
 	referenceGenome_file: 'str'
 		Reference genome FASTA file that the synthteic reads should align.
 	outdirectory: `str`
 		Specify the output directory of the synthteic FASTQ file with random errors.
 	synthetic_fastq_prename: `str`
 		Base name of the synthetic FASTQ files output by function `scATAC_BED2FASTQ`.
+	sort_reads: `bool` (default: False)
+		Whether to sort the reads by name. Reads keep the order of the input FASTQ files otherwise, which is the same for read 1 and read 2.
+	sort_memory: `str` (default: '1G')
+		Memory budget of the external merge sort (see `Utility.sort_fastq`).
+	temp_directory: `str` (default: None)
+		Directory of the temporary files of the sort. If None, use `outdirectory`.
+	n_cores: `int` (default: 1)
+		Number of processes introducing errors and merging sorted runs.
+	random_seed: `int` (default: 2022)
+		Random seed of the errors. The output does not depend on `n_cores`.
+	n_profile_reads: `int` (default: 100000)
+		Number of reads sampled from the start of each chromosome to estimate the error rates. If None, use all reads.
+	compress: `bool` (default: False)
+		Whether to BGZF compress the output FASTQ files, named with suffix '.fq.gz' instead of '.fq'. Compressed synthetic FASTQ files of `scRNA_BED2FASTQ` are read when the uncompressed ones do not exist.
+	compress_threads: `int` (default: 1)
+		Number of background compression threads of each compressed FASTQ file.
 	"""
 	print('[scReadSim] Substitution Error Calculating...')
-	combine_read1_cmd = "java -jar %s ErrorRateByReadPosition -i %s -r %s -o %s/Real --collapse false" % (fgbio_jarfile, INPUT_bamfile, referenceGenome_file, outdirectory)
-	output, error = subprocess.Popen(combine_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-		print('[Messages] Running fgbio on real bam file:\n', error.decode())
-	# Generate Errors into fastq files
 	real_error_rate_file = outdirectory + "/" + "Real.error_rate_by_read_position.txt"
-	SubstiError(real_error_rate_file, outdirectory, synthetic_fastq_prename)
-	# Combine FASTQs
-	print('[scReadSim] Sorting FASTQ files...')
-	sort_fastq_read1_cmd = "cat %s/%s.read1.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read1_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to sort read1 synthetic fastq file:', error.decode())
-	sort_fastq_read2_cmd = "cat %s/%s.ErrorIncluded.read2.bed2fa.fq | paste - - - - | sort -k1,1 -S 3G | tr '\t' '\n' > %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename, outdirectory, synthetic_fastq_prename)
-	output, error = subprocess.Popen(sort_fastq_read2_cmd, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
-	if error:
-			print('[ERROR] Fail to sort read2 synthetic fastq file:', error.decode())
+	Utility.profile_error_rates(INPUT_bamfile, referenceGenome_file, real_error_rate_file, n_profile_reads, n_cores=n_cores)
+	# Generate Errors into fastq files
+	SubstiError(real_error_rate_file, outdirectory, synthetic_fastq_prename, n_cores=n_cores, random_seed=random_seed, compress=compress, compress_threads=compress_threads)
+	# Read 1 (cell barcode and UMI) has no substitution errors
+	suffix = Utility.output_suffix(compress)
+	read1_fq = Utility.resolve_output_file("%s/%s.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
+	read1_error_fq = "%s/%s.ErrorIncluded.read1.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix)
+	if sort_reads:
+		print('[scReadSim] Sorting FASTQ files...')
+		Utility.sort_fastq(read1_fq, read1_error_fq, sort_memory, temp_directory, n_cores, compress_threads)
+	else:
+		Utility.copy_fastq(read1_fq, read1_error_fq, compress_threads)
+	Utility.order_fastq("%s/%s.ErrorIncluded.read2.bed2fa.fq%s" % (outdirectory, synthetic_fastq_prename, suffix), "%s/%s.ErrorIncluded.read2.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix), sort_reads, sort_memory, temp_directory, n_cores, compress_threads)
 	print("\n[scReadSim] Created:")
-	print("[scReadSim] Read 1 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
-	print("[scReadSim] Read 2 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq" % (outdirectory, synthetic_fastq_prename))
+	print("[scReadSim] Read 1 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read1.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix))
+	print("[scReadSim] Read 2 FASTQ File with Substitution Error: %s/%s.ErrorIncluded.read2.bed2fa.sorted.fq%s" % (outdirectory, synthetic_fastq_prename, suffix))
 	print("[scReadSim] Done.")
 
 
@@ -0,0 +1,44 @@
+import scReadSim.IntervalSet as IntervalSet
+
+
+def as_records(intervals):
+    return [(chrom, int(s), int(e)) for chrom, (start, end) in intervals.items() for s, e in zip(start, end)]
+
+
+def test_sort_by_name_start_end():
+    intervals = IntervalSet.from_arrays(["chr2", "chr10", "chr2", "chr2"], [50, 5, 10, 10], [60, 8, 30, 20])
+    assert as_records(IntervalSet.sort(intervals)) == [("chr10", 5, 8), ("chr2", 10, 20), ("chr2", 10, 30), ("chr2", 50, 60)]
+
+
+def test_merge_overlapping_and_book_ended():
+    intervals = IntervalSet.from_arrays(["chr1"] * 5, [30, 10, 20, 50, 12], [40, 20, 25, 60, 15])
+    assert as_records(IntervalSet.merge(intervals)) == [("chr1", 10, 25), ("chr1", 30, 40), ("chr1", 50, 60)]
+
+
+def test_merge_contained_interval():
+    intervals = IntervalSet.from_arrays(["chr1"] * 3, [0, 10, 100], [200, 20, 150])
+    assert as_records(IntervalSet.merge(intervals)) == [("chr1", 0, 200)]
+
+
+def test_complement_chromosome_without_intervals():
+    intervals = IntervalSet.from_arrays(["chr1", "chr1"], [0, 50], [10, 60])
+    genome_size = {"chr1": 100, "chr2": 80}
+    assert as_records(IntervalSet.complement(intervals, genome_size)) == [("chr1", 10, 50), ("chr1", 60, 100), ("chr2", 0, 80)]
+
+
+def test_complement_ignores_unlisted_chromosomes_and_clips():
+    intervals = IntervalSet.from_arrays(["chr1", "chrUn"], [90, 0], [120, 10])
+    assert as_records(IntervalSet.complement(intervals, {"chr1": 100})) == [("chr1", 0, 90)]
+
+
+def test_intersect_partial_overlaps():
+    intervals_a = IntervalSet.from_arrays(["chr1", "chr1", "chr1", "chr2"], [100, 300, 500, 0], [200, 400, 600, 50])
+    intervals_b = IntervalSet.from_arrays(["chr1", "chr1", "chr1"], [150, 350, 380], [250, 360, 500])
+    # Book-ended intervals (chr1:400-500 with chr1:500-600) share no base, and chr2 has no interval in b
+    assert as_records(IntervalSet.intersect(intervals_a, intervals_b)) == [("chr1", 150, 200), ("chr1", 350, 360), ("chr1", 380, 400)]
+
+
+def test_subtract_partial_overlaps():
+    intervals_a = IntervalSet.from_arrays(["chr1", "chr1", "chr2"], [100, 300, 0], [200, 400, 50])
+    intervals_b = IntervalSet.from_arrays(["chr1", "chr1", "chr1"], [150, 320, 390], [250, 330, 500])
+    assert as_records(IntervalSet.subtract(intervals_a, intervals_b)) == [("chr1", 100, 150), ("chr1", 300, 320), ("chr1", 330, 390), ("chr2", 0, 50)]
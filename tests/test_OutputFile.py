@@ -0,0 +1,60 @@
+import gzip
+
+import pysam
+import pytest
+
+import scReadSim.Utility as Utility
+
+
+def bed_lines(n_line):
+    return ["chr%d\t%d\t%d\tread%d\t50\t+\n" % (1 + k // (n_line // 2), 10 * k, 10 * k + 50, k) for k in range(n_line)]
+
+
+def write_output(filename, lines, codec, threads):
+    with Utility.OutputFile(filename, codec, threads) as outsfile:
+        for k in range(0, len(lines), 1000):
+            outsfile.write("".join(lines[k:k + 1000]))
+    with open(filename, "rb") as infile:
+        return infile.read()
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Several compression tasks in flight for a small file
+    monkeypatch.setattr(Utility, "COMPRESS_CHUNK_SIZE", 50000)
+
+
+def test_bgzf_readable_and_indexable(tmp_path, small_chunks):
+    lines = bed_lines(20000)
+    bed_file = str(tmp_path / "reads.bed.gz")
+    write_output(bed_file, lines, None, 2)
+    with gzip.open(bed_file, "rt") as infile:
+        assert infile.read() == "".join(lines)
+    pysam.tabix_index(bed_file, preset="bed", force=True)
+    with pysam.TabixFile(bed_file) as tabix_file:
+        assert list(tabix_file.fetch("chr2", 100000, 100100)) == [line.rstrip("\n") for line in lines[10000:10010]]
+
+
+@pytest.mark.parametrize("codec", ["gzip", "bgzf"])
+def test_output_independent_of_threads(tmp_path, small_chunks, codec):
+    lines = bed_lines(20000)
+    outputs = [write_output(str(tmp_path / ("out%d.gz" % threads)), lines, codec, threads) for threads in [0, 1, 4]]
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+@pytest.mark.parametrize("codec", ["none", "gzip"])
+def test_round_trip(tmp_path, small_chunks, codec):
+    lines = bed_lines(20000)
+    filename = str(tmp_path / ("out.%s" % codec))
+    data = write_output(filename, lines, codec, 2)
+    with Utility.OutputFile(filename, codec, 2, mode='a') as outsfile:
+        outsfile.writelines([b"appended\n"])
+    expected = "".join(lines) + "appended\n"
+    if codec == "none":
+        assert data == "".join(lines).encode()
+        with open(filename) as infile:
+            assert infile.read() == expected
+    else:
+        assert gzip.decompress(data).decode() == "".join(lines)
+        with gzip.open(filename, "rt") as infile:
+            assert infile.read() == expected
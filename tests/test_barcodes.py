@@ -0,0 +1,72 @@
+import itertools
+
+import numpy as np
+import pytest
+
+import scReadSim.Utility as Utility
+
+
+def hamming_distances(barcodes):
+    bases = np.array([list(barcode) for barcode in barcodes])
+    return [int(np.sum(bases[i] != bases[j])) for i, j in itertools.combinations(range(len(barcodes)), 2)]
+
+
+def write_whitelist(path, n, size, rng):
+    barcodes = sorted(set("".join(rng.choice(list("ACGT"), size=size)) for _ in range(n)))
+    with open(path, "w") as outfile:
+        outfile.write("".join(barcode + "\n" for barcode in barcodes))
+    return str(path), barcodes
+
+
+def test_barcodes_unique():
+    barcodes = Utility.generate_barcodes(50000, 16, np.random.default_rng(1))
+    assert len(barcodes) == 50000 and len(set(barcodes)) == 50000
+    assert all(len(barcode) == 16 and set(barcode) <= set("ACGT") for barcode in barcodes)
+    # Every barcode of the space, so duplicates must be redrawn
+    barcodes = Utility.generate_barcodes(256, 4, np.random.default_rng(2))
+    assert sorted(barcodes) == sorted("".join(bases) for bases in itertools.product("ACGT", repeat=4))
+
+
+def test_barcodes_unique_within_groups():
+    groups = np.repeat(np.arange(20), 60)
+    barcodes = Utility.generate_barcodes(len(groups), 3, np.random.default_rng(3), groups=groups)
+    for group in range(20):
+        group_barcodes = [barcodes[k] for k in np.nonzero(groups == group)[0]]
+        assert len(set(group_barcodes)) == 60
+    # Only 64 barcodes of 3 bp, so groups share barcodes
+    assert len(set(barcodes)) < len(barcodes)
+
+
+def test_barcodes_too_many_in_group():
+    with pytest.raises(SystemExit):
+        Utility.draw_barcode_codes(65, 3, np.random.default_rng(4), groups=np.zeros(65, dtype=np.int64))
+
+
+@pytest.mark.parametrize("min_distance", [2, 3, 4])
+def test_barcodes_min_distance(min_distance):
+    barcodes = Utility.generate_barcodes(300, 12, np.random.default_rng(5), min_distance=min_distance)
+    assert len(barcodes) == 300
+    assert min(hamming_distances(barcodes)) >= min_distance
+
+
+def test_spaced_barcode_codes_greedy():
+    candidates, size = Utility.encode_barcodes(["AAAA", "AAAC", "AACC", "CCCC", "AAAA", "GGGA"])
+    accepted = Utility.spaced_barcode_codes(10, size, [candidates], 2)
+    assert Utility.decode_barcodes(accepted, size) == ["AAAA", "AACC", "CCCC", "GGGA"]
+
+
+def test_whitelist_draws(tmp_path):
+    whitelist_file, whitelist = write_whitelist(tmp_path / "whitelist.txt", 400, 10, np.random.default_rng(6))
+    barcodes = Utility.generate_barcodes(200, 10, np.random.default_rng(7), whitelist=whitelist_file)
+    assert len(set(barcodes)) == 200 and set(barcodes) <= set(whitelist)
+    barcodes = Utility.generate_barcodes(50, 10, np.random.default_rng(8), whitelist=whitelist_file, min_distance=3)
+    assert set(barcodes) <= set(whitelist)
+    assert min(hamming_distances(barcodes)) >= 3
+
+
+def test_whitelist_exhausted(tmp_path):
+    whitelist_file, whitelist = write_whitelist(tmp_path / "whitelist.txt", 100, 10, np.random.default_rng(9))
+    with pytest.raises(SystemExit, match="whitelist only provides"):
+        Utility.generate_barcodes(len(whitelist) + 1, 10, np.random.default_rng(10), whitelist=whitelist_file)
+    with pytest.raises(SystemExit, match="whitelist only provides"):
+        Utility.generate_barcodes(len(whitelist), 10, np.random.default_rng(11), whitelist=whitelist_file, min_distance=8)
@@ -0,0 +1,81 @@
+import numpy as np
+import pysam
+
+import scReadSim.Utility as Utility
+
+
+CHROM_LENGTH = 100000
+
+
+def write_bam(path, reads):
+    """Write reads given as (name, start, length, is_reverse, mate_start, template_length) to an indexed BAM file.
+
+    Reads with a mate_start of None are unpaired.
+    """
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": CHROM_LENGTH}]}
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        for name, start, length, is_reverse, mate_start, template_length in sorted(reads, key=lambda read: read[1]):
+            segment = pysam.AlignedSegment(bam.header)
+            segment.query_name = name
+            segment.reference_id = 0
+            segment.reference_start = start
+            segment.cigarstring = "%dM" % length
+            segment.query_sequence = "A" * length
+            segment.mapping_quality = 60
+            segment.is_reverse = is_reverse
+            if mate_start is not None:
+                segment.is_paired = True
+                segment.is_proper_pair = True
+                segment.is_read1 = not is_reverse
+                segment.is_read2 = is_reverse
+                segment.mate_is_reverse = not is_reverse
+                segment.next_reference_id = 0
+                segment.next_reference_start = mate_start
+                segment.template_length = template_length
+            bam.write(segment)
+    pysam.index(str(path))
+    return str(path)
+
+
+def write_lines(path, lines):
+    with open(path, "w") as outfile:
+        outfile.write("".join(line + "\n" for line in lines))
+    return str(path)
+
+
+def count_matrix(tmp_path, bam_file, peaks, count_mode):
+    cells_file = write_lines(tmp_path / "cells.txt", ["AAAC", "GGGT"])
+    bed_file = write_lines(tmp_path / "peaks.bed", ["chr1\t%d\t%d" % peak for peak in peaks])
+    Utility.scATAC_bam2countmat_paral(cells_file, bed_file, bam_file, str(tmp_path), count_mode, count_mode=count_mode, count_mat_format="txt")
+    return np.loadtxt(tmp_path / ("%s.txt" % count_mode), dtype=np.int64, usecols=(1, 2), ndmin=2)
+
+
+def test_fragment_counted_once(tmp_path):
+    bam_file = write_bam(tmp_path / "pair.bam", [
+        ("AAAC:1", 1000, 50, False, 1150, 200),
+        ("AAAC:1", 1150, 50, True, 1000, -200),
+        ])
+    counts = count_matrix(tmp_path, bam_file, [(1050, 1150)], "fragment")
+    assert counts.tolist() == [[1, 0]]
+
+
+def test_fragment_unpaired_read_midpoint(tmp_path):
+    bam_file = write_bam(tmp_path / "single.bam", [("GGGT:1", 1080, 50, False, None, 0)])
+    counts = count_matrix(tmp_path, bam_file, [(1050, 1100), (1100, 1150)], "fragment")
+    assert counts.tolist() == [[0, 0], [0, 1]]
+
+
+def test_sweep_matches_fetch_on_overlapping_features(tmp_path):
+    rng = np.random.default_rng(7)
+    cells = rng.choice(["AAAC", "GGGT", "TTTT"], size=400) # TTTT is not a listed cell
+    starts = rng.integers(0, 5000, size=400)
+    lengths = rng.integers(20, 120, size=400)
+    reverse = rng.integers(2, size=400).astype(bool)
+    reads = [("%s:%d" % (cells[k], k), int(starts[k]), int(lengths[k]), bool(reverse[k]), None, 0) for k in range(400)]
+    bam_file = write_bam(tmp_path / "reads.bam", reads)
+    # Nested, overlapping, book-ended and duplicated features
+    peaks = [(100, 900), (200, 300), (250, 1200), (1200, 1500), (1200, 1500), (1499, 1501), (2000, 4000), (2500, 2600), (4990, 5200)]
+    fetch_counts = count_matrix(tmp_path, bam_file, peaks, "fetch")
+    read_counts = count_matrix(tmp_path, bam_file, peaks, "read")
+    assert fetch_counts.sum() > 0
+    assert (fetch_counts == read_counts).all()
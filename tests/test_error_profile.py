@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pysam
+import pytest
+
+import scReadSim.Utility as Utility
+
+
+REFERENCE = "ACGT" * 250
+
+
+def write_reference(path, chrom):
+    with open(path, "w") as outfile:
+        outfile.write(">%s\n%s\n" % (chrom, REFERENCE))
+    pysam.faidx(str(path))
+    return str(path)
+
+
+def write_bam(path, chrom, mapping_quality=60):
+    """Write 20 reads matching the reference, except for a G to C substitution at cycle 3 of the first read."""
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": chrom, "LN": len(REFERENCE)}]}
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        for k in range(20):
+            start = 40 * k
+            seq = REFERENCE[start:start + 20]
+            if k == 0:
+                seq = seq[:2] + "C" + seq[3:]
+            segment = pysam.AlignedSegment(bam.header)
+            segment.query_name = "read%d" % k
+            segment.reference_id = 0
+            segment.reference_start = start
+            segment.cigarstring = "20M"
+            segment.query_sequence = seq
+            segment.query_qualities = pysam.qualitystring_to_array("I" * 20)
+            segment.mapping_quality = mapping_quality
+            bam.write(segment)
+    pysam.index(str(path))
+    return str(path)
+
+
+def test_profile_error_rates(tmp_path):
+    reference_file = write_reference(tmp_path / "ref.fa", "chr1")
+    bam_file = write_bam(tmp_path / "reads.bam", "chr1")
+    table = Utility.profile_error_rates(bam_file, reference_file, str(tmp_path / "rates.txt"))
+    assert table["bases_total"].tolist() == [20] * 20
+    assert table["errors"].tolist() == [0, 0, 1] + [0] * 17
+    assert table.loc[2, "g_to_c_error_rate"] == pytest.approx(1 / 20)
+    assert pd.read_csv(tmp_path / "rates.txt", sep="\t").shape == table.shape
+
+
+def test_profile_error_rates_chromosome_name_mismatch(tmp_path):
+    reference_file = write_reference(tmp_path / "ref.fa", "1")
+    bam_file = write_bam(tmp_path / "reads.bam", "chr1")
+    with pytest.raises(SystemExit, match="chromosome names"):
+        Utility.profile_error_rates(bam_file, reference_file, str(tmp_path / "rates.txt"))
+
+
+def test_profile_error_rates_no_read_passes_filters(tmp_path):
+    reference_file = write_reference(tmp_path / "ref.fa", "chr1")
+    bam_file = write_bam(tmp_path / "reads.bam", "chr1", mapping_quality=10)
+    with pytest.raises(SystemExit, match="min_mapping_quality"):
+        Utility.profile_error_rates(bam_file, reference_file, str(tmp_path / "rates.txt"))
@@ -0,0 +1,83 @@
+import filecmp
+import os
+
+import numpy as np
+import pysam
+import pytest
+
+import scReadSim.scATAC_GenerateBAM as scATAC_GenerateBAM
+
+
+DATA_DIR = os.path.join(os.path.dirname(scATAC_GenerateBAM.__file__), "data")
+INPUT_BAMFILE = os.path.join(DATA_DIR, "10X_ATAC_chr1_4194444_4399104.bam")
+PEAK_BED = os.path.join(DATA_DIR, "10x_ATAC_chr1_4194444_4399104.input.peak.bed")
+N_CELL = 30
+
+
+def write_countmat(path, bed_file, rng):
+    """Write a dense synthetic count matrix for the features of `bed_file`."""
+    with open(bed_file) as infile:
+        features = ["_".join(line.split()[0:3]) for line in infile if line.strip()]
+    with open(path, "w") as outfile:
+        for feature in features:
+            outfile.write(feature + "\t" + "\t".join(rng.poisson(2, size=N_CELL).astype(str)) + "\n")
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def synthesis_inputs(tmp_path_factory):
+    input_dir = tmp_path_factory.mktemp("inputs")
+    rng = np.random.default_rng(11)
+    samfile = pysam.AlignmentFile(INPUT_BAMFILE, "rb")
+    chrom_length = samfile.get_reference_length("chr1")
+    samfile.close()
+    reference_file = str(input_dir / "chr1.fa")
+    with open(reference_file, "w") as outfile:
+        outfile.write(">chr1\n%s\n" % np.frombuffer(b"ACGT", dtype="S1")[rng.integers(4, size=chrom_length)].tobytes().decode())
+    pysam.faidx(reference_file)
+    label_file = str(input_dir / "labels.txt")
+    with open(label_file, "w") as outfile:
+        outfile.write("".join("type%d\n" % (cell % 2) for cell in range(N_CELL)))
+    return {"count_mat_file": write_countmat(input_dir / "peak.countmat.txt", PEAK_BED, rng), "label_file": label_file, "reference_file": reference_file}
+
+
+def synthesize(outdirectory, synthesis_inputs, n_cores):
+    os.makedirs(outdirectory, exist_ok=True)
+    scATAC_GenerateBAM.scATAC_GenerateBAMCoord(PEAK_BED, synthesis_inputs["count_mat_file"], synthesis_inputs["label_file"], "syn", INPUT_BAMFILE, str(outdirectory), str(outdirectory / "barcodes.txt"), n_cores=n_cores, sort_memory="1M")
+    scATAC_GenerateBAM.scATAC_BED2FASTQ(None, None, synthesis_inputs["reference_file"], str(outdirectory), "syn", "syn", n_cores=n_cores)
+
+
+def test_synthesis_independent_of_n_cores(tmp_path, synthesis_inputs):
+    synthesize(tmp_path / "cores1", synthesis_inputs, 1)
+    synthesize(tmp_path / "cores2", synthesis_inputs, 2)
+    output_files = ["syn.read1.bed", "syn.read2.bed", "syn.read1.bed2fa.sorted.fq", "syn.read2.bed2fa.sorted.fq", "barcodes.txt"]
+    assert os.path.getsize(tmp_path / "cores1" / "syn.read1.bed") > 0
+    for output_file in output_files:
+        assert filecmp.cmp(tmp_path / "cores1" / output_file, tmp_path / "cores2" / output_file, shallow=False), output_file
+
+
+def test_empty_gray_area_file(tmp_path, synthesis_inputs):
+    nonpeak_bed = os.path.join(DATA_DIR, "10x_ATAC_chr1_4194444_4399104.input.nonpeak.bed")
+    count_mat_file = write_countmat(tmp_path / "nonpeak.countmat.txt", nonpeak_bed, np.random.default_rng(5))
+    open(tmp_path / "scReadSim.grayareas.bed", "w").close()
+    scATAC_GenerateBAM.scATAC_GenerateBAMCoord(nonpeak_bed, count_mat_file, synthesis_inputs["label_file"], "syn", INPUT_BAMFILE, str(tmp_path), str(tmp_path / "barcodes.txt"), GrayAreaModeling=True)
+    assert os.path.getsize(tmp_path / "syn.read1.bed") > 0
+    assert os.path.getsize(tmp_path / "syn.GrayArea.read1.bed") == 0
+    assert os.path.getsize(tmp_path / "syn.GrayArea.read2.bed") == 0
+    assert os.path.getsize(tmp_path / "GrayArea_Assigned_Synthetic_CountMatrix.txt") == 0
+
+
+def test_bed2bam_proper_pair_flag(tmp_path):
+    reference_file = str(tmp_path / "ref.fa")
+    with open(reference_file, "w") as outfile:
+        outfile.write(">chr1\n%s\n" % ("ACGT" * 5000))
+    with open(tmp_path / "syn.read1.bed", "w") as outfile:
+        outfile.write("chr1\t100\t150\tAAAC:CellNo1:chr1:0-20000#0000\t50\t+\n")
+        outfile.write("chr1\t200\t250\tAAAC:CellNo1:chr1:0-20000#0001\t50\t+\n")
+    with open(tmp_path / "syn.read2.bed", "w") as outfile:
+        outfile.write("chr1\t350\t400\tAAAC:CellNo1:chr1:0-20000#0000\t50\t-\n")
+        outfile.write("chr1\t15000\t15050\tAAAC:CellNo1:chr1:0-20000#0001\t50\t-\n")
+    scATAC_GenerateBAM.scATAC_BED2BAM(reference_file, str(tmp_path), "syn", "truth", max_insert=1200)
+    with pysam.AlignmentFile(str(tmp_path / "truth.synthetic.sorted.bam"), "rb") as bam:
+        proper_pair = {(read.query_name[-4:], read.is_read1): (read.is_proper_pair, abs(read.template_length)) for read in bam}
+    assert proper_pair == {("0000", True): (True, 300), ("0000", False): (True, 300), ("0001", True): (False, 14850), ("0001", False): (False, 14850)}
@@ -0,0 +1,50 @@
+import numpy as np
+
+import scReadSim.Utility as Utility
+
+
+def write_read_pairs(tmp_path, n_pair, rng):
+    """Write read 1 and read 2 bed files of read pairs in random order, with many equal coordinates. Both reads of a pair share their name."""
+    chroms = rng.choice(["chr1", "chr10", "chr2", "chrX"], size=n_pair)
+    starts = rng.integers(0, 200, size=n_pair)
+    ends = starts + rng.integers(1, 3, size=n_pair)
+    read1_lines = ["%s\t%d\t%d\tpair%d\t50\t+\n" % (chrom, start, end, k) for k, (chrom, start, end) in enumerate(zip(chroms, starts, ends))]
+    read2_lines = ["%s\t%d\t%d\tpair%d\t50\t-\n" % (chrom, start + 300, end + 300, k) for k, (chrom, start, end) in enumerate(zip(chroms, starts, ends))]
+    bed_files = [str(tmp_path / "read1.bed"), str(tmp_path / "read2.bed")]
+    for bed_file, lines in zip(bed_files, [read1_lines, read2_lines]):
+        with open(bed_file, "w") as outfile:
+            outfile.write("".join(lines))
+    return bed_files, read1_lines, read2_lines
+
+
+def test_sort_bed_spilled_runs(tmp_path, monkeypatch):
+    bed_files, read1_lines, read2_lines = write_read_pairs(tmp_path, 5000, np.random.default_rng(1))
+    merged_groups = []
+    merge_sorted_beds = Utility.merge_sorted_beds
+    def record_merge(bed_file_groups, *args, **kwargs):
+        merged_groups.append(len(bed_file_groups))
+        return merge_sorted_beds(bed_file_groups, *args, **kwargs)
+    monkeypatch.setattr(Utility, "merge_sorted_beds", record_merge)
+    sorted_bed_files = [str(tmp_path / "read1.sorted.bed"), str(tmp_path / "read2.sorted.bed")]
+    Utility.sort_bed(bed_files, sorted_bed_files, memory_budget=50000)
+    assert merged_groups[0] > 5
+    # Stable in-memory sort by chromosome (as bytes), start and end of read 1
+    order = sorted(range(len(read1_lines)), key=lambda k: Utility.bed_record_key((read1_lines[k].encode(),)))
+    with open(sorted_bed_files[0]) as infile:
+        assert infile.read() == "".join(read1_lines[k] for k in order)
+    with open(sorted_bed_files[1]) as infile:
+        assert infile.read() == "".join(read2_lines[k] for k in order)
+    assert not [path for path in tmp_path.iterdir() if ".sortrun" in path.name]
+
+
+def test_sort_bed_in_place_compressed(tmp_path):
+    bed_files, read1_lines, read2_lines = write_read_pairs(tmp_path, 2000, np.random.default_rng(2))
+    Utility.sort_bed(bed_files, bed_files, memory_budget=30000)
+    Utility.sort_bed(bed_files, [bed_file + ".gz" for bed_file in bed_files], memory_budget=30000)
+    with open(bed_files[0]) as infile:
+        read1_sorted = infile.read()
+    with Utility.open_input(bed_files[0] + ".gz") as infile:
+        assert infile.read().decode() == read1_sorted
+    with Utility.open_input(bed_files[1] + ".gz") as infile:
+        read2_names = [line.split(b"\t")[3] for line in infile]
+    assert read2_names == [line.split("\t")[3].encode() for line in read1_sorted.splitlines()]
@@ -0,0 +1,64 @@
+import filecmp
+
+import numpy as np
+import pandas as pd
+
+import scReadSim.Utility as Utility
+
+
+PROFILE_LENGTH = 30
+
+
+def error_rate_table(error_rate=0.2):
+    table = pd.DataFrame({"read_number": 1, "position": np.arange(1, PROFILE_LENGTH + 1), "error_rate": error_rate})
+    for columns in Utility.SUBSTITUTION_COLUMNS.values():
+        for k, column in enumerate(columns):
+            table[column] = 0.01 * (k + 1)
+    return table
+
+
+def write_fastq(path, n_read, rng):
+    """Write lowercase reads of 10 to 50 bp, some with N bases, with quality 'I'."""
+    with open(path, "w") as outfile:
+        for k in range(n_read):
+            seq = "".join(np.array(list("acgtn"))[rng.choice(5, size=rng.integers(10, 51), p=[0.24, 0.24, 0.24, 0.24, 0.04])])
+            outfile.write("@read%d\n%s\n+\n%s\n" % (k, seq, "I" * len(seq)))
+    return str(path)
+
+
+def fastq_reads(path):
+    with open(path) as infile:
+        lines = infile.read().splitlines()
+    return lines[1::4], lines[3::4]
+
+
+def test_substitution_errors(tmp_path):
+    fastq_file = write_fastq(tmp_path / "reads.fq", 2000, np.random.default_rng(3))
+    Utility.add_substitution_errors(fastq_file, str(tmp_path / "errors.fq"), error_rate_table(), chunk_size=500)
+    n_error_read = 0
+    for (seq, qual), (error_seq, error_qual) in zip(zip(*fastq_reads(fastq_file)), zip(*fastq_reads(tmp_path / "errors.fq"))):
+        assert len(error_seq) == len(seq) and len(error_qual) == len(qual)
+        substituted = [k for k in range(len(seq)) if error_seq[k].upper() != seq[k].upper()]
+        # Substituted bases, and only they, get quality '9'
+        assert [k for k in range(len(qual)) if error_qual[k] != qual[k]] == substituted
+        assert set(error_qual[k] for k in substituted) <= {"9"}
+        # No error past the end of the error rate table, and none on N bases
+        assert all(k < PROFILE_LENGTH and seq[k] != "n" for k in substituted)
+        # Only reads with a substituted base are uppercased
+        if substituted:
+            n_error_read += 1
+            assert error_seq == error_seq.upper()
+        else:
+            assert error_seq == seq
+    assert 0 < n_error_read < 2000
+
+
+def test_substitution_errors_independent_of_n_cores_and_chunk_size(tmp_path):
+    fastq_file = write_fastq(tmp_path / "reads.fq", 3 * Utility.SUBSTITUTION_BLOCK_SIZE + 100, np.random.default_rng(4))
+    table = error_rate_table(0.05)
+    Utility.add_substitution_errors(fastq_file, str(tmp_path / "errors1.fq"), table, chunk_size=1, n_cores=1)
+    Utility.add_substitution_errors(fastq_file, str(tmp_path / "errors2.fq"), table, chunk_size=2 * Utility.SUBSTITUTION_BLOCK_SIZE, n_cores=2)
+    Utility.add_substitution_errors(fastq_file, str(tmp_path / "errors3.fq"), table, chunk_size=65536, n_cores=3)
+    assert not filecmp.cmp(fastq_file, tmp_path / "errors1.fq", shallow=False)
+    assert filecmp.cmp(tmp_path / "errors1.fq", tmp_path / "errors2.fq", shallow=False)
+    assert filecmp.cmp(tmp_path / "errors1.fq", tmp_path / "errors3.fq", shallow=False)